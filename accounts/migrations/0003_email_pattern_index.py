@@ -0,0 +1,30 @@
+from django.db import migrations
+
+
+def create_pattern_index(apps, schema_editor):
+    """
+    Индекс email с varchar_pattern_ops для поиска по началу адреса (LIKE 'q%') на PostgreSQL.
+    Django создаёт такой индекс вместе с уникальным полем, здесь он гарантируется явно под тем же именем;
+    на sqlite LIKE этот индекс не использует, подсказка адресатов там идёт по обычному индексу.
+    """
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    model = apps.get_model("accounts", "MailboxUser")
+    table = model._meta.db_table
+    name = schema_editor._create_index_name(table, ["email"], suffix="_like")
+    schema_editor.execute(
+        f"CREATE INDEX IF NOT EXISTS {schema_editor.quote_name(name)} "
+        f"ON {schema_editor.quote_name(table)} ({schema_editor.quote_name('email')} varchar_pattern_ops)"
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0002_alter_first_name_max_length'),
+    ]
+
+    operations = [
+        # при откате индекс остаётся: он принадлежит уникальному полю email
+        migrations.RunPython(create_pattern_index, migrations.RunPython.noop),
+    ]
@@ -1,9 +1,14 @@
-from typing import List
+import time
+from typing import List, Iterable, Union, Optional, Iterator, Tuple
+
+from django.conf import settings
 
 from django.contrib.auth.base_user import BaseUserManager
 from django.contrib.auth.models import AbstractUser
 from django.core.exceptions import PermissionDenied
 from django.db import models, transaction
+from django.db.models import Count, Q
+from django.utils import timezone
 
 
 class MailboxUserManager(BaseUserManager):
@@ -41,6 +46,42 @@ class MailboxUserManager(BaseUserManager):
 
         return self._create_user(email, password, **extra_fields)
 
+    def resolve_ids(self, recipients: "Iterable[Union[int, str]]",
+                    batch_size: int) -> "Tuple[List[int], List[Union[int, str]]]":
+        """
+        Переводит адресатов, заданных id или email, в список id существующих пользователей.
+        Пользователи проверяются пакетами, без создания объектов.
+        Возвращает найденные id (без повторов, в исходном порядке) и не найденных адресатов.
+        """
+        recipients = list(dict.fromkeys(recipients))
+        found = {}
+        for start in range(0, len(recipients), batch_size):
+            chunk = recipients[start:start + batch_size]
+            ids = [r for r in chunk if isinstance(r, int)]
+            emails = [r for r in chunk if isinstance(r, str)]
+            if ids:
+                found.update((user_id, user_id) for user_id in self.filter(id__in=ids).values_list("id", flat=True))
+            if emails:
+                found.update(self.filter(email__in=emails).values_list("email", "id"))
+        resolved = list(dict.fromkeys(found[r] for r in recipients if r in found))
+        unknown = [r for r in recipients if r not in found]
+        return resolved, unknown
+
+
+class FanoutResult:
+    """Итог рассылки: сколько писем доставлено, какие адресаты не найдены и за какое время"""
+
+    def __init__(self, message: "Message", delivered: int, unknown: "List[Union[int, str]]", elapsed: float):
+        self.message = message
+        self.delivered = delivered
+        self.unknown = unknown
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self) -> float:
+        """Доставлено писем в секунду"""
+        return self.delivered / self.elapsed if self.elapsed else 0.0
+
 
 class MailboxUser(AbstractUser):
     """
@@ -70,30 +111,231 @@ class MailboxUser(AbstractUser):
         Дело в том, что письмо по-сути отправляется путём его создания.
         """
 
+        # адресат, указанный дважды, получает одно письмо
+        recipient_ids = list(dict.fromkeys(user.pk for user in users))
+        with shard_transactions([self.pk, *recipient_ids]):
+            message = self._create_message(header, text)
+            emails = [self._create_sent_letter(message), ]
+            for letters in self._deliver(message, recipient_ids):
+                emails.extend(letters)
+        return emails
+
+    @transaction.atomic
+    def send_mail_fanout(self, header: "str", text: "str", recipients: "Iterable[Union[int, str]]",
+                         batch_size: "Optional[int]" = None) -> "FanoutResult":
+        """
+        Отправка письма большому количеству адресатов (рассылка).
+        Адресаты передаются id или email-ами, объекты пользователей не создаются.
+        Адресаты и письма вставляются пакетами фиксированного размера,
+        поэтому ни память, ни размер одного запроса не растут с числом адресатов.
+        """
+        batch_size = batch_size or settings.MAILBOX_FANOUT_BATCH_SIZE
+        started = time.perf_counter()
+        recipient_ids, unknown = MailboxUser.objects.resolve_ids(recipients, batch_size)
+
+        delivered = 0
+        with shard_transactions([self.pk, *recipient_ids]):
+            message = self._create_message(header, text)
+            self._create_sent_letter(message)
+            for letters in self._deliver(message, recipient_ids, batch_size):
+                delivered += len(letters)
+        return FanoutResult(message, delivered, unknown, time.perf_counter() - started)
+
+    def _create_message(self, header: "str", text: "str") -> "Message":
         message = Message(sender=self, header=header, text=text)
         message.clean_fields()  # sqlite3 не проверяет длину текста, поэтому нужно самому
         message.save()
-        message.addressees_set.add(*users)
-        sent_email = Letter(user=self, message=message, type=EmailTypes.OUTGOING.value)
-
-        emails = [sent_email, ]
-        for user in users:  # type: MailboxUser
-            inbox_email = Letter(user=user, message=message, type=EmailTypes.INCOMING.value, is_read=False)
-            emails.append(inbox_email)
-        emails = Letter.objects.bulk_create(emails)  # Чтобы одним запросом все письма сохранить.
-        return emails
+        index_message(message)
+        return message
+
+    def _create_sent_letter(self, message: "Message") -> "Letter":
+        # счётчики обновляются до вставки писем, иначе недостающие счётчики учтут новые письма дважды
+        FolderCounters.objects.letter_sent(self.pk)
+        invalidate_users([self.pk])
+        letter = Letter.objects.on_shard_of(self).create(user=self, message=message, type=EmailTypes.OUTGOING.value)
+        index_letter_database([message], shard_for_user(self.pk))
+        LetterChange.objects.record(ChangeKinds.CREATED, [(self.pk, letter.id, letter.type)])
+        return letter
+
+    @transaction.atomic
+    def send_mail_queued(self, header: "str", text: "str", recipients: "Iterable[Union[int, str]]",
+                         batch_size: "Optional[int]" = None) -> "FanoutResult":
+        """
+        Отправка с отложенной доставкой.
+        Сообщение, его адресаты и письмо отправителя сохраняются сразу,
+        а входящие письма адресатов создаёт очередь доставки (команда deliver_mail).
+        """
+        batch_size = batch_size or settings.MAILBOX_FANOUT_BATCH_SIZE
+        started = time.perf_counter()
+        recipient_ids, unknown = MailboxUser.objects.resolve_ids(recipients, batch_size)
+
+        message = self._create_message(header, text)
+        with shard_transactions([self.pk]):
+            self._create_sent_letter(message)
+        for start in range(0, len(recipient_ids), batch_size):
+            self._add_addressees(message, recipient_ids[start:start + batch_size])
+        enqueue_delivery(message, recipient_ids, batch_size)
+        return FanoutResult(message, 0, unknown, time.perf_counter() - started)
+
+    @staticmethod
+    def _add_addressees(message: "Message", recipient_ids: "List[int]"):
+        addressee = Message.addressees_set.through
+        addressee.objects.bulk_create(
+            [addressee(message_id=message.pk, mailboxuser_id=user_id) for user_id in recipient_ids])
+
+    @staticmethod
+    def _deliver(message: "Message", recipient_ids: "List[int]", batch_size: "Optional[int]" = None,
+                 add_addressees: bool = True) -> "Iterator[List[Letter]]":
+        """
+        Доставка сообщения во входящие адресатов: адресаты сообщения, письма и счётчики.
+        Работает пакетами по batch_size адресатов, отдавая письма каждого пакета.
+        Письма пакета вставляются одним запросом в каждую базу писем (mail_box.shards),
+        транзакции этих баз открывает вызывающий (shard_transactions).
+        """
+        batch_size = batch_size or settings.MAILBOX_FANOUT_BATCH_SIZE
+        for start in range(0, len(recipient_ids), batch_size):
+            chunk = recipient_ids[start:start + batch_size]
+            FolderCounters.objects.letters_received(chunk)
+            invalidate_users(chunk)
+            if add_addressees:
+                MailboxUser._add_addressees(message, chunk)
+            letters, changes = [], []
+            for alias, shard_chunk in group_by_shard(chunk).items():
+                shard_letters = [Letter(user_id=user_id, message=message, type=EmailTypes.INCOMING.value,
+                                        is_read=False) for user_id in shard_chunk]
+                # Чтобы одним запросом все письма пакета сохранить.
+                shard_letters = Letter.objects.using(alias).bulk_create(shard_letters)
+                index_letter_database([message], alias)
+                if shard_letters and shard_letters[0].pk is not None:
+                    delivered = [(letter.user_id, letter.pk) for letter in shard_letters]
+                else:
+                    # sqlite не возвращает id после bulk_create
+                    delivered = Letter.objects.using(alias).filter(
+                        message=message, user_id__in=shard_chunk, type=EmailTypes.INCOMING.value
+                    ).values_list("user_id", "id")
+                letters.extend(shard_letters)
+                changes.extend((user_id, letter_id, EmailTypes.INCOMING.value) for user_id, letter_id in delivered)
+            last_seq = LetterChange.objects.record(ChangeKinds.CREATED, changes)
+            notify_new_mail(last_seq)
+            yield letters
 
     def is_ownership_letter(self, letter: "Letter"):
-        return letter.user == self
+        return letter.user_id == self.pk  # по id, чтобы не загружать владельца письма
 
-    def read_letter(self, letter):
-        """Пользователь читает письмо"""
+    def read_letter(self, letter) -> bool:
+        """
+        Пользователь читает письмо.
+        Возвращает True, если отметка изменилась. Уже прочитанное письмо ничего не записывает в базу.
+        """
         if not self.is_ownership_letter(letter):
             raise PermissionDenied("Пользователю, для прочтения, передано чужое письмо.")
-        letter.is_read = True
-        letter.save()
+        return self._mark_letter(letter, True)
+
+    def unread_letter(self, letter) -> bool:
+        """
+        Пользователь снимает с письма отметку о прочтении.
+        Возвращает True, если отметка изменилась.
+        """
+        if not self.is_ownership_letter(letter):
+            raise PermissionDenied("Пользователю, для снятия отметки о прочтении, передано чужое письмо.")
+        return self._mark_letter(letter, False)
+
+    def _mark_letter(self, letter, is_read: bool) -> bool:
+        """
+        Отметка одним условным UPDATE только изменяемого поля.
+        Если письмо уже в нужном состоянии, запись в базу не делается вовсе,
+        а при одновременных запросах счётчики меняет только тот, чей UPDATE изменил строку.
+        """
+        if letter.is_read == is_read:
+            return False
+        now = timezone.now()
+        with transaction.atomic(), shard_transactions([self.pk]):
+            FolderCounters.objects.ensure([self.pk])
+            changed = Letter.objects.for_user(self).filter(id=letter.id, is_read=not is_read) \
+                .update(is_read=is_read, updated_at=now)
+            if changed:
+                if is_read:
+                    FolderCounters.objects.letter_read(letter)
+                else:
+                    FolderCounters.objects.letter_unread(letter)
+                LetterChange.objects.record(ChangeKinds.READ if is_read else ChangeKinds.UNREAD,
+                                            [(self.pk, letter.id, letter.type)])
+                invalidate_users([self.pk])
+        letter.is_read = is_read
+        if changed:
+            letter.updated_at = now
+        return bool(changed)
+
+    @transaction.atomic
+    def delete_letter(self, letter):
+        """Пользователь удаляет письмо из своей папки"""
+        if not self.is_ownership_letter(letter):
+            raise PermissionDenied("Пользователю, для удаления, передано чужое письмо.")
+        if letter.archived:
+            # файл сегмента не меняется, удаление архивного письма запоминается отметкой (mail_box.archive).
+            # Архивные письма вычтены из счётчиков папок при переносе в архив, поэтому счётчики не меняются
+            _, created = ArchivedLetterDeletion.objects.get_or_create(user_id=self.pk, letter_id=letter.id)
+            if created:
+                LetterChange.objects.record(ChangeKinds.DELETED, [(self.pk, letter.id, letter.type)])
+                invalidate_users([self.pk])
+            return
+        FolderCounters.objects.letter_deleted(letter)
+        LetterChange.objects.record(ChangeKinds.DELETED, [(self.pk, letter.id, letter.type)])
+        invalidate_users([self.pk])
+        with shard_transactions([self.pk]):
+            letter.delete()
+
+    @transaction.atomic
+    def mark_letters(self, letters, is_read: bool) -> int:
+        """
+        Установка или снятие отметки о прочтении сразу у набора писем.
+        Письма фильтруются по владельцу и обновляются одним запросом.
+        Возвращает количество изменённых писем.
+        """
+        changed = letters.for_user(self).exclude(is_read=is_read)
+        with shard_transactions([self.pk]):
+            # строки блокируются до конца транзакции, поэтому журнал и счётчики совпадают с тем, что изменит UPDATE
+            rows = list(changed.select_for_update().order_by("id").values_list("id", "type"))
+            incoming_changed = sum(1 for _, letter_type in rows if letter_type == EmailTypes.INCOMING.value)
+            FolderCounters.objects.add(self.pk, unread_incoming=-incoming_changed if is_read else incoming_changed)
+            LetterChange.objects.record(ChangeKinds.READ if is_read else ChangeKinds.UNREAD,
+                                        [(self.pk, letter_id, letter_type) for letter_id, letter_type in rows])
+            updated = changed.update(is_read=is_read, updated_at=timezone.now())
+        if updated:
+            invalidate_users([self.pk])
+        return updated
+
+    @transaction.atomic
+    def delete_letters(self, letters) -> int:
+        """
+        Удаление набора писем одним запросом, с фильтрацией по владельцу.
+        Возвращает количество удалённых писем.
+        """
+        letters = letters.for_user(self)
+        with shard_transactions([self.pk]):
+            # строки блокируются до конца транзакции, поэтому журнал и счётчики совпадают с тем, что удалит DELETE
+            rows = list(letters.select_for_update().order_by("id").values_list("id", "type"))
+            incoming = Q(type=EmailTypes.INCOMING.value)
+            totals = letters.aggregate(
+                unread_incoming=Count("id", filter=incoming & Q(is_read=False)),
+                total_incoming=Count("id", filter=incoming),
+                total_sent=Count("id", filter=Q(type=EmailTypes.OUTGOING.value)),
+            )
+            FolderCounters.objects.add(self.pk, **{name: -total for name, total in totals.items()})
+            LetterChange.objects.record(ChangeKinds.DELETED,
+                                        [(self.pk, letter_id, letter_type) for letter_id, letter_type in rows])
+            deleted, _ = letters.delete()
+        if deleted:
+            invalidate_users([self.pk])
+        return deleted
 
 
 # импорт размещён здесь намеренно.
 # Чтобы работали аннотации и не сооздавался повод для появления циклической зависимости
-from mail_box.models import Message, Letter, EmailTypes
+from mail_box.models import Message, Letter, EmailTypes, FolderCounters, LetterChange, ChangeKinds, \
+    ArchivedLetterDeletion
+from mail_box.delivery import enqueue_delivery
+from mail_box.search import index_message, index_letter_database
+from mail_box.cache import invalidate_users
+from mail_box.notifications import notify_new_mail
+from mail_box.shards import shard_transactions, group_by_shard, shard_for_user
@@ -0,0 +1,486 @@
+"""
+JSON API хранилища писем для внешних компонентов (SMTP/IMAP/POP3).
+
+Аутентификация - по сессии (как у html-страниц) либо по HTTP Basic (email и пароль).
+При сессионной аутентификации изменяющие запросы проверяются на csrf.
+"""
+import base64
+import binascii
+import heapq
+import json
+from functools import wraps
+from itertools import islice
+from typing import Optional
+
+from django.conf import settings
+from django.contrib.auth import authenticate
+from django.core.exceptions import PermissionDenied, ValidationError
+from django.db import connection, transaction
+from django.http import JsonResponse, StreamingHttpResponse, Http404
+from django.middleware.csrf import CsrfViewMiddleware
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_http_methods, require_POST
+
+from accounts.models import MailboxUser
+from mail_box import cache as mailbox_cache
+from mail_box.archive import UserArchive, ArchivedFolder
+from mail_box.changes import get_changes, ResyncRequired
+from mail_box.message_cache import message_cache, get_messages
+from mail_box.models import Letter, FOLDERS, EmailTypes
+from mail_box.pagination import get_cursor
+from mail_box.search import search_letters
+from mail_box.shards import shard_transactions
+
+FOLDER_NAMES = {email_type: name for name, email_type in FOLDERS.items()}
+
+# Сколько писем сериализуется в один кусок потокового ответа
+STREAM_CHUNK_SIZE = 500
+
+
+def _error(message, status, **extra):
+    return JsonResponse({"error": message, **extra}, status=status, json_dumps_params={"ensure_ascii": False})
+
+
+def _basic_auth_user(header: str):
+    try:
+        email, password = base64.b64decode(header[len("Basic "):]).decode().split(":", 1)
+    except (binascii.Error, UnicodeDecodeError, ValueError):
+        return None
+    return authenticate(email=email, password=password)
+
+
+def api_login_required(view):
+    """
+    Аутентифицирует запрос к API.
+    Для неаутентифицированных возвращается 401, а не редирект на страницу входа.
+    """
+
+    @csrf_exempt
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+        if header.startswith("Basic "):
+            user = _basic_auth_user(header)
+            if user is None:
+                return _error("Неверный email или пароль.", 401)
+            request.user = user
+        elif request.user.is_authenticated:
+            # браузерная сессия передаётся в cookie, поэтому csrf проверяется как у обычных форм
+            rejection = CsrfViewMiddleware(lambda _: None).process_view(request, None, (), {})
+            if rejection is not None:
+                return rejection
+        else:
+            return _error("Требуется аутентификация.", 401)
+
+        try:
+            return view(request, *args, **kwargs)
+        except PermissionDenied:
+            return _error("Письмо принадлежит другому пользователю.", 403)
+    return wrapper
+
+
+def _parse_json_body(request) -> dict:
+    try:
+        data = json.loads(request.body.decode() or "{}")
+    except (UnicodeDecodeError, ValueError):
+        raise ValidationError("Тело запроса должно быть в формате JSON.")
+    if not isinstance(data, dict):
+        raise ValidationError("Тело запроса должно быть JSON-объектом.")
+    return data
+
+
+def _get_user_letter(user, letter_id) -> "Letter":
+    """Письмо пользователя из таблицы писем или из архива"""
+    letter = Letter.objects.on_shard_of(user).with_content().filter(id=letter_id).first()
+    if letter is None:
+        letter = UserArchive(user).get_letter(letter_id)
+    if letter is None:
+        raise Http404()
+    if not user.is_ownership_letter(letter):
+        raise PermissionDenied()
+    return letter
+
+
+def letter_to_dict(letter: "Letter") -> dict:
+    message = letter.message
+    return {
+        "id": letter.id,
+        "folder": FOLDER_NAMES[letter.get_type()],
+        "is_read": letter.is_read,
+        "created_at": letter.created_at.isoformat(),
+        "message_id": message.id,
+        "sent_at": message.sent_at.isoformat(),
+        "sender": message.sender.email,
+        "addressees": [user.email for user in message.addressees_set.all()],
+        "header": message.header,
+        "text": message.text,
+    }
+
+
+def _stream_json_list(rows, chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Отдаёт JSON-массив кусками, не собирая весь список в памяти.
+    Строки берутся из итератора курсора БД.
+    """
+    yield "["
+    buffer = []
+    first = True
+    for row in rows:
+        buffer.append(json.dumps(row, ensure_ascii=False))
+        if len(buffer) >= chunk_size:
+            yield ("" if first else ",") + ",".join(buffer)
+            first = False
+            buffer = []
+    if buffer:
+        yield ("" if first else ",") + ",".join(buffer)
+    yield "]"
+
+
+def _folder_row(letter_id: int, folder_name: str, is_read: bool, created_at, message) -> dict:
+    return {
+        "id": letter_id,
+        "folder": folder_name,
+        "is_read": is_read,
+        "created_at": created_at.isoformat(),
+        "message_id": message.id,
+        "header": message.header,
+        "sender": message.sender.email,
+    }
+
+
+def _folder_rows(queryset, folder_name):
+    """
+    Строки списка папки. Из базы писем выбираются только столбцы писем, заголовок и отправитель
+    берутся из сообщений (message_cache.get_messages) пачками по STREAM_CHUNK_SIZE писем:
+    при шардировании сообщения и пользователи хранятся в другой базе.
+    """
+    rows = queryset.values_list("id", "is_read", "created_at", "message_id").iterator(chunk_size=STREAM_CHUNK_SIZE)
+    while True:
+        chunk = list(islice(rows, STREAM_CHUNK_SIZE))
+        if not chunk:
+            break
+        messages = get_messages(message_id for *_, message_id in chunk)
+        for letter_id, is_read, created_at, message_id in chunk:
+            message = messages.get(message_id)
+            if message is not None:
+                yield _folder_row(letter_id, folder_name, is_read, created_at, message)
+
+
+def _archived_rows(folder: "ArchivedFolder", folder_name, before=None, limit=None, since=None, until=None):
+    """
+    Строки архивных писем папки (mail_box.archive) по убыванию id, с тем же курсором before.
+    Записи архива читаются пачками по STREAM_CHUNK_SIZE писем.
+    """
+    # с отбором по времени часть писем отбрасывается, поэтому limit ограничивает выборку id только без него
+    ids = folder.ids(before=before, limit=limit if since is None and until is None else None)
+    for start in range(0, len(ids), STREAM_CHUNK_SIZE):
+        chunk = ids[start:start + STREAM_CHUNK_SIZE]
+        letters = folder.letters(chunk)
+        for letter_id in chunk:
+            letter = letters[letter_id]
+            if (since is None or letter.created_at >= since) and (until is None or letter.created_at < until):
+                yield _folder_row(letter_id, folder_name, letter.is_read, letter.created_at, letter.message)
+
+
+def _get_datetime(request, name: str):
+    """Момент времени из параметра запроса в формате ISO 8601. Без часового пояса считается UTC."""
+    value = request.GET.get(name)
+    if not value:
+        return None
+    moment = parse_datetime(value)
+    if moment is None:
+        raise ValidationError(f"Некорректное время {name}.")
+    return moment if timezone.is_aware(moment) else timezone.make_aware(moment, timezone.utc)
+
+
+@require_GET
+@api_login_required
+def folder_list(request, folder):
+    """
+    Список писем папки вместе с архивными в порядке убывания id.
+    Необязательные параметры: before - курсор (id), limit - максимальное количество писем,
+    since и until - письма, полученные в полуинтервале времени [since, until) (ISO 8601).
+    Без limit отдаётся вся папка потоковым ответом.
+    """
+    if folder not in FOLDERS:
+        return _error("Неизвестная папка.", 404)
+    try:
+        limit = int(request.GET["limit"]) if request.GET.get("limit") else None
+    except ValueError:
+        return _error("Некорректный limit.", 400)
+    if limit is not None and limit <= 0:
+        return _error("Некорректный limit.", 400)
+    try:
+        since, until = _get_datetime(request, "since"), _get_datetime(request, "until")
+    except ValidationError as error:
+        return _error(error.message, 400)
+
+    letters = Letter.objects.for_user(request.user).filter(type=FOLDERS[folder].value) \
+        .created_between(since, until).order_by("-id")
+    before = get_cursor(request, "before")
+    if before is not None:
+        letters = letters.filter(id__lt=before)
+    if limit is not None:
+        letters = letters[:limit]
+
+    # письма таблицы и архива идут по убыванию id, поэтому сливаются без сортировки всего списка
+    archived = _archived_rows(UserArchive(request.user).folder(FOLDERS[folder]), folder, before, limit, since, until)
+    rows = heapq.merge(_folder_rows(letters, folder), archived, key=lambda row: row["id"], reverse=True)
+    if limit is not None:
+        rows = islice(rows, limit)
+    response = StreamingHttpResponse(_stream_json_list(rows), content_type="application/json")
+    return response
+
+
+@require_http_methods(["GET", "DELETE"])
+@api_login_required
+def letter_detail(request, letter_id):
+    """Содержимое письма (GET) или его удаление (DELETE)"""
+    # noinspection PyTypeChecker
+    user: "MailboxUser" = request.user
+    try:
+        letter = _get_user_letter(user, letter_id)
+    except Http404:
+        return _error("Письмо не найдено.", 404)
+
+    if request.method == "DELETE":
+        user.delete_letter(letter)
+        return JsonResponse({"id": letter_id, "deleted": True})
+    return JsonResponse(letter_to_dict(letter), json_dumps_params={"ensure_ascii": False})
+
+
+@require_POST
+@api_login_required
+def letter_read_mark(request, letter_id):
+    """Установка или снятие отметки о прочтении. Тело: {"is_read": true|false}"""
+    # noinspection PyTypeChecker
+    user: "MailboxUser" = request.user
+    try:
+        data = _parse_json_body(request)
+    except ValidationError as e:
+        return _error(e.messages[0], 400)
+    is_read = data.get("is_read", True)
+    if not isinstance(is_read, bool):
+        return _error("is_read должен быть true или false.", 400)
+    try:
+        letter = _get_user_letter(user, letter_id)
+    except Http404:
+        return _error("Письмо не найдено.", 404)
+
+    if letter.archived:
+        return _error("Письмо в архиве, отметку о прочтении у него изменить нельзя.", 409)
+    if is_read:
+        user.read_letter(letter)
+    else:
+        user.unread_letter(letter)
+    return JsonResponse({"id": letter.id, "is_read": letter.is_read})
+
+
+@require_POST
+@api_login_required
+def send_letter(request):
+    """
+    Отправка письма.
+    Тело: {"header": "...", "text": "...", "addressees": ["email", ...]}
+    """
+    # noinspection PyTypeChecker
+    user: "MailboxUser" = request.user
+    try:
+        data = _parse_json_body(request)
+    except ValidationError as e:
+        return _error(e.messages[0], 400)
+
+    emails = data.get("addressees")
+    if not emails or not isinstance(emails, list) or not all(isinstance(email, str) for email in emails):
+        return _error("Нужно указать список адресатов.", 400)
+    users = list(MailboxUser.objects.filter(email__in=set(emails)))
+    unknown = set(emails) - {u.email for u in users}
+    if unknown:
+        return _error("Адресаты не найдены.", 400, addressees=sorted(unknown))
+
+    header, text = data.get("header", ""), data.get("text", "")
+    try:
+        if settings.MAILBOX_QUEUED_DELIVERY:
+            message = user.send_mail_queued(header, text, [u.pk for u in users]).message
+        else:
+            message = user.send_mail(header, text, users)[0].message
+    except ValidationError as e:
+        return _error("Письмо не прошло проверку.", 400, fields=e.message_dict)
+    # при отложенной доставке письмо принято, но ещё не доставлено
+    status = 202 if settings.MAILBOX_QUEUED_DELIVERY else 201
+    return JsonResponse({"message_id": message.id, "recipients": len(users)}, status=status)
+
+
+BULK_ACTIONS = ("read", "unread", "delete")
+
+
+def _bulk_letters(user, data):
+    """
+    Набор писем пользователя (из базы его писем) для пакетной операции: либо список id ("ids"),
+    либо все письма папки с id не больше заданного ("folder" и "up_to_id").
+    """
+    letters = Letter.objects.for_user(user)
+    ids = data.get("ids")
+    if ids is not None:
+        if not isinstance(ids, list) or not all(isinstance(i, int) and not isinstance(i, bool) for i in ids):
+            raise ValidationError("ids должен быть списком целых чисел.")
+        if len(ids) > settings.MAILBOX_BULK_MAX_IDS:
+            raise ValidationError(f"За один запрос можно обработать не больше {settings.MAILBOX_BULK_MAX_IDS} писем.")
+        return letters.filter(id__in=ids), ids
+
+    folder, up_to_id = data.get("folder"), data.get("up_to_id")
+    if folder not in FOLDERS or not isinstance(up_to_id, int) or isinstance(up_to_id, bool):
+        raise ValidationError("Нужно указать ids, либо folder и up_to_id.")
+    return letters.filter(type=FOLDERS[folder].value, id__lte=up_to_id), None
+
+
+@require_POST
+@api_login_required
+def letters_bulk(request):
+    """
+    Пакетная операция над письмами пользователя: одно UPDATE или DELETE на весь набор.
+    Тело: {"action": "read"|"unread"|"delete", "ids": [...]}
+    либо  {"action": ..., "folder": "inbox"|"sent", "up_to_id": N}.
+
+    Для списка id возвращается результат по каждому письму:
+    updated/deleted, unchanged (отметка уже стояла) или not_found (нет такого письма у пользователя).
+    """
+    # noinspection PyTypeChecker
+    user: "MailboxUser" = request.user
+    try:
+        data = _parse_json_body(request)
+        action = data.get("action")
+        if action not in BULK_ACTIONS:
+            raise ValidationError(f"action должен быть одним из: {', '.join(BULK_ACTIONS)}.")
+        letters, ids = _bulk_letters(user, data)
+    except ValidationError as e:
+        return _error(e.messages[0], 400)
+
+    with transaction.atomic(), shard_transactions([user.pk]):
+        # состояние до изменения нужно только для ответа по каждому id
+        before = dict(letters.values_list("id", "is_read")) if ids is not None else None
+        if action == "delete":
+            affected = user.delete_letters(letters)
+        else:
+            affected = user.mark_letters(letters, is_read=action == "read")
+
+    response = {"action": action, "affected": affected}
+    if ids is not None:
+        results = {}
+        for letter_id in ids:
+            if letter_id not in before:
+                results[letter_id] = "not_found"
+            elif action == "delete":
+                results[letter_id] = "deleted"
+            elif before[letter_id] == (action == "read"):
+                results[letter_id] = "unchanged"
+            else:
+                results[letter_id] = "updated"
+        response["results"] = results
+    return JsonResponse(response)
+
+
+def _get_number(request, name: str) -> "Optional[int]":
+    value = request.GET.get(name)
+    if not value:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValidationError(f"Некорректный {name}.")
+    if number < 0:
+        raise ValidationError(f"Некорректный {name}.")
+    return number
+
+
+@require_GET
+@api_login_required
+def changes(request):
+    """
+    Изменения писем пользователя после номера since: ?since=<номер>&limit=<n>&folder=<inbox|sent>.
+    Клиент передаёт в следующем запросе полученный next_seq; пока has_more, изменения есть ещё.
+    Если изменения после since уже удалены сжатием журнала, возвращается 410
+    с текущим номером: клиент заново загружает папку и продолжает с этого номера.
+    """
+    folder = request.GET.get("folder") or None
+    if folder is not None and folder not in FOLDERS:
+        return _error("Неизвестная папка.", 404)
+    try:
+        since = _get_number(request, "since") or 0
+        limit = _get_number(request, "limit")
+    except ValidationError as error:
+        return _error(error.message, 400)
+
+    try:
+        batch = get_changes(request.user, since, limit, email_type=FOLDERS[folder] if folder else None)
+    except ResyncRequired as resync:
+        return _error("Нужна полная синхронизация.", 410, next_seq=resync.last_seq)
+    return JsonResponse({
+        "changes": [{
+            "seq": change.seq,
+            "letter_id": change.letter_id,
+            "folder": FOLDER_NAMES[EmailTypes(change.letter_type)],
+            "change": change.get_kind().name.lower(),
+        } for change in batch],
+        "next_seq": batch.next_seq,
+        "has_more": batch.has_more,
+    })
+
+
+@require_GET
+@api_login_required
+def recipients_autocomplete(request):
+    """
+    Подсказка адресатов по началу email: ?q=<начало адреса>.
+    На PostgreSQL LIKE 'q%' идёт по индексу email с varchar_pattern_ops (миграция accounts 0003).
+    LIKE в sqlite не учитывает регистр и индекс email не использует, поэтому там начало адреса
+    ещё и превращается в диапазон email >= q AND email < q + '\uffff' по уникальному индексу.
+    """
+    prefix = request.GET.get("q", "").strip()
+    if not prefix:
+        return JsonResponse([], safe=False)
+    users = MailboxUser.objects.filter(email__startswith=prefix)
+    if connection.vendor == "sqlite":
+        users = users.filter(email__gte=prefix, email__lt=prefix + "\uffff")
+    users = users.order_by("email") \
+        .values_list("email", "first_name", "last_name")[:settings.MAILBOX_AUTOCOMPLETE_LIMIT]
+    suggestions = [{"email": email, "name": f"{first_name} {last_name}".strip()}
+                   for email, first_name, last_name in users]
+    return JsonResponse(suggestions, safe=False, json_dumps_params={"ensure_ascii": False})
+
+
+@require_GET
+@api_login_required
+def search(request):
+    """
+    Поиск по письмам пользователя: ?q=<слова>&folder=<inbox|sent>&page=<номер страницы>.
+    Письма упорядочены по релевантности.
+    """
+    query = request.GET.get("q", "")
+    folder = request.GET.get("folder") or None
+    if folder is not None and folder not in FOLDERS:
+        return _error("Неизвестная папка.", 404)
+    try:
+        page = int(request.GET.get("page") or 1)
+    except ValueError:
+        return _error("Некорректный номер страницы.", 400)
+    if page < 1:
+        return _error("Некорректный номер страницы.", 400)
+
+    results = search_letters(request.user, query, email_type=FOLDERS[folder] if folder else None, page=page)
+    return JsonResponse({
+        "page": results.page,
+        "has_next": results.has_next,
+        "letters": [letter_to_dict(letter) for letter in results],
+    }, json_dumps_params={"ensure_ascii": False})
+
+
+@require_GET
+@api_login_required
+def cache_stats(request):
+    """Попадания и промахи кэша почтового ящика и кэша сообщений в этом процессе. Только для персонала."""
+    if not request.user.is_staff:
+        return _error("Доступно только персоналу.", 403)
+    return JsonResponse({**mailbox_cache.stats.as_dict(), "messages": message_cache.stats()})
@@ -1,5 +1,14 @@
 from django.apps import AppConfig
+from django.contrib.auth import get_user_model
+from django.db.backends.signals import connection_created
+from django.db.models.signals import pre_delete
 
 
 class MailBoxConfig(AppConfig):
     name = 'mail_box'
+
+    def ready(self):
+        from mail_box.middleware import install_query_wrapper
+        from mail_box.shards import delete_user_letters
+        connection_created.connect(install_query_wrapper, dispatch_uid="mailbox_query_wrapper")
+        pre_delete.connect(delete_user_letters, sender=get_user_model(), dispatch_uid="mailbox_shard_letters")
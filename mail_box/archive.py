@@ -0,0 +1,315 @@
+"""
+Архив старых писем.
+
+Команда archive_letters переносит прочитанные письма из таблицы писем в файлы-сегменты в MAILBOX_ARCHIVE_DIR,
+по сегменту на пакет. Сегмент пишется последовательно один раз и дальше не меняется:
+
+    MAGIC | записи писем | индексы пользователей | каталог | FOOTER
+
+Запись - письмо вместе с содержимым сообщения (JSON, сжатый zlib), поэтому сообщения, на которые остались
+только архивные письма, удаляются из базы командой purge_orphan_messages. Индекс пользователя - его письма
+в сегменте по возрастанию id со смещениями записей, каталог - смещения индексов пользователей.
+Оба сжаты и разбираются только при обращении к ним.
+
+Сегменты открываются через mmap: в память читаются только затронутые страницы файла, а открытые сегменты
+общие для потоков процесса. Какие сегменты есть у пользователя и диапазоны id его писем в них,
+хранит ArchiveSegmentUser: для страницы папки или письма открываются только сегменты, покрывающие нужные id.
+Архивные письма выводятся в папках и открываются на странице письма. Отметки и поиск к ним не применяются,
+а удаление запоминается строкой ArchivedLetterDeletion: удалённые письма отбрасываются при чтении архива.
+"""
+import json
+import mmap
+import os
+import struct
+import threading
+import uuid
+import zlib
+from collections import Counter, OrderedDict
+from typing import Dict, List, Optional
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from mail_box.cache import invalidate_users
+from mail_box.models import Letter, Message, ArchiveSegment, ArchiveSegmentUser, ArchivedLetterDeletion, EmailTypes, \
+    FolderCounters
+
+MAGIC = b"MBXARC01"
+# смещение и длина каталога, MAGIC
+FOOTER = struct.Struct("<QQ8s")
+
+
+class ArchiveError(Exception):
+    """Файл сегмента повреждён или не является сегментом архива"""
+
+
+def _pack(value) -> bytes:
+    return zlib.compress(json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode())
+
+
+def _unpack(data) -> "object":
+    return json.loads(zlib.decompress(data))
+
+
+def _user_record(user) -> list:
+    return [user.pk, user.email, user.first_name, user.last_name]
+
+
+def _letter_record(letter: "Letter") -> dict:
+    message = letter.message
+    return {
+        "id": letter.id,
+        "user_id": letter.user_id,
+        "type": letter.type,
+        "is_read": letter.is_read,
+        "created_at": letter.created_at.isoformat(),
+        "updated_at": letter.updated_at.isoformat(),
+        "message": {
+            "id": message.id,
+            "sender": _user_record(message.sender),
+            "addressees": [_user_record(user) for user in message.addressees_set.all()],
+            "header": message.header,
+            "text": message.text,
+            "sent_at": message.sent_at.isoformat(),
+        },
+    }
+
+
+def _user(record):
+    user_id, email, first_name, last_name = record
+    return get_user_model()(id=user_id, email=email, first_name=first_name, last_name=last_name)
+
+
+def _letter_from_record(record: dict) -> "Letter":
+    """Письмо с содержимым, как после with_content, но без обращений к базе"""
+    content = record["message"]
+    message = Message(id=content["id"], sender=_user(content["sender"]), header=content["header"],
+                      text=content["text"], sent_at=parse_datetime(content["sent_at"]))
+    # адресаты подставляются как результат prefetch_related, поэтому addressees_set.all() не идёт в базу
+    addressees = get_user_model().objects.none()
+    addressees._result_cache = [_user(user) for user in content["addressees"]]
+    addressees._prefetch_done = True
+    message._prefetched_objects_cache = {"addressees_set": addressees}
+    letter = Letter(id=record["id"], user_id=record["user_id"], message=message, type=record["type"],
+                    is_read=record["is_read"], created_at=parse_datetime(record["created_at"]),
+                    updated_at=parse_datetime(record["updated_at"]))
+    letter.archived = True
+    return letter
+
+
+def write_segment(letters: "List[Letter]") -> str:
+    """
+    Записывает письма (с содержимым, with_content) в новый сегмент и возвращает его имя.
+    Файл пишется под временным именем и переименовывается после записи на диск,
+    поэтому под именем сегмента лежит только полностью записанный файл.
+    """
+    directory = settings.MAILBOX_ARCHIVE_DIR
+    os.makedirs(directory, exist_ok=True)
+    name = f"{timezone.now():%Y%m%d-%H%M%S}-{uuid.uuid4().hex[:8]}.seg"
+    path = os.path.join(directory, name)
+    indexes = {}  # id пользователя -> [id письма, тип, смещение записи, длина записи]
+    with open(path + ".tmp", "wb") as file:
+        file.write(MAGIC)
+        for letter in sorted(letters, key=lambda item: item.id):
+            data = _pack(_letter_record(letter))
+            indexes.setdefault(letter.user_id, []).append([letter.id, letter.type, file.tell(), len(data)])
+            file.write(data)
+        directory_entries = {}
+        for user_id, entries in indexes.items():
+            data = _pack(entries)
+            directory_entries[str(user_id)] = [file.tell(), len(data)]
+            file.write(data)
+        data = _pack(directory_entries)
+        directory_offset = file.tell()
+        file.write(data)
+        file.write(FOOTER.pack(directory_offset, len(data), MAGIC))
+        file.flush()
+        os.fsync(file.fileno())
+    os.replace(path + ".tmp", path)
+    return name
+
+
+class Segment:
+    """Сегмент, открытый через mmap. Индексы пользователей разбираются при первом обращении и запоминаются."""
+
+    def __init__(self, path: str):
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        if len(self._map) < len(MAGIC) + FOOTER.size or self._map[:len(MAGIC)] != MAGIC:
+            raise ArchiveError(f"{path} не является сегментом архива.")
+        offset, length, magic = FOOTER.unpack_from(self._map, len(self._map) - FOOTER.size)
+        if magic != MAGIC:
+            raise ArchiveError(f"Сегмент {path} записан не полностью.")
+        directory = _unpack(self._map[offset:offset + length])
+        self._directory = {int(user_id): span for user_id, span in directory.items()}
+        self._indexes = {}
+
+    def user_index(self, user_id: int) -> "List[list]":
+        """Письма пользователя в сегменте по возрастанию id: [id, тип, смещение, длина]"""
+        index = self._indexes.get(user_id)
+        if index is None:
+            span = self._directory.get(user_id)
+            index = self._read(*span) if span else []
+            self._indexes[user_id] = index
+        return index
+
+    def _read(self, offset: int, length: int):
+        return _unpack(self._map[offset:offset + length])
+
+    def letter(self, offset: int, length: int) -> "Letter":
+        return _letter_from_record(self._read(offset, length))
+
+
+_segments = OrderedDict()  # имя -> Segment, давно не использованные закрываются первыми
+_segments_lock = threading.Lock()
+
+
+def open_segment(name: str) -> "Segment":
+    """
+    Открытый сегмент из общих для процесса. Вытесненный сегмент закрывается сборщиком мусора,
+    когда его перестанут читать другие потоки.
+    """
+    with _segments_lock:
+        segment = _segments.get(name)
+        if segment is not None:
+            _segments.move_to_end(name)
+            return segment
+    segment = Segment(os.path.join(settings.MAILBOX_ARCHIVE_DIR, name))
+    with _segments_lock:
+        _segments[name] = segment
+        while len(_segments) > settings.MAILBOX_ARCHIVE_OPEN_SEGMENTS:
+            _segments.popitem(last=False)
+    return segment
+
+
+class UserArchive:
+    """
+    Архивные письма пользователя без удалённых. Диапазоны id его писем в сегментах выбираются одним запросом
+    при первом обращении, а открываются только сегменты, в которых могут быть нужные письма.
+    Записи писем читаются из файлов только для выдаваемых писем.
+    """
+
+    def __init__(self, user):
+        self.user_id = getattr(user, "pk", user)
+        self._ranges = None
+        self._opened = {}  # имя сегмента -> письма пользователя в нём
+        self._entries = {}  # id письма -> запись из открытого сегмента
+
+    def _segment_ranges(self) -> "List[tuple]":
+        """Сегменты с письмами пользователя: (наименьший id, наибольший id, имя сегмента)"""
+        if self._ranges is None:
+            self._ranges = list(ArchiveSegmentUser.objects.filter(user=self.user_id)
+                                .values_list("min_letter_id", "max_letter_id", "segment__name"))
+        return self._ranges
+
+    def _open(self, low: int, high: int, name: str) -> "List[tuple]":
+        """Письма пользователя в сегменте по возрастанию id: (id, тип, сегмент, смещение, длина)"""
+        entries = self._opened.get(name)
+        if entries is None:
+            segment = open_segment(name)
+            deleted = set(ArchivedLetterDeletion.objects.filter(user=self.user_id, letter_id__range=(low, high))
+                          .values_list("letter_id", flat=True))
+            entries = [(letter_id, letter_type, segment, offset, length)
+                       for letter_id, letter_type, offset, length in segment.user_index(self.user_id)
+                       if letter_id not in deleted]
+            self._opened[name] = entries
+            self._entries.update((entry[0], entry) for entry in entries)
+        return entries
+
+    def ids(self, email_type: "EmailTypes", before: "Optional[int]" = None, after: "Optional[int]" = None,
+            limit: int = None) -> "List[int]":
+        """
+        id писем папки: меньше before по убыванию либо больше after по возрастанию, не больше limit.
+        Сегменты открываются, начиная с ближайшего к курсору, пока следующий может дать письма на страницу.
+        """
+        newest_first = after is None
+        if newest_first:
+            ranges = sorted((item for item in self._segment_ranges() if before is None or item[0] < before),
+                            key=lambda item: item[1], reverse=True)
+        else:
+            ranges = sorted((item for item in self._segment_ranges() if item[1] > after), key=lambda item: item[0])
+        found = []
+        for low, high, name in ranges:
+            # письма следующих сегментов не новее high (при after - не старее low), страница уже набрана
+            if limit is not None and len(found) >= limit and (found[limit - 1] > high if newest_first
+                                                               else found[limit - 1] < low):
+                break
+            found.extend(entry[0] for entry in self._open(low, high, name)
+                         if entry[1] == email_type.value
+                         and (entry[0] > after if not newest_first else before is None or entry[0] < before))
+            found.sort(reverse=newest_first)
+        return found[:limit]
+
+    def letters(self, letter_ids) -> "Dict[int, Letter]":
+        """Письма с содержимым по id из уже открытых сегментов (ids, get_letter)"""
+        return {letter_id: _load(self._entries[letter_id]) for letter_id in letter_ids if letter_id in self._entries}
+
+    def folder(self, email_type: "EmailTypes") -> "ArchivedFolder":
+        return ArchivedFolder(self, email_type)
+
+    def get_letter(self, letter_id: int) -> "Optional[Letter]":
+        for low, high, name in self._segment_ranges():
+            if low <= letter_id <= high:
+                self._open(low, high, name)
+        entry = self._entries.get(letter_id)
+        return _load(entry) if entry is not None else None
+
+
+def _load(entry) -> "Letter":
+    _, _, segment, offset, length = entry
+    return segment.letter(offset, length)
+
+
+class ArchivedFolder:
+    """Архивные письма папки для постраничного вывода (pagination.paginate_letters)"""
+
+    def __init__(self, archive: "UserArchive", email_type: "EmailTypes"):
+        self.archive = archive
+        self.email_type = email_type
+
+    def ids(self, before: "Optional[int]" = None, after: "Optional[int]" = None, limit: int = None) -> "List[int]":
+        """
+        id писем папки: меньше before по убыванию либо больше after по возрастанию, не больше limit.
+        Записи писем при этом не читаются.
+        """
+        return self.archive.ids(self.email_type, before=before, after=after, limit=limit)
+
+    def letters(self, letter_ids) -> "Dict[int, Letter]":
+        """Письма с содержимым по id"""
+        return self.archive.letters(letter_ids)
+
+
+def archive_letters(alias: "Optional[str]", letter_ids: "List[int]") -> int:
+    """
+    Переносит в новый сегмент прочитанные письма из letter_ids (из базы писем alias, mail_box.shards).
+    Сегмент записывается до фиксации транзакции, в которой письма удаляются из таблицы:
+    если она не зафиксируется, файл останется без строки ArchiveSegment и читаться не будет.
+    Возвращает число перенесённых писем.
+    """
+    with transaction.atomic(), transaction.atomic(using=alias):
+        # непрочитанные письма остаются в таблице: они нужны счётчику непрочитанных
+        letters = list(Letter.objects.using(alias).select_for_update().filter(id__in=letter_ids, is_read=True)
+                       .order_by("id").with_content())
+        if not letters:
+            return 0
+        segment = ArchiveSegment.objects.create(name=write_segment(letters), letters=len(letters))
+        # письма идут по возрастанию id, поэтому первое и последнее письмо пользователя - границы его диапазона
+        user_letters = {}
+        for letter in letters:
+            user_letters.setdefault(letter.user_id, []).append(letter.id)
+        user_ids = sorted(user_letters)
+        ArchiveSegmentUser.objects.bulk_create([
+            ArchiveSegmentUser(segment=segment, user_id=user_id, min_letter_id=user_letters[user_id][0],
+                               max_letter_id=user_letters[user_id][-1], letters=len(user_letters[user_id]))
+            for user_id in user_ids])
+        # счётчики папок считают письма таблицы, архивные из них вычитаются до удаления
+        folders = Counter((letter.user_id, letter.get_type()) for letter in letters)
+        for user_id in user_ids:
+            FolderCounters.objects.add(user_id, total_incoming=-folders[(user_id, EmailTypes.INCOMING)],
+                                       total_sent=-folders[(user_id, EmailTypes.OUTGOING)])
+        Letter.objects.using(alias).filter(id__in=[letter.id for letter in letters]).delete()
+        invalidate_users(user_ids)
+    return len(letters)
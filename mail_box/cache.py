@@ -0,0 +1,102 @@
+"""
+Кэш почтового ящика пользователя: отрисованные первые страницы папок, число непрочитанных и письма.
+
+Ключи данных пользователя содержат его версию. Отправка, прочтение и удаление писем
+меняют версию затронутых пользователей, после чего их старые ключи больше не запрашиваются
+и вытесняются из кэша как давно не использованные (LRU).
+Кэш берётся из CACHES по алиасу MAILBOX_CACHE_ALIAS.
+"""
+import threading
+import uuid
+from collections import Counter
+from typing import Callable, Iterable
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import connection, transaction
+
+from mail_box.replicas import reads_from_replica
+
+
+class CacheStats:
+    """Счётчики попаданий и промахов по видам данных. Считаются в пределах процесса."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counts = Counter()
+
+    def record(self, kind: str, hit: bool):
+        with self._lock:
+            self._counts[(kind, "hits" if hit else "misses")] += 1
+
+    def as_dict(self) -> dict:
+        with self._lock:
+            counts = dict(self._counts)
+        kinds = sorted({kind for kind, _ in counts})
+        return {kind: {"hits": counts.get((kind, "hits"), 0), "misses": counts.get((kind, "misses"), 0)}
+                for kind in kinds}
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+
+stats = CacheStats()
+
+
+def get_cache():
+    return caches[settings.MAILBOX_CACHE_ALIAS]
+
+
+def _version_key(user_id: int) -> str:
+    return f"mailbox:version:{user_id}"
+
+
+def _new_version() -> str:
+    # не номер, а случайная метка: если ключ версии вытеснен, новая версия не совпадёт ни с одной из старых
+    return uuid.uuid4().hex[:16]
+
+
+def get_version(user_id: int) -> str:
+    cache = get_cache()
+    version = cache.get(_version_key(user_id))
+    if version is None:
+        cache.add(_version_key(user_id), _new_version(), timeout=None)
+        version = cache.get(_version_key(user_id))
+    return version
+
+
+def _bump(user_ids: "Iterable[int]"):
+    version = _new_version()
+    get_cache().set_many({_version_key(user_id): version for user_id in user_ids}, timeout=None)
+
+
+def invalidate_users(user_ids: "Iterable[int]"):
+    """
+    Сбрасывает кэш пользователей сменой их версии.
+    Внутри транзакции версия меняется ещё раз после фиксации: до неё другие запросы
+    видят старые данные и могли положить их в кэш под новой версией.
+    """
+    user_ids = list(user_ids)
+    if not user_ids:
+        return
+    _bump(user_ids)
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: _bump(user_ids))
+
+
+def get_or_set(user_id: int, kind: str, name: str, compute: "Callable"):
+    """Данные пользователя из кэша или вычисленные compute и положенные в кэш"""
+    cache = get_cache()
+    key = f"mailbox:{user_id}:{get_version(user_id)}:{kind}:{name}"
+    value = cache.get(key)
+    stats.record(kind, value is not None)
+    if value is None:
+        value = compute()
+        if value is not None:
+            timeout = settings.MAILBOX_CACHE_TIMEOUT
+            if reads_from_replica():
+                # реплика могла ещё не получить записи, сменившие версию: её данные живут в кэше недолго
+                timeout = min(timeout, settings.MAILBOX_REPLICA_PIN_SECONDS)
+            cache.set(key, value, timeout)
+    return value
@@ -0,0 +1,86 @@
+"""
+Инкрементальная синхронизация по журналу изменений писем (LetterChange).
+
+Отправка, прочтение и удаление писем записывают изменения с номерами, возрастающими
+для каждого пользователя. Клиент запоминает номер последнего полученного изменения
+и запрашивает только более новые, пакетами ограниченного размера.
+Старые изменения удаляются сжатием; клиенту, отставшему дальше сжатой части журнала,
+нужна полная синхронизация папки.
+"""
+from datetime import datetime
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Max, Q, Case, When, Value
+
+from mail_box.models import ChangeSequence, LetterChange, EmailTypes
+
+
+class ResyncRequired(Exception):
+    """Изменения после номера клиента уже удалены сжатием (или номер клиента из будущего)"""
+
+    def __init__(self, last_seq: int):
+        super().__init__(last_seq)
+        self.last_seq = last_seq
+
+
+class ChangesBatch:
+    """
+    Пакет изменений.
+    next_seq - номер, который клиент передаёт в следующем запросе,
+    has_more - есть ли ещё изменения сверх размера пакета.
+    """
+
+    def __init__(self, changes: "List[LetterChange]", next_seq: int, has_more: bool):
+        self.changes = changes
+        self.next_seq = next_seq
+        self.has_more = has_more
+
+    def __iter__(self):
+        return iter(self.changes)
+
+    def __len__(self):
+        return len(self.changes)
+
+
+def get_changes(user, since: int, limit: "Optional[int]" = None,
+                email_type: "Optional[EmailTypes]" = None) -> "ChangesBatch":
+    """
+    Изменения писем пользователя с номером больше since, не больше limit штук.
+    Сначала читается текущий номер пользователя, и выдаются только изменения не новее его:
+    номера пользователя фиксируются по порядку, поэтому все они уже видны и ни одно не будет пропущено.
+    """
+    limit = min(limit or settings.MAILBOX_SYNC_BATCH_SIZE, settings.MAILBOX_SYNC_BATCH_SIZE)
+    sequence = ChangeSequence.objects.filter(user_id=user.pk).values_list("last_seq", "compacted_seq").first()
+    last_seq, compacted_seq = sequence or (0, 0)
+    if since < compacted_seq or since > last_seq:
+        raise ResyncRequired(last_seq)
+
+    changes = LetterChange.objects.filter(user_id=user.pk, seq__gt=since, seq__lte=last_seq)
+    if email_type is not None:
+        changes = changes.filter(letter_type=email_type.value)
+    changes = list(changes.order_by("seq")[:limit + 1])
+    has_more = len(changes) > limit
+    changes = changes[:limit]
+    return ChangesBatch(changes, changes[-1].seq if has_more else last_seq, has_more)
+
+
+def compact_changes(before: "datetime", user_ids: "List[int]") -> int:
+    """
+    Удаляет изменения пользователей, записанные раньше before, и запоминает сжатую часть журнала.
+    Изменения удаляются по номер включительно, чтобы в журнале не оставалось пропусков.
+    Возвращает количество удалённых изменений.
+    """
+    with transaction.atomic():
+        compacted = dict(LetterChange.objects.filter(user_id__in=user_ids, created_at__lt=before)
+                         .values("user_id").annotate(seq=Max("seq")).order_by().values_list("user_id", "seq"))
+        if not compacted:
+            return 0
+        ChangeSequence.objects.filter(user_id__in=compacted).update(compacted_seq=Case(
+            *[When(user_id=user_id, then=Value(seq)) for user_id, seq in compacted.items()]))
+        condition = Q()
+        for user_id, seq in compacted.items():
+            condition |= Q(user_id=user_id, seq__lte=seq)
+        deleted, _ = LetterChange.objects.filter(condition).delete()
+    return deleted
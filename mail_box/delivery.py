@@ -0,0 +1,140 @@
+"""
+Очередь отложенной доставки писем.
+
+Задания (DeliveryJob) хранятся в базе. Исполнитель захватывает задание условным UPDATE
+по статусу, поэтому несколько потоков или процессов не выполнят одно задание дважды
+и никаких блокировок, кроме обычных блокировок строк, не требуется.
+"""
+import logging
+import threading
+import time
+from contextlib import nullcontext
+from datetime import timedelta
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import transaction, connection
+from django.db.models import F
+from django.utils import timezone
+
+from mail_box.models import DeliveryJob, DeliveryStatus, Message
+from mail_box.shards import shard_transactions
+
+logger = logging.getLogger(__name__)
+
+# sqlite допускает только одного писателя, а транзакция, начатая чтением, при попытке записи
+# сразу получает "database is locked". Поэтому потоки одного процесса пишут в sqlite по очереди.
+_sqlite_write_lock = threading.Lock()
+
+
+def _write_lock():
+    return _sqlite_write_lock if connection.vendor == "sqlite" else nullcontext()
+
+
+def enqueue_delivery(message: "Message", recipient_ids: "List[int]", batch_size: "Optional[int]" = None):
+    """Ставит доставку сообщения в очередь: одно задание на каждый пакет адресатов"""
+    batch_size = batch_size or settings.MAILBOX_FANOUT_BATCH_SIZE
+    DeliveryJob.objects.bulk_create([
+        DeliveryJob(message=message, recipient_ids=",".join(map(str, recipient_ids[start:start + batch_size])))
+        for start in range(0, len(recipient_ids), batch_size)
+    ])
+
+
+def release_stale_jobs(timeout: float) -> int:
+    """Возвращает в очередь задания, исполнитель которых пропал (например, процесс был убит)"""
+    stale = timezone.now() - timedelta(seconds=timeout)
+    return DeliveryJob.objects.filter(status=DeliveryStatus.RUNNING.value, locked_at__lt=stale) \
+        .update(status=DeliveryStatus.PENDING.value, locked_at=None)
+
+
+def claim_job() -> "Optional[DeliveryJob]":
+    """
+    Захватывает следующее готовое к выполнению задание.
+    Задание считается захваченным, только если условный UPDATE изменил строку.
+    """
+    now = timezone.now()
+    candidates = DeliveryJob.objects.filter(status=DeliveryStatus.PENDING.value, run_after__lte=now) \
+        .order_by("run_after", "id").values_list("id", flat=True)[:10]
+    for job_id in candidates:
+        with _write_lock():
+            claimed = DeliveryJob.objects.filter(id=job_id, status=DeliveryStatus.PENDING.value).update(
+                status=DeliveryStatus.RUNNING.value, attempts=F("attempts") + 1, locked_at=now)
+        if claimed:
+            return DeliveryJob.objects.select_related("message").get(id=job_id)
+    return None
+
+
+def process_job(job: "DeliveryJob", max_attempts: int, retry_delay: float) -> bool:
+    """
+    Выполняет задание. Доставка и отметка о выполнении - в одной транзакции,
+    поэтому при ошибке не остаётся частично доставленных пакетов.
+    При ошибке задание возвращается в очередь с задержкой, растущей с числом попыток,
+    пока попытки не кончатся.
+    """
+    from accounts.models import MailboxUser
+
+    recipient_ids = job.get_recipient_ids()
+    try:
+        with _write_lock(), transaction.atomic(), shard_transactions(recipient_ids):
+            for _ in MailboxUser._deliver(job.message, recipient_ids, add_addressees=False):
+                pass
+            DeliveryJob.objects.filter(id=job.id).update(status=DeliveryStatus.DONE.value, locked_at=None)
+        return True
+    except Exception as e:
+        logger.exception("Ошибка доставки задания %s (попытка %s)", job.id, job.attempts)
+        if job.attempts >= max_attempts:
+            status, run_after = DeliveryStatus.FAILED.value, job.run_after
+        else:
+            status, run_after = DeliveryStatus.PENDING.value, timezone.now() + timedelta(
+                seconds=retry_delay * job.attempts)
+        with _write_lock():
+            DeliveryJob.objects.filter(id=job.id).update(status=status, run_after=run_after, locked_at=None,
+                                                         last_error=repr(e))
+        return False
+
+
+def run_worker(concurrency: int = 1, max_attempts: int = 5, retry_delay: float = 10.0, poll_interval: float = 1.0,
+               once: bool = False, stop_event: "Optional[threading.Event]" = None) -> "dict":
+    """
+    Выполняет задания очереди в concurrency потоках.
+    При once=True останавливается, когда готовых заданий не осталось,
+    иначе ждёт новые задания, опрашивая очередь раз в poll_interval секунд.
+    Возвращает количество выполненных и неудачных заданий.
+    """
+    stop_event = stop_event or threading.Event()
+    stats = {"done": 0, "failed": 0}
+    lock = threading.Lock()
+
+    def work():
+        while not stop_event.is_set():
+            job = claim_job()
+            if job is None:
+                if once:
+                    break
+                time.sleep(poll_interval)
+                continue
+            succeeded = process_job(job, max_attempts, retry_delay)
+            with lock:
+                stats["done" if succeeded else "failed"] += 1
+
+    def thread_main():
+        try:
+            work()
+        finally:
+            connection.close()  # у каждого потока своё соединение с базой
+
+    if concurrency == 1:
+        work()
+        return stats
+    threads = [threading.Thread(target=thread_main, name=f"deliver-mail-{i}") for i in range(concurrency)]
+    for thread in threads:
+        thread.start()
+    try:
+        for thread in threads:
+            thread.join()
+    except KeyboardInterrupt:
+        # потоки дорабатывают текущие задания и завершаются
+        stop_event.set()
+        for thread in threads:
+            thread.join()
+    return stats
@@ -0,0 +1,155 @@
+"""
+Уведомления о новых письмах: ASGI-приложение, держащее соединения открытыми на asyncio.
+
+GET EVENTS_PATH с заголовком "Accept: text/event-stream" - поток server-sent events:
+событие "mail" с номером изменения (id) при каждой доставке письма и пустые комментарии,
+поддерживающие соединение. Без этого заголовка - long-poll: ответ с первыми уведомлениями
+или 204 по истечении MAILBOX_EVENTS_LONGPOLL_TIMEOUT.
+
+Запросы к базе делаются только при подключении (аутентификация и, если клиент передал
+Last-Event-ID или since, номер последней пропущенной доставки); ожидающее соединение базу не использует.
+Получив уведомление, клиент запрашивает изменения через api/changes/.
+"""
+import asyncio
+import io
+import json
+from importlib import import_module
+from typing import Optional
+from urllib.parse import parse_qs
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import auth
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+
+from mail_box.api import _basic_auth_user
+from mail_box.models import LetterChange, ChangeKinds, EmailTypes
+from mail_box.notifications import hub, Subscription
+
+EVENTS_PATH = "/mailbox/events/"
+
+
+def _authenticate(scope) -> "Optional[int]":
+    """id пользователя по HTTP Basic или по сессии в cookie"""
+    try:
+        request = ASGIRequest(scope, io.BytesIO())
+        header = request.META.get("HTTP_AUTHORIZATION", "")
+        if header.startswith("Basic "):
+            user = _basic_auth_user(header)
+            return user.pk if user is not None else None
+        engine = import_module(settings.SESSION_ENGINE)
+        request.session = engine.SessionStore(request.COOKIES.get(settings.SESSION_COOKIE_NAME))
+        user = auth.get_user(request)
+        return user.pk if user.is_authenticated else None
+    finally:
+        close_old_connections()
+
+
+def _missed_mail_seq(user_id: int, since: int) -> "Optional[int]":
+    """
+    Номер последней доставки письма во входящие после since; None, если новых писем не было.
+    Прочтения, удаления и отправленные письма событием "mail" не считаются.
+    """
+    try:
+        return LetterChange.objects.filter(user_id=user_id, seq__gt=since, kind=ChangeKinds.CREATED.value,
+                                           letter_type=EmailTypes.INCOMING.value) \
+            .order_by("-seq").values_list("seq", flat=True).first()
+    finally:
+        close_old_connections()
+
+
+def _get_since(scope) -> "Optional[int]":
+    """Номер последнего известного клиенту изменения: заголовок Last-Event-ID или параметр since"""
+    headers = dict(scope.get("headers", ()))
+    value = headers.get(b"last-event-id", b"").decode("latin-1")
+    if not value:
+        value = parse_qs(scope.get("query_string", b"").decode("latin-1")).get("since", [""])[0]
+    try:
+        return int(value) if value else None
+    except ValueError:
+        return None
+
+
+async def _respond(send, status: int, body: bytes = b"", content_type: bytes = b"application/json"):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), (b"cache-control", b"no-cache")]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def _wait_disconnect(receive):
+    while True:
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+
+
+async def _next_event(subscription: "Subscription", disconnected: "asyncio.Future", timeout: float) -> "Optional[dict]":
+    """Следующее уведомление; None, если за timeout его не было или клиент отключился"""
+    get = asyncio.ensure_future(subscription.queue.get())
+    done, _ = await asyncio.wait({get, disconnected}, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+    if get in done:
+        return get.result()
+    get.cancel()
+    return None
+
+
+def _format_event(event: dict) -> bytes:
+    return f"id: {event['seq']}\nevent: {event['event']}\ndata: {json.dumps(event)}\n\n".encode()
+
+
+async def _stream(subscription: "Subscription", disconnected: "asyncio.Future", send):
+    await send({"type": "http.response.start", "status": 200, "headers": [
+        (b"content-type", b"text/event-stream"),
+        (b"cache-control", b"no-cache"),
+        (b"x-accel-buffering", b"no"),  # чтобы nginx не буферизовал поток
+    ]})
+    await send({"type": "http.response.body", "body": b": connected\n\n", "more_body": True})
+    while not disconnected.done():
+        event = await _next_event(subscription, disconnected, settings.MAILBOX_EVENTS_HEARTBEAT)
+        if disconnected.done():
+            break
+        body = _format_event(event) if event is not None else b": ping\n\n"
+        await send({"type": "http.response.body", "body": body, "more_body": True})
+
+
+async def _long_poll(subscription: "Subscription", disconnected: "asyncio.Future", send):
+    event = await _next_event(subscription, disconnected, settings.MAILBOX_EVENTS_LONGPOLL_TIMEOUT)
+    if disconnected.done():
+        return
+    if event is None:
+        await _respond(send, 204)
+        return
+    events = [event]
+    while not subscription.queue.empty():
+        events.append(subscription.queue.get_nowait())
+    await _respond(send, 200, json.dumps({"events": events}).encode())
+
+
+async def events_app(scope, receive, send):
+    if scope["method"] != "GET":
+        await _respond(send, 405, json.dumps({"error": "Метод не поддерживается."}).encode())
+        return
+    user_id = await sync_to_async(_authenticate)(scope)
+    if user_id is None:
+        await _respond(send, 401, json.dumps({"error": "Требуется аутентификация."}).encode())
+        return
+
+    # подписка оформляется до чтения текущего номера, поэтому доставка между ними не потеряется
+    subscription = hub.subscribe(user_id)
+    disconnected = asyncio.ensure_future(_wait_disconnect(receive))
+    try:
+        since = _get_since(scope)
+        if since is not None:
+            missed = await sync_to_async(_missed_mail_seq)(user_id, since)
+            if missed is not None:
+                subscription.put({"event": "mail", "seq": missed})
+
+        headers = dict(scope.get("headers", ()))
+        if b"text/event-stream" in headers.get(b"accept", b""):
+            await _stream(subscription, disconnected, send)
+        else:
+            await _long_poll(subscription, disconnected, send)
+    finally:
+        disconnected.cancel()
+        hub.unsubscribe(subscription)
@@ -1,16 +1,68 @@
+import re
+
 from django import forms
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.urls import reverse_lazy
 
 from accounts.models import MailboxUser
 
 
+class RecipientsField(forms.CharField):
+    """
+    Адресаты, перечисленные через запятую по email.
+    Все адресаты проверяются одним запросом с IN, таблица пользователей не перебирается.
+    Очищенное значение - список id пользователей в порядке перечисления.
+    """
+
+    separators = re.compile(r"[\s,;]+")
+
+    def to_python(self, value):
+        value = super().to_python(value)
+        return list(dict.fromkeys(email for email in self.separators.split(value) if email))
+
+    def validate(self, value):
+        super().validate(value)
+        if len(value) > settings.MAILBOX_FORM_MAX_RECIPIENTS:
+            raise ValidationError(f"Можно указать не больше {settings.MAILBOX_FORM_MAX_RECIPIENTS} адресатов.",
+                                  code="too_many")
+        for email in value:
+            validate_email(email)
+
+    def clean(self, value):
+        emails = super().clean(value)
+        found = dict(MailboxUser.objects.filter(email__in=emails).values_list("email", "id"))
+        unknown = [email for email in emails if email not in found]
+        if unknown:
+            raise ValidationError("Нет таких адресатов: %(emails)s", code="unknown",
+                                  params={"emails": ", ".join(unknown)})
+        return [found[email] for email in emails]
+
+
 class EmailForm(forms.Form):
     """
     Форма письма. Используется для отправки(создания писем)
-    Чтобы пользователю было удобнее отправлять (нам же не нужна реалистичность?),
-    сделал выбор из существующих в бд пользователей,
-    как будто они у него находятся в контактах.
+    Адресаты вводятся по email через запятую, с подсказками по началу адреса,
+    чтобы не выводить в форму всех пользователей системы.
     """
 
-    addressee = forms.ModelMultipleChoiceField(queryset=MailboxUser.objects.all(), label="Адресаты")
+    addressee = RecipientsField(
+        label="Адресаты",
+        widget=forms.TextInput(attrs={
+            "list": "addressee-suggestions",
+            "autocomplete": "off",
+            "data-autocomplete-url": reverse_lazy("recipients_autocomplete"),
+        }),
+    )
     header = forms.CharField(max_length=70, label="Заголовок")
     text = forms.CharField(max_length=900, widget=forms.Textarea, label="Текст")
+
+
+class SearchForm(forms.Form):
+    """Форма поиска по письмам"""
+
+    q = forms.CharField(max_length=200, label="Искать")
+    folder = forms.ChoiceField(choices=[("", "Все папки"), ("inbox", "Входящие"), ("sent", "Исходящие")],
+                               required=False, label="Папка")
+    page = forms.IntegerField(min_value=1, required=False, widget=forms.HiddenInput)
@@ -0,0 +1,77 @@
+"""
+Общие помощники команд-бенчмарков.
+Модуль начинается с подчёркивания, поэтому django не считает его командой.
+"""
+import math
+import random
+import time
+from contextlib import contextmanager, ExitStack
+from typing import List
+
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+from accounts.models import MailboxUser
+from mail_box.shards import letter_shards
+
+
+SYLLABLES = ["ка", "ло", "ми", "ра", "сто", "не", "до", "ве", "ры", "па", "ти", "зо", "гу", "ба", "ше", "ль"]
+
+
+class Rollback(Exception):
+    """Прерывает транзакцию бенчмарка, чтобы созданные данные не остались в базе"""
+
+
+@contextmanager
+def rolled_back():
+    """Всё, что создано внутри блока, откатывается при выходе из него."""
+    try:
+        with ExitStack() as stack:
+            # письма могут храниться в базах шардов (mail_box.shards), их изменения тоже откатываются
+            for alias in [DEFAULT_DB_ALIAS, *letter_shards()]:
+                stack.enter_context(transaction.atomic(using=alias))
+            yield
+            raise Rollback()
+    except Rollback:
+        pass
+
+
+@contextmanager
+def timer():
+    """Замер времени блока: elapsed()[0] после выхода содержит секунды"""
+    elapsed = [0.0]
+    started = time.perf_counter()
+    try:
+        yield elapsed
+    finally:
+        elapsed[0] = time.perf_counter() - started
+
+
+def percentile(values: "List[float]", percent: float) -> float:
+    """Перцентиль методом ближайшего ранга"""
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    rank = max(math.ceil(percent / 100 * len(ordered)) - 1, 0)
+    return ordered[rank]
+
+
+def make_vocabulary(size: int, rnd: "random.Random"):
+    words = set()
+    while len(words) < size:
+        words.add("".join(rnd.choice(SYLLABLES) for _ in range(rnd.randint(2, 4))))
+    return sorted(words)
+
+
+def create_benchmark_users(total: int, prefix: str = "bench", batch_size: int = 1000) -> "List[int]":
+    """
+    Быстро создаёт пользователей для бенчмарка и возвращает их id.
+    Пароль не хешируется: такие пользователи не могут войти в систему.
+    """
+    for start in range(0, total, batch_size):
+        MailboxUser.objects.bulk_create(
+            [MailboxUser(email=f"{prefix}{i}@bench.local", password="!", first_name=prefix, last_name=str(i))
+             for i in range(start, min(start + batch_size, total))]
+        )
+    # sqlite не возвращает id после bulk_create
+    return list(MailboxUser.objects.filter(email__endswith="@bench.local", first_name=prefix)
+                .order_by("id").values_list("id", flat=True))
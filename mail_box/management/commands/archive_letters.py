@@ -0,0 +1,76 @@
+import time
+from datetime import timedelta
+from typing import Iterator, List, Optional
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db.models import Count
+from django.utils import timezone
+
+from mail_box.archive import archive_letters
+from mail_box.models import Letter
+from mail_box.shards import letter_databases
+
+
+class Command(BaseCommand):
+    help = (
+        "Переносит прочитанные письма старше заданного количества дней или сверх заданного числа последних писем "
+        "папки в файлы архива (mail_box.archive). Работает пакетами, каждый пакет - отдельный сегмент архива "
+        "и своя короткая транзакция. Непрочитанные письма не переносятся."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.MAILBOX_ARCHIVE_AFTER_DAYS,
+                            help="Письма старше этого количества дней переносятся в архив.")
+        parser.add_argument("--keep", type=int, default=settings.MAILBOX_ARCHIVE_FOLDER_LIMIT,
+                            help="Сколько последних писем папки остаётся в таблице, остальные переносятся в архив.")
+        parser.add_argument("--batch-size", type=int, default=5000,
+                            help="Сколько писем записывается в один сегмент архива.")
+        parser.add_argument("--sleep", type=float, default=0,
+                            help="Пауза между пакетами в секундах, чтобы не мешать рабочей нагрузке.")
+
+    def handle(self, *args, days, keep, batch_size, sleep, **options):
+        if batch_size <= 0 or (days is not None and days < 0) or (keep is not None and keep < 0):
+            raise CommandError("Параметры не могут быть отрицательными, размер пакета должен быть положительным.")
+        before = timezone.now() - timedelta(days=days) if days is not None else None
+        archived = 0
+        for alias in letter_databases():
+            batch = []
+            for letter_id in self._candidates(alias, before, keep, batch_size):
+                batch.append(letter_id)
+                if len(batch) >= batch_size:
+                    archived += archive_letters(alias, batch)
+                    batch = []
+                    if sleep:
+                        time.sleep(sleep)
+            if batch:
+                archived += archive_letters(alias, batch)
+        self.stdout.write(self.style.SUCCESS(f"Перенесено в архив писем: {archived}."))
+
+    @staticmethod
+    def _walk(letters, batch_size: int) -> "Iterator[int]":
+        """id писем по возрастанию: каждый пакет - ограниченный проход по первичному ключу, а не весь список сразу"""
+        last_id = 0
+        while True:
+            letter_ids: "List[int]" = list(letters.filter(id__gt=last_id).order_by("id")
+                                           .values_list("id", flat=True)[:batch_size])
+            if not letter_ids:
+                break
+            last_id = letter_ids[-1]
+            yield from letter_ids
+
+    @classmethod
+    def _candidates(cls, alias: "Optional[str]", before, keep: "Optional[int]", batch_size: int) -> "Iterator[int]":
+        """id прочитанных писем для архива: сначала по возрасту, затем сверх ограничения папок"""
+        letters = Letter.objects.using(alias).filter(is_read=True)
+        if before is not None:
+            yield from cls._walk(letters.filter(created_at__lt=before), batch_size)
+        if keep is not None:
+            folders = list(Letter.objects.using(alias).values("user_id", "type").annotate(total=Count("id"))
+                           .filter(total__gt=keep).order_by().values_list("user_id", "type"))
+            for user_id, letter_type in folders:
+                folder = Letter.objects.using(alias).filter(user_id=user_id, type=letter_type)
+                # id самого нового письма, которое уже не помещается в папку
+                oldest_kept = list(folder.order_by("-id").values_list("id", flat=True)[keep:keep + 1])
+                if oldest_kept:
+                    yield from cls._walk(folder.filter(id__lte=oldest_kept[0], is_read=True), batch_size)
@@ -0,0 +1,190 @@
+import asyncio
+import socket
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+
+from django.conf import settings
+from django.contrib.auth import SESSION_KEY, BACKEND_SESSION_KEY, HASH_SESSION_KEY
+from django.contrib.sessions.backends.db import SessionStore
+from django.core.management.base import BaseCommand, CommandError
+from django.urls import reverse
+
+from accounts.models import MailboxUser
+from mail_box.management.commands._benchmark import percentile
+from mail_box.models import Letter, EmailTypes
+
+SERVERS = ("wsgi", "asgi")
+PAGES = ("main", "inbox", "sent", "letter")
+
+
+class Command(BaseCommand):
+    help = (
+        "Замер страниц чтения (главная, входящие, исходящие, письмо) под WSGI и под ASGI: "
+        "оба приложения запускаются локальным сервером uvicorn с одинаковым числом потоков, "
+        "клиент держит заданное число одновременных соединений. Нужны uvicorn и применённые миграции."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=1000, help="Одновременных соединений.")
+        parser.add_argument("--requests", type=int, default=10000, help="Запросов к каждому серверу.")
+        parser.add_argument("--threads", type=int, default=10,
+                            help="Потоков сервера: пул WSGI и пул асинхронных страниц ASGI.")
+        parser.add_argument("--email", default="admin@mail.ru", help="Пользователь, от имени которого идут запросы.")
+        parser.add_argument("--pages", nargs="+", choices=PAGES, default=list(PAGES))
+        parser.add_argument("--servers", nargs="+", choices=SERVERS, default=list(SERVERS))
+        parser.add_argument("--port", type=int, default=8765)
+        # запуск сервера замера в дочернем процессе
+        parser.add_argument("--serve", choices=SERVERS, help="Только запустить сервер (используется самим замером).")
+
+    def handle(self, *args, concurrency, requests, threads, email, pages, servers, port, serve, **options):
+        try:
+            import uvicorn  # noqa: F401
+        except ImportError:
+            raise CommandError("Для замера нужен uvicorn: pip install uvicorn.")
+        if serve:
+            self._serve(serve, port, threads, concurrency)
+            return
+        if min(concurrency, requests, threads) <= 0:
+            raise CommandError("Параметры должны быть положительными.")
+        user = MailboxUser.objects.filter(email=email).first()
+        if user is None:
+            raise CommandError(f"Пользователь {email} не найден.")
+
+        paths = self._paths(user, pages)
+        session = self._create_session(user)
+        try:
+            self.stdout.write(f"Соединений: {concurrency}, запросов: {requests}, потоков: {threads}, "
+                              f"страницы: {', '.join(pages)}")
+            self.stdout.write(f"{'сервер':>6} {'запросов/с':>11} {'p50, мс':>9} {'p99, мс':>9} {'ошибок':>7}")
+            for server in servers:
+                latencies, errors, seconds = self._bench_server(server, port, threads, concurrency, requests,
+                                                                paths, session.session_key)
+                self.stdout.write(f"{server:>6} {len(latencies) / seconds:>11.0f} "
+                                  f"{percentile(latencies, 50) * 1000:>9.1f} {percentile(latencies, 99) * 1000:>9.1f} "
+                                  f"{errors:>7}")
+        finally:
+            session.delete()
+
+    @staticmethod
+    def _paths(user, pages) -> "List[str]":
+        paths = {"main": reverse("main_page"), "inbox": reverse("inbox_page"), "sent": reverse("sent_page")}
+        if "letter" in pages:
+            letter = Letter.objects.filter(user=user, type=EmailTypes.INCOMING.value).order_by("-id").first()
+            if letter is None:
+                raise CommandError("У пользователя нет входящих писем для страницы письма.")
+            paths["letter"] = reverse("letter_page", kwargs={"letter_id": letter.id})
+        return [paths[page] for page in pages]
+
+    @staticmethod
+    def _create_session(user) -> "SessionStore":
+        """Сессия вошедшего пользователя без проверки пароля, как после входа"""
+        session = SessionStore()
+        session[SESSION_KEY] = str(user.pk)
+        session[BACKEND_SESSION_KEY] = settings.AUTHENTICATION_BACKENDS[0]
+        session[HASH_SESSION_KEY] = user.get_session_auth_hash()
+        session.create()
+        return session
+
+    @staticmethod
+    def _serve(server: str, port: int, threads: int, backlog: int):
+        import uvicorn
+        if server == "wsgi":
+            from uvicorn.middleware.wsgi import WSGIMiddleware
+            from mailbox_project.wsgi import application
+            application = WSGIMiddleware(application, workers=threads)
+        else:
+            from mailbox_project.asgi import application
+        config = uvicorn.Config(application, host="127.0.0.1", port=port, log_level="warning", access_log=False,
+                                backlog=max(backlog * 2, 2048), lifespan="off")
+
+        async def serve():
+            # асинхронные страницы выполняются в пуле потоков цикла событий, его размер равен пулу WSGI
+            asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=threads))
+            await uvicorn.Server(config).serve()
+
+        asyncio.run(serve())
+
+    def _bench_server(self, server, port, threads, concurrency, requests, paths, session_key):
+        process = subprocess.Popen(
+            [sys.executable, "-m", "django", "bench_asgi", "--serve", server, "--port", str(port),
+             "--threads", str(threads), "--concurrency", str(concurrency)],
+            cwd=settings.BASE_DIR)
+        try:
+            self._wait_for_port(process, port)
+            return asyncio.run(_load(port, concurrency, requests, paths, session_key))
+        finally:
+            process.terminate()
+            process.wait()
+
+    @staticmethod
+    def _wait_for_port(process, port: int, timeout: float = 30):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise CommandError("Сервер замера завершился при запуске.")
+            try:
+                socket.create_connection(("127.0.0.1", port), timeout=1).close()
+                return
+            except OSError:
+                time.sleep(0.1)
+        raise CommandError("Сервер замера не запустился.")
+
+
+async def _read_response(reader) -> bool:
+    """Читает ответ HTTP/1.1. Возвращает, можно ли продолжать работу с соединением."""
+    head = await reader.readuntil(b"\r\n\r\n")
+    lines = head.decode("latin-1").split("\r\n")
+    status = int(lines[0].split()[1])
+    headers = dict(line.lower().split(": ", 1) for line in lines[1:] if ": " in line)
+    if headers.get("transfer-encoding") == "chunked":
+        while True:
+            size = int((await reader.readline()).strip(), 16)
+            await reader.readexactly(size + 2)
+            if size == 0:
+                break
+    else:
+        await reader.readexactly(int(headers.get("content-length", 0)))
+    if status >= 400:
+        raise ConnectionError(f"HTTP {status}")
+    return headers.get("connection") != "close"
+
+
+async def _load(port: int, concurrency: int, requests: int, paths: "List[str]", session_key: str):
+    """
+    concurrency соединений keep-alive выполняют requests запросов по очереди страниц paths.
+    Возвращает задержки успешных запросов в секундах, число ошибок и длительность замера.
+    """
+    latencies = []
+    errors = 0
+    remaining = [requests]
+
+    async def connection_worker(number: int):
+        nonlocal errors
+        reader = writer = None
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            path = paths[(remaining[0] + number) % len(paths)]
+            request = (f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\n"
+                       f"Cookie: {settings.SESSION_COOKIE_NAME}={session_key}\r\n\r\n").encode()
+            started = time.perf_counter()
+            try:
+                if writer is None:
+                    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+                writer.write(request)
+                keep_alive = await _read_response(reader)
+                latencies.append(time.perf_counter() - started)
+            except (OSError, ConnectionError, asyncio.IncompleteReadError, ValueError):
+                errors += 1
+                keep_alive = False
+            if not keep_alive and writer is not None:
+                writer.close()
+                reader = writer = None
+        if writer is not None:
+            writer.close()
+
+    started = time.perf_counter()
+    await asyncio.gather(*(connection_worker(number) for number in range(concurrency)))
+    return latencies, errors, time.perf_counter() - started
@@ -0,0 +1,77 @@
+import random
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+
+from accounts.models import MailboxUser
+from mail_box.management.commands._benchmark import rolled_back, create_benchmark_users, timer
+from mail_box.models import Letter, EmailTypes
+from mail_box.pagination import paginate_letters
+from mail_box.shards import letter_databases
+
+
+class Command(BaseCommand):
+    help = (
+        "Замер пропускной способности базы текущего профиля (MAILBOX_DB): "
+        "установка соединения, отправка, вывод папки и прочтение писем. "
+        "Все созданные данные откатываются после замера."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--connections", type=int, default=200, help="Сколько раз открыть и закрыть соединение.")
+        parser.add_argument("--users", type=int, default=1000, help="Количество пользователей.")
+        parser.add_argument("--sends", type=int, default=500, help="Количество отправляемых писем.")
+        parser.add_argument("--recipients", type=int, default=10, help="Адресатов у одного письма.")
+        parser.add_argument("--lists", type=int, default=500, help="Количество выводов папки входящих.")
+        parser.add_argument("--reads", type=int, default=500, help="Количество прочтений писем.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def _report(self, operation: str, count: int, seconds: float):
+        self.stdout.write(f"{operation:>12} {count:>8} {seconds:>10.3f} {count / seconds if seconds else 0:>12.0f}")
+
+    def handle(self, *args, users, sends, recipients, lists, reads, seed, **options):
+        total_connections = options["connections"]
+        if min(total_connections, users, sends, lists, reads) <= 0 or not 0 < recipients <= users:
+            raise CommandError("Параметры должны быть положительными, адресатов не больше пользователей.")
+        rnd = random.Random(seed)
+        settings_dict = connection.settings_dict
+        pool = settings_dict.get("POOL")
+        self.stdout.write(f"База: {connection.vendor}, CONN_MAX_AGE={settings_dict['CONN_MAX_AGE']}, "
+                          f"пул: {pool['MAX_SIZE'] if pool else 'нет'}")
+        self.stdout.write(f"{'операция':>12} {'штук':>8} {'секунд':>10} {'операций/с':>12}")
+
+        # отдельное соединение, как у нового запроса: открыть, выполнить запрос, закрыть
+        wrapper = connections[DEFAULT_DB_ALIAS].__class__(settings_dict, alias="bench_database")
+        with timer() as elapsed:
+            for _ in range(total_connections):
+                with wrapper.cursor() as cursor:
+                    cursor.execute("SELECT 1")
+                wrapper.close()
+        self._report("соединение", total_connections, elapsed[0])
+
+        with rolled_back():
+            user_ids = create_benchmark_users(users)
+            senders = MailboxUser.objects.in_bulk(user_ids)
+
+            with timer() as elapsed:
+                for _ in range(sends):
+                    sender = senders[rnd.choice(user_ids)]
+                    sender.send_mail_fanout("Замер", "Текст письма для замера", rnd.sample(user_ids, recipients))
+            self._report("отправка", sends, elapsed[0])
+
+            with timer() as elapsed:
+                for _ in range(lists):
+                    letters = Letter.objects.for_user(rnd.choice(user_ids)) \
+                        .filter(type=EmailTypes.INCOMING.value).with_content()
+                    list(paginate_letters(letters).letters)
+            self._report("папка", lists, elapsed[0])
+
+            # письма читаются в базах писем их пользователей (mail_box.shards), пользователи уже загружены
+            unread = []
+            for alias in letter_databases():
+                unread.extend(Letter.objects.using(alias).filter(user_id__in=user_ids, is_read=False)
+                              [:reads - len(unread)])
+            with timer() as elapsed:
+                for letter in unread:
+                    senders[letter.user_id].read_letter(letter)
+            self._report("прочтение", len(unread), elapsed[0])
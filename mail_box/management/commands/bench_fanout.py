@@ -0,0 +1,33 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import MailboxUser
+from mail_box.management.commands._benchmark import rolled_back, create_benchmark_users
+
+
+class Command(BaseCommand):
+    help = (
+        "Замер рассылки письма большому количеству адресатов (send_mail_fanout). "
+        "Все созданные данные откатываются после замера."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000],
+                            help="Количества адресатов, для которых выполняется замер.")
+        parser.add_argument("--batch-size", type=int, default=None,
+                            help="Размер пакета вставки. По умолчанию MAILBOX_FANOUT_BATCH_SIZE.")
+        parser.add_argument("--by-email", action="store_true",
+                            help="Передавать адресатов email-ами, а не id.")
+
+    def handle(self, *args, sizes, batch_size, by_email, **options):
+        if any(size <= 0 for size in sizes):
+            raise CommandError("Количество адресатов должно быть положительным.")
+
+        self.stdout.write(f"{'адресатов':>10} {'секунд':>10} {'писем/с':>12}")
+        for size in sizes:
+            with rolled_back():
+                sender = MailboxUser.objects.create_user("sender@bench.local", first_name="sender")
+                recipients = create_benchmark_users(size)
+                if by_email:
+                    recipients = [f"bench{i}@bench.local" for i in range(size)]
+                result = sender.send_mail_fanout("Рассылка", "Текст рассылки", recipients, batch_size=batch_size)
+            self.stdout.write(f"{result.delivered:>10} {result.elapsed:>10.3f} {result.throughput:>12.0f}")
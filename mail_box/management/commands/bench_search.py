@@ -0,0 +1,84 @@
+import random
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from accounts.models import MailboxUser
+from mail_box.management.commands._benchmark import rolled_back, create_benchmark_users, percentile, make_vocabulary
+from mail_box.models import Message, Letter, EmailTypes
+from mail_box.search import get_backend, search_letters, index_letter_database
+from mail_box.shards import shard_for_user
+
+
+class Command(BaseCommand):
+    help = (
+        "Замер задержки поиска по письмам на синтетическом корпусе сообщений. "
+        "Корпус создаётся в транзакции, которая откатывается после замера."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--messages", type=int, default=1000000, help="Размер корпуса сообщений.")
+        parser.add_argument("--users", type=int, default=100,
+                            help="Между сколькими пользователями распределить письма.")
+        parser.add_argument("--queries", type=int, default=200, help="Количество замеряемых запросов.")
+        parser.add_argument("--words", type=int, default=2, help="Слов в одном запросе.")
+        parser.add_argument("--vocabulary", type=int, default=20000, help="Размер словаря корпуса.")
+        parser.add_argument("--batch-size", type=int, default=5000, help="Размер пакета вставки сообщений.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, messages, users, queries, words, vocabulary, batch_size, seed, **options):
+        if min(messages, users, queries, words, vocabulary, batch_size) <= 0:
+            raise CommandError("Все параметры должны быть положительными.")
+        rnd = random.Random(seed)
+        dictionary = make_vocabulary(vocabulary, rnd)
+        # частоты слов по закону Ципфа, как в естественном тексте
+        weights = [1 / rank for rank in range(1, vocabulary + 1)]
+        backend = get_backend()
+
+        with rolled_back():
+            sender = MailboxUser.objects.create_user("search-sender@bench.local")
+            user_ids = create_benchmark_users(users)
+            started = time.perf_counter()
+            for start in range(0, messages, batch_size):
+                size = min(batch_size, messages - start)
+                last_id = Message.objects.order_by("-id").values_list("id", flat=True).first() or 0
+                Message.objects.bulk_create([
+                    Message(sender=sender, header=" ".join(rnd.choices(dictionary, weights, k=5)),
+                            text=" ".join(rnd.choices(dictionary, weights, k=40)))
+                    for _ in range(size)
+                ])
+                # sqlite не возвращает id после bulk_create
+                created = list(Message.objects.filter(id__gt=last_id).order_by("id"))
+                backend.index_messages(created)
+                # письма вставляются в базы писем своих пользователей (mail_box.shards), по запросу на базу
+                by_shard = {}
+                for message in created:
+                    user_id = rnd.choice(user_ids)
+                    by_shard.setdefault(shard_for_user(user_id), []).append((user_id, message))
+                for alias, rows in by_shard.items():
+                    Letter.objects.using(alias).bulk_create([
+                        Letter(user_id=user_id, message_id=message.id, type=EmailTypes.INCOMING.value, is_read=False)
+                        for user_id, message in rows
+                    ])
+                    index_letter_database([message for _, message in rows], alias)
+                self.stdout.write(f"\rСоздано сообщений: {start + size}", ending="")
+            self.stdout.write(f"\nКорпус создан за {time.perf_counter() - started:.1f} с.")
+
+            # слова запросов берутся из середины частотного словаря, а не только самые частые
+            query_words = dictionary[vocabulary // 100:vocabulary // 10] or dictionary
+            users_by_id = MailboxUser.objects.in_bulk(user_ids)
+            latencies = []
+            found = 0
+            for _ in range(queries):
+                user = users_by_id[rnd.choice(user_ids)]
+                query = " ".join(rnd.sample(query_words, min(words, len(query_words))))
+                started = time.perf_counter()
+                results = search_letters(user, query)
+                latencies.append((time.perf_counter() - started) * 1000)
+                found += len(results)
+
+        self.stdout.write(f"Механизм поиска: {backend.name}, сообщений: {messages}, запросов: {queries}")
+        self.stdout.write(f"Найдено писем в среднем: {found / queries:.1f}")
+        for name, value in (("p50", percentile(latencies, 50)), ("p95", percentile(latencies, 95)),
+                            ("p99", percentile(latencies, 99)), ("max", max(latencies))):
+            self.stdout.write(f"{name}: {value:.2f} мс")
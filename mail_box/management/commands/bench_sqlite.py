@@ -0,0 +1,124 @@
+import os
+import random
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, transaction, OperationalError
+
+from accounts.models import MailboxUser
+from mail_box.models import Message, Letter, EmailTypes, FolderCounters
+from mail_box.pagination import paginate_letters
+
+# Стандартный режим sqlite и режим, который включает MAILBOX_SQLITE_TUNING
+PROFILES = {
+    "default": {"PRAGMAS": {"journal_mode": "DELETE"}, "TRANSACTION_MODE": None},
+    "tuned": {"PRAGMAS": {**settings.SQLITE_PRAGMAS, **settings.SQLITE_WAL_PRAGMAS}, "TRANSACTION_MODE": "IMMEDIATE"},
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Многопоточный замер sqlite: читатели выводят папки, писатели отправляют и отмечают письма. "
+        "Замер выполняется на временных базах в стандартном и настроенном режиме, рабочая база не затрагивается."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--readers", type=int, default=8, help="Потоков-читателей.")
+        parser.add_argument("--writers", type=int, default=2, help="Потоков-писателей.")
+        parser.add_argument("--seconds", type=float, default=5, help="Длительность замера каждого режима.")
+        parser.add_argument("--users", type=int, default=200)
+        parser.add_argument("--messages", type=int, default=5000, help="Начальное количество сообщений.")
+        parser.add_argument("--profiles", nargs="+", choices=list(PROFILES), default=list(PROFILES))
+
+    def handle(self, *args, readers, writers, seconds, users, messages, profiles, **options):
+        if min(readers + writers, seconds, users, messages) <= 0 or min(readers, writers) < 0:
+            raise CommandError("Параметры должны быть положительными.")
+        self.stdout.write(f"Читателей: {readers}, писателей: {writers}, секунд: {seconds}")
+        self.stdout.write(f"{'режим':>8} {'чтений/с':>10} {'записей/с':>10} {'блокировок':>11}")
+        with tempfile.TemporaryDirectory() as directory:
+            for profile in profiles:
+                alias = f"bench_sqlite_{profile}"
+                connections.databases[alias] = {
+                    "ENGINE": "mailbox_project.sqlite_tuned",
+                    "NAME": os.path.join(directory, f"{profile}.sqlite3"),
+                    **PROFILES[profile],
+                }
+                try:
+                    call_command("migrate", database=alias, verbosity=0)
+                    user_ids = self._populate(alias, users, messages)
+                    counts = self._run(alias, user_ids, readers, writers, seconds)
+                finally:
+                    connections[alias].close()
+                    del connections.databases[alias]
+                self.stdout.write(f"{profile:>8} {counts['reads'] / seconds:>10.0f} "
+                                  f"{counts['writes'] / seconds:>10.0f} {counts['locked']:>11}")
+
+    @staticmethod
+    def _populate(alias: str, users: int, messages: int) -> "list":
+        rnd = random.Random(1)
+        MailboxUser.objects.db_manager(alias).bulk_create(
+            [MailboxUser(email=f"bench{i}@bench.local", password="!") for i in range(users)])
+        user_ids = list(MailboxUser.objects.using(alias).values_list("id", flat=True))
+        Message.objects.using(alias).bulk_create(
+            [Message(sender_id=rnd.choice(user_ids), header=f"Письмо {i}", text="Текст письма") for i in range(messages)])
+        Letter.objects.using(alias).bulk_create(
+            [Letter(user_id=rnd.choice(user_ids), message_id=message_id, type=EmailTypes.INCOMING.value, is_read=False)
+             for message_id in Message.objects.using(alias).values_list("id", flat=True) for _ in range(3)])
+        FolderCounters.objects.db_manager(alias).rebuild(user_ids)
+        return user_ids
+
+    @staticmethod
+    def _send(alias: str, rnd: "random.Random", user_ids: "list"):
+        """Транзакция как при отправке: сначала читаются счётчики, затем пишутся сообщение, письма и счётчики"""
+        recipient_ids = rnd.sample(user_ids, 3)
+        with transaction.atomic(using=alias):
+            list(FolderCounters.objects.using(alias).filter(user_id__in=recipient_ids).values_list("user_id"))
+            message = Message.objects.using(alias).create(sender_id=rnd.choice(user_ids), header="Замер", text="Текст")
+            Letter.objects.using(alias).bulk_create(
+                [Letter(user_id=user_id, message=message, type=EmailTypes.INCOMING.value, is_read=False)
+                 for user_id in recipient_ids])
+            FolderCounters.objects.using(alias).filter(user_id__in=recipient_ids).update(total_incoming=0)
+
+    def _run(self, alias: str, user_ids: "list", readers: int, writers: int, seconds: float) -> dict:
+        counts = {"reads": 0, "writes": 0, "locked": 0}
+        counts_lock = threading.Lock()
+        max_letter_id = Letter.objects.using(alias).order_by("-id").values_list("id", flat=True).first()
+        deadline = time.monotonic() + seconds
+
+        def worker(kind: str, seed: int):
+            rnd = random.Random(seed)
+            done = locked = 0
+            try:
+                while time.monotonic() < deadline:
+                    try:
+                        if kind == "reads":
+                            letters = Letter.objects.using(alias).filter(
+                                user_id=rnd.choice(user_ids), type=EmailTypes.INCOMING.value).with_content()
+                            list(paginate_letters(letters).letters)
+                        elif rnd.random() < 0.5:
+                            self._send(alias, rnd, user_ids)
+                        else:
+                            Letter.objects.using(alias).filter(id=rnd.randint(1, max_letter_id), is_read=False) \
+                                .update(is_read=True)
+                        done += 1
+                    except OperationalError as error:
+                        if "locked" not in str(error):
+                            raise
+                        locked += 1
+            finally:
+                connections[alias].close()
+                with counts_lock:
+                    counts[kind] += done
+                    counts["locked"] += locked
+
+        threads = [threading.Thread(target=worker, args=("reads", i)) for i in range(readers)]
+        threads += [threading.Thread(target=worker, args=("writes", readers + i)) for i in range(writers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return counts
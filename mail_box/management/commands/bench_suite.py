@@ -0,0 +1,158 @@
+import json
+import platform
+import random
+import time
+from statistics import mean
+
+import django
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from accounts.models import MailboxUser
+from mail_box.management.commands._benchmark import rolled_back, percentile
+from mail_box.message_cache import message_cache
+from mail_box.models import Message, Letter, EmailTypes, FolderCounters
+from mail_box.pagination import paginate_letters
+from mail_box.shards import letter_databases
+
+OPERATIONS = ("send_mail", "folder_page", "unread_count", "read_letter", "unread_letter", "delete_letter")
+
+
+class Command(BaseCommand):
+    help = (
+        "Набор замеров операций модели на данных текущей базы (например, созданных generate_mailbox_data): "
+        "отправка, вывод папки, число непрочитанных, прочтение, снятие отметки и удаление писем. "
+        "Для каждой операции считаются перцентили задержки и число запросов к базе, результат пишется в JSON. "
+        "Все изменения откатываются после замера, поэтому прогоны с одним --seed повторяемы."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--iterations", type=int, default=200, help="Повторов каждой операции.")
+        parser.add_argument("--recipients", type=int, default=5, help="Адресатов у отправляемого письма.")
+        parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=list(OPERATIONS))
+        parser.add_argument("--output", help="Файл для результата в JSON, иначе он выводится на экран.")
+        parser.add_argument("--compare", help="JSON прошлого прогона: вывести изменение задержек и числа запросов.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, iterations, recipients, operations, output, compare, seed, **options):
+        if min(iterations, recipients) <= 0:
+            raise CommandError("Параметры должны быть положительными.")
+        user_ids = sorted({user_id for alias in letter_databases()
+                           for user_id in Letter.objects.using(alias).filter(type=EmailTypes.INCOMING.value)
+                           .values_list("user_id", flat=True).distinct()})
+        if len(user_ids) <= recipients:
+            raise CommandError("В базе мало пользователей с письмами, сначала выполните generate_mailbox_data.")
+        rnd = random.Random(seed)
+        # кэш сообщений не должен переносить результаты одного прогона в другой
+        message_cache.clear()
+
+        results = {}
+        with rolled_back():
+            users = MailboxUser.objects.in_bulk(rnd.sample(user_ids, min(len(user_ids), 1000)))
+            sample_ids = list(users)
+            for operation in operations:
+                measure = getattr(self, f"_measure_{operation}")
+                results[operation] = measure(users, sample_ids, iterations, recipients, rnd)
+
+        report = {
+            "meta": {
+                "created_at": timezone.now().isoformat(),
+                "database": connection.vendor,
+                "django": django.get_version(),
+                "python": platform.python_version(),
+                "seed": seed,
+                "iterations": iterations,
+                "users": MailboxUser.objects.count(),
+                "messages": Message.objects.count(),
+                "letters": sum(Letter.objects.using(alias).count() for alias in letter_databases()),
+            },
+            "operations": results,
+        }
+        content = json.dumps(report, indent=4, ensure_ascii=False)
+        if output:
+            with open(output, "w", encoding="utf-8") as file:
+                file.write(content)
+        else:
+            self.stdout.write(content)
+        # без --output JSON занимает стандартный вывод, и таблица выводится в поток ошибок
+        self._print_table(self.stdout if output else self.stderr, results, compare)
+
+    @staticmethod
+    def _run(samples, operation) -> dict:
+        """Выполняет operation для каждого набора аргументов, замеряя время и запросы к базе каждого вызова"""
+        latencies, queries = [], []
+        for sample in samples:
+            with CaptureQueriesContext(connection) as context:
+                started = time.perf_counter()
+                operation(*sample)
+                latencies.append((time.perf_counter() - started) * 1000)
+            queries.append(len(context.captured_queries))
+        return {
+            "count": len(latencies),
+            "mean_ms": round(mean(latencies), 3) if latencies else 0.0,
+            "p50_ms": round(percentile(latencies, 50), 3),
+            "p95_ms": round(percentile(latencies, 95), 3),
+            "p99_ms": round(percentile(latencies, 99), 3),
+            "max_ms": round(max(latencies, default=0.0), 3),
+            "queries_per_op": round(mean(queries), 2) if queries else 0.0,
+        }
+
+    def _measure_send_mail(self, users, sample_ids, iterations, recipients, rnd):
+        samples = []
+        for _ in range(iterations):
+            sender_id, *recipient_ids = rnd.sample(sample_ids, recipients + 1)
+            samples.append((users[sender_id], [users[user_id] for user_id in recipient_ids]))
+        return self._run(samples, lambda sender, addressees: sender.send_mail("Замер", "Текст письма", addressees))
+
+    def _measure_folder_page(self, users, sample_ids, iterations, recipients, rnd):
+        samples = [(rnd.choice(sample_ids),) for _ in range(iterations)]
+        return self._run(samples, lambda user_id: list(paginate_letters(
+            Letter.objects.for_user(user_id).filter(type=EmailTypes.INCOMING.value).with_content()).letters))
+
+    def _measure_unread_count(self, users, sample_ids, iterations, recipients, rnd):
+        samples = [(users[rnd.choice(sample_ids)],) for _ in range(iterations)]
+        return self._run(samples, lambda user: FolderCounters.objects.get_for_user(user).unread_incoming)
+
+    def _letters(self, sample_ids, iterations, rnd, **filters) -> "list":
+        """Случайные входящие письма пользователей выборки, по одному запросу на пользователя"""
+        letters = []
+        for user_id in rnd.sample(sample_ids, len(sample_ids)):
+            letters.extend(Letter.objects.for_user(user_id).filter(type=EmailTypes.INCOMING.value, **filters)
+                           .order_by("id")[:5])
+            if len(letters) >= iterations:
+                break
+        return letters[:iterations]
+
+    def _measure_read_letter(self, users, sample_ids, iterations, recipients, rnd):
+        letters = self._letters(sample_ids, iterations, rnd, is_read=False)
+        samples = [(users[letter.user_id], letter) for letter in letters]
+        return self._run(samples, lambda user, letter: user.read_letter(letter))
+
+    def _measure_unread_letter(self, users, sample_ids, iterations, recipients, rnd):
+        letters = self._letters(sample_ids, iterations, rnd, is_read=True)
+        samples = [(users[letter.user_id], letter) for letter in letters]
+        return self._run(samples, lambda user, letter: user.unread_letter(letter))
+
+    def _measure_delete_letter(self, users, sample_ids, iterations, recipients, rnd):
+        samples = [(users[letter.user_id], letter) for letter in self._letters(sample_ids, iterations, rnd)]
+        return self._run(samples, lambda user, letter: user.delete_letter(letter))
+
+    @staticmethod
+    def _print_table(stream, results: dict, compare: "str"):
+        previous = {}
+        if compare:
+            with open(compare, encoding="utf-8") as file:
+                previous = json.load(file)["operations"]
+        header = f"{'операция':>14} {'штук':>6} {'p50, мс':>9} {'p95, мс':>9} {'p99, мс':>9} {'запросов':>9}"
+        if previous:
+            header += f" {'p50 было':>9} {'p99 было':>9} {'запр. было':>10}"
+        stream.write(header)
+        for operation, result in results.items():
+            line = (f"{operation:>14} {result['count']:>6} {result['p50_ms']:>9.2f} {result['p95_ms']:>9.2f} "
+                    f"{result['p99_ms']:>9.2f} {result['queries_per_op']:>9.2f}")
+            if operation in previous:
+                old = previous[operation]
+                line += f" {old['p50_ms']:>9.2f} {old['p99_ms']:>9.2f} {old['queries_per_op']:>10.2f}"
+            stream.write(line)
@@ -0,0 +1,39 @@
+import time
+from datetime import timedelta
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from mail_box.changes import compact_changes
+from mail_box.models import ChangeSequence
+
+
+class Command(BaseCommand):
+    help = (
+        "Сжимает журнал изменений писем: удаляет изменения старше заданного количества дней. "
+        "Работает пакетами пользователей, каждый пакет - в своей короткой транзакции."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--days", type=int, default=settings.MAILBOX_CHANGES_RETENTION_DAYS,
+                            help="Сколько дней хранятся изменения.")
+        parser.add_argument("--batch-size", type=int, default=500,
+                            help="Сколько пользователей обрабатывается в одной транзакции.")
+        parser.add_argument("--sleep", type=float, default=0,
+                            help="Пауза между пакетами в секундах, чтобы не мешать рабочей нагрузке.")
+
+    def handle(self, *args, days, batch_size, sleep, **options):
+        before = timezone.now() - timedelta(days=days)
+        last_id = 0
+        deleted = 0
+        while True:
+            user_ids = list(ChangeSequence.objects.filter(user_id__gt=last_id).order_by("user_id")
+                            .values_list("user_id", flat=True)[:batch_size])
+            if not user_ids:
+                break
+            last_id = user_ids[-1]
+            deleted += compact_changes(before, user_ids)
+            if sleep:
+                time.sleep(sleep)
+        self.stdout.write(self.style.SUCCESS(f"Удалено изменений: {deleted}."))
@@ -0,0 +1,34 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from mail_box.delivery import run_worker, release_stale_jobs
+
+
+class Command(BaseCommand):
+    help = "Исполнитель очереди отложенной доставки писем."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--concurrency", type=int, default=1, help="Количество потоков-исполнителей.")
+        parser.add_argument("--max-attempts", type=int, default=5,
+                            help="После стольких неудачных попыток задание помечается как неудачное.")
+        parser.add_argument("--retry-delay", type=float, default=10.0,
+                            help="Задержка перед повтором в секундах, умножается на номер попытки.")
+        parser.add_argument("--poll-interval", type=float, default=1.0,
+                            help="Как часто проверять очередь, когда она пуста, в секундах.")
+        parser.add_argument("--stale-timeout", type=float, default=600.0,
+                            help="Задания, выполняемые дольше этого времени, возвращаются в очередь при запуске.")
+        parser.add_argument("--once", action="store_true",
+                            help="Выполнить готовые задания и завершиться.")
+
+    def handle(self, *args, concurrency, max_attempts, retry_delay, poll_interval, stale_timeout, once, **options):
+        if concurrency < 1 or max_attempts < 1:
+            raise CommandError("concurrency и max-attempts должны быть положительными.")
+        released = release_stale_jobs(stale_timeout)
+        if released:
+            self.stdout.write(f"Возвращено в очередь зависших заданий: {released}.")
+        try:
+            stats = run_worker(concurrency=concurrency, max_attempts=max_attempts, retry_delay=retry_delay,
+                               poll_interval=poll_interval, once=once)
+        except KeyboardInterrupt:
+            return
+        self.stdout.write(self.style.SUCCESS(
+            f"Выполнено заданий: {stats['done']}, неудачных попыток: {stats['failed']}."))
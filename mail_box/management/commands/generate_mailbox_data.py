@@ -0,0 +1,106 @@
+import random
+import time
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils import timezone
+
+from accounts.models import MailboxUser
+from mail_box.management.commands._benchmark import create_benchmark_users, make_vocabulary
+from mail_box.models import Message, Letter, EmailTypes, FolderCounters
+from mail_box.search import get_backend, index_letter_database
+from mail_box.shards import shard_transactions, shard_for_user
+
+
+class Command(BaseCommand):
+    help = (
+        "Наполняет базу синтетическими пользователями и письмами для замеров. "
+        "Сообщения, адресаты и письма вставляются пакетами, каждый пакет - в своей транзакции. "
+        "Число адресатов письма распределено по степенному закону: в основном один-два адресата, изредка рассылки. "
+        "Созданные пользователи не могут войти в систему, журнал изменений для них не заполняется."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=1000, help="Количество пользователей.")
+        parser.add_argument("--messages", type=int, default=10000, help="Количество отправленных сообщений.")
+        parser.add_argument("--max-recipients", type=int, default=50, help="Наибольшее число адресатов письма.")
+        parser.add_argument("--recipients-exponent", type=float, default=2.0,
+                            help="Показатель степени: вероятность k адресатов пропорциональна k^-показатель.")
+        parser.add_argument("--unread", type=float, default=0.3, help="Доля непрочитанных входящих писем.")
+        parser.add_argument("--days", type=int, default=365, help="За сколько дней распределены сообщения.")
+        parser.add_argument("--batch-size", type=int, default=2000, help="Сообщений в одном пакете вставки.")
+        parser.add_argument("--prefix", default="gen", help="Начало email создаваемых пользователей.")
+        parser.add_argument("--seed", type=int, default=1)
+
+    def handle(self, *args, users, messages, max_recipients, recipients_exponent, unread, days, batch_size,
+               prefix, seed, **options):
+        if min(users, messages, max_recipients, days, batch_size) <= 0 or users < 2 or not 0 <= unread <= 1:
+            raise CommandError("Нужно не меньше двух пользователей, параметры должны быть положительными, "
+                               "доля непрочитанных - от 0 до 1.")
+        if MailboxUser.objects.filter(email__startswith=prefix, email__endswith="@bench.local").exists():
+            raise CommandError(f"Пользователи с префиксом {prefix!r} уже созданы, укажите другой --prefix.")
+        rnd = random.Random(seed)
+        started = time.perf_counter()
+
+        with transaction.atomic():
+            user_ids = create_benchmark_users(users, prefix=prefix)
+        counts = list(range(1, min(max_recipients, users - 1) + 1))
+        count_weights = [count ** -recipients_exponent for count in counts]
+        dictionary = make_vocabulary(5000, rnd)
+        word_weights = [1 / rank for rank in range(1, len(dictionary) + 1)]
+        backend = get_backend()
+        period = timedelta(days=days)
+        first_sent_at = timezone.now() - period
+
+        total_letters = 0
+        for start in range(0, messages, batch_size):
+            size = min(batch_size, messages - start)
+            with transaction.atomic(), shard_transactions(user_ids):
+                last_id = Message.objects.order_by("-id").values_list("id", flat=True).first() or 0
+                Message.objects.bulk_create([
+                    Message(sender_id=rnd.choice(user_ids),
+                            header=" ".join(rnd.choices(dictionary, word_weights, k=rnd.randint(2, 6)))[:70],
+                            text=" ".join(rnd.choices(dictionary, word_weights, k=rnd.randint(10, 80)))[:900],
+                            # время отправки растёт вместе с id сообщения, как в настоящей почте
+                            sent_at=first_sent_at + period * (start + i + rnd.random()) / messages)
+                    for i in range(size)
+                ])
+                # sqlite не возвращает id после bulk_create
+                created = list(Message.objects.filter(id__gt=last_id).order_by("id"))
+                backend.index_messages(created)
+                total_letters += self._deliver(created, user_ids, counts, count_weights, unread, rnd)
+            self.stdout.write(f"\rСоздано сообщений: {start + size}", ending="")
+
+        for start in range(0, len(user_ids), batch_size):
+            FolderCounters.objects.rebuild(user_ids[start:start + batch_size])
+        elapsed = time.perf_counter() - started
+        self.stdout.write("")
+        self.stdout.write(self.style.SUCCESS(
+            f"Пользователей: {users}, сообщений: {messages}, писем: {total_letters}, "
+            f"за {elapsed:.1f} с ({total_letters / elapsed:.0f} писем/с)."))
+
+    @staticmethod
+    def _deliver(messages, user_ids, counts, count_weights, unread, rnd) -> int:
+        """Адресаты, письмо отправителя и входящие письма адресатов для пакета сообщений"""
+        addressee = Message.addressees_set.through
+        addressees, letters = [], {}  # письма по базам писем (mail_box.shards)
+        for message in messages:
+            count = rnd.choices(counts, count_weights)[0]
+            recipients = [user_id for user_id in rnd.sample(user_ids, count + 1) if user_id != message.sender_id]
+            times = {"created_at": message.sent_at, "updated_at": message.sent_at}
+            letters.setdefault(shard_for_user(message.sender_id), []).append(Letter(
+                user_id=message.sender_id, message_id=message.id, type=EmailTypes.OUTGOING.value, **times))
+            for user_id in recipients[:count]:
+                addressees.append(addressee(message_id=message.id, mailboxuser_id=user_id))
+                letters.setdefault(shard_for_user(user_id), []).append(Letter(
+                    user_id=user_id, message_id=message.id, type=EmailTypes.INCOMING.value,
+                    is_read=rnd.random() >= unread, **times))
+        addressee.objects.bulk_create(addressees)
+        by_id = {message.id: message for message in messages}
+        for alias, shard_letters in letters.items():
+            Letter.objects.using(alias).bulk_create(shard_letters)
+            # копия поискового индекса сообщений этих писем в их базе (mail_box.search)
+            index_letter_database([by_id[message_id] for message_id in dict.fromkeys(
+                letter.message_id for letter in shard_letters)], alias)
+        return sum(len(shard_letters) for shard_letters in letters.values())
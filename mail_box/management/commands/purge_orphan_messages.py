@@ -0,0 +1,53 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mail_box.models import Message, MessageTerm
+from mail_box.shards import letter_shards
+
+
+class Command(BaseCommand):
+    help = (
+        "Удаляет содержимое писем (Message), на которое не ссылается ни одно письмо, "
+        "вместе с его адресатами. Работает небольшими пакетами, каждый в своей короткой транзакции."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Сколько сообщений просматривается в одной транзакции.")
+        parser.add_argument("--sleep", type=float, default=0,
+                            help="Пауза между пакетами в секундах, чтобы не мешать рабочей нагрузке.")
+
+    def handle(self, *args, batch_size, sleep, **options):
+        last_id = 0
+        purged = 0
+        while True:
+            # сообщения перебираются по ключу, поэтому каждый пакет - ограниченный проход по первичному ключу
+            message_ids = list(
+                Message.objects.filter(id__gt=last_id).order_by("id").values_list("id", flat=True)[:batch_size])
+            if not message_ids:
+                break
+            last_id = message_ids[-1]
+            purged += purge_orphan_messages(message_ids)
+            if sleep:
+                time.sleep(sleep)
+        self.stdout.write(self.style.SUCCESS(f"Удалено сообщений без писем: {purged}."))
+
+
+@transaction.atomic
+def purge_orphan_messages(message_ids) -> int:
+    """
+    Удаляет сообщения без писем среди переданных, вместе со связями с адресатами.
+    Отсутствие ссылок проверяется в той же транзакции, что и удаление.
+    Копии поискового индекса удалённых сообщений в базах писем (mail_box.search) удаляются следом.
+    """
+    orphans = Message.objects.filter(id__in=message_ids).orphans()
+    shards = letter_shards()
+    if shards:
+        orphan_ids = list(orphans.values_list("id", flat=True))
+        orphans = Message.objects.filter(id__in=orphan_ids)
+        for alias in shards:
+            MessageTerm.objects.using(alias).filter(message_id__in=orphan_ids).delete()
+    deleted, per_model = orphans.delete()
+    return per_model.get(Message._meta.label, 0)
@@ -0,0 +1,28 @@
+from django.contrib.auth import get_user_model
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from mail_box.models import FolderCounters
+
+
+class Command(BaseCommand):
+    help = "Пересчитывает счётчики папок пользователей по письмам, исправляя расхождения."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--batch-size", type=int, default=1000,
+                            help="Количество пользователей, пересчитываемых в одной транзакции.")
+
+    def handle(self, *args, batch_size, **options):
+        users = get_user_model().objects.order_by("id").values_list("id", flat=True)
+        last_id = 0
+        total = 0
+        while True:
+            # Пользователи перебираются по ключу, чтобы не держать долгую транзакцию на всю таблицу
+            user_ids = list(users.filter(id__gt=last_id)[:batch_size])
+            if not user_ids:
+                break
+            with transaction.atomic():
+                FolderCounters.objects.rebuild(user_ids)
+            last_id = user_ids[-1]
+            total += len(user_ids)
+        self.stdout.write(self.style.SUCCESS(f"Пересчитаны счётчики {total} пользователей."))
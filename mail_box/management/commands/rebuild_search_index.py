@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from mail_box.search import get_backend, rebuild_letter_databases
+
+
+class Command(BaseCommand):
+    help = "Перестраивает поисковый индекс писем по всем сообщениям."
+
+    def handle(self, *args, **options):
+        backend = get_backend()
+        backend.rebuild()
+        rebuild_letter_databases()
+        self.stdout.write(self.style.SUCCESS(f"Поисковый индекс ({backend.name}) перестроен."))
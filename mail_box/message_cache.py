@@ -0,0 +1,185 @@
+"""
+Кэш содержимого сообщений, общий для всех адресатов.
+
+Сообщение (заголовок, текст, отправитель и адресаты) после отправки не меняется,
+а ссылаются на него письма всех адресатов. Поэтому содержимое кэшируется по id сообщения
+в памяти процесса (LRU, ограниченный числом записей и оценкой занимаемой памяти)
+и, если задан MAILBOX_MESSAGE_CACHE_ALIAS, во втором уровне - кэше django, общем для процессов.
+Пользователи в кэш не кладутся, только id отправителя и адресатов: их имена и адреса выбираются
+при каждом обращении одним запросом (USER_FIELDS), поэтому в кэше нет паролей, а переименование видно сразу.
+
+Сообщения, прочитанные внутри незафиксированной транзакции, в кэш не кладутся:
+sqlite после отката выдаёт те же id другим сообщениям.
+"""
+import sys
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, List
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.core.cache import caches
+from django.db import connection
+
+# Оценка памяти на одного адресата в списке и на сам объект сообщения, в байтах
+ADDRESSEE_SIZE = 100
+MESSAGE_OVERHEAD = 2000
+
+# Поля отправителя и адресатов, выводимые вместе с сообщением
+USER_FIELDS = ("id", "email", "first_name", "last_name")
+
+
+def _estimate_size(message: "Message") -> int:
+    return sys.getsizeof(message.header) + sys.getsizeof(message.text) + MESSAGE_OVERHEAD \
+        + ADDRESSEE_SIZE * len(message.addressee_ids)
+
+
+class MessageCache:
+    """LRU сообщений в памяти процесса со счётчиками попаданий"""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # id сообщения -> (сообщение, оценка размера)
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_many(self, message_ids: "Iterable[int]") -> "Dict[int, Message]":
+        found = {}
+        with self._lock:
+            for message_id in message_ids:
+                entry = self._entries.get(message_id)
+                if entry is None:
+                    self.misses += 1
+                else:
+                    self.hits += 1
+                    self._entries.move_to_end(message_id)
+                    found[message_id] = entry[0]
+        return found
+
+    def set_many(self, messages: "Iterable[Message]"):
+        with self._lock:
+            for message in messages:
+                size = _estimate_size(message)
+                if size > self.max_bytes:
+                    continue  # одно сообщение больше всего кэша, например рассылка на всю компанию
+                old = self._entries.pop(message.pk, None)
+                if old is not None:
+                    self._bytes -= old[1]
+                self._entries[message.pk] = (message, size)
+                self._bytes += size
+            while self._entries and (len(self._entries) > self.max_entries or self._bytes > self.max_bytes):
+                _, (_, size) = self._entries.popitem(last=False)
+                self._bytes -= size
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+            self.hits = self.misses = 0
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": self.hits / total if total else 0.0,
+                "entries": len(self._entries),
+                "bytes": self._bytes,
+            }
+
+
+message_cache = MessageCache(settings.MAILBOX_MESSAGE_CACHE_SIZE, settings.MAILBOX_MESSAGE_CACHE_MAX_BYTES)
+
+
+def _shared_key(message_id: int) -> str:
+    # v2 - сообщения без объектов пользователей
+    return f"mailbox:message:v2:{message_id}"
+
+
+def _fetch_messages(message_ids: "Iterable[int]") -> "Dict[int, Message]":
+    """Сообщения для кэша: отправитель и адресаты (addressee_ids) - только id"""
+    messages = Message.objects.in_bulk(message_ids)
+    for message in messages.values():
+        message.addressee_ids = []
+    addressees = Message.addressees_set.through.objects.filter(message_id__in=messages).order_by("id")
+    for message_id, user_id in addressees.values_list("message_id", "mailboxuser_id"):
+        messages[message_id].addressee_ids.append(user_id)
+    return messages
+
+
+def _with_users(cached: "Iterable[Message]") -> "Dict[int, Message]":
+    """
+    Копии сообщений из кэша с отправителем и адресатами, выбранными одним запросом.
+    Кэшированные объекты общие для потоков, поэтому пользователи подставляются в копии.
+    """
+    cached = list(cached)
+    user_ids = set()
+    for message in cached:
+        user_ids.add(message.sender_id)
+        user_ids.update(message.addressee_ids)
+    users = get_user_model().objects.only(*USER_FIELDS).in_bulk(user_ids) if user_ids else {}
+    messages = {}
+    for message in cached:
+        if message.sender_id not in users:
+            continue  # сообщение удалено вместе с отправителем после попадания в кэш
+        copy = Message(**{field.attname: getattr(message, field.attname) for field in Message._meta.concrete_fields})
+        copy._state.adding, copy._state.db = False, message._state.db
+        copy.sender = users[message.sender_id]
+        copy.addressee_ids = message.addressee_ids
+        # адресаты подставляются как результат prefetch_related, поэтому addressees_set.all() не идёт в базу
+        addressees = get_user_model().objects.none()
+        addressees._result_cache = [users[user_id] for user_id in message.addressee_ids if user_id in users]
+        addressees._prefetch_done = True
+        copy._prefetched_objects_cache = {"addressees_set": addressees}
+        messages[copy.pk] = copy
+    return messages
+
+
+def get_messages(message_ids: "Iterable[int]") -> "Dict[int, Message]":
+    """
+    Сообщения с отправителем и адресатами: из памяти процесса, затем из общего кэша,
+    недостающие - одним запросом (и одним запросом адресатов) из базы.
+    Отправитель и адресаты выбираются из базы при каждом вызове одним запросом.
+    """
+    message_ids = set(message_ids)
+    found = message_cache.get_many(message_ids)
+    missing = message_ids - found.keys()
+    can_store = not connection.in_atomic_block
+
+    alias = settings.MAILBOX_MESSAGE_CACHE_ALIAS
+    if missing and alias:
+        shared = caches[alias].get_many([_shared_key(message_id) for message_id in missing])
+        from_shared = list(shared.values())
+        found.update((message.pk, message) for message in from_shared)
+        missing -= {message.pk for message in from_shared}
+        if can_store:
+            message_cache.set_many(from_shared)
+
+    if missing:
+        fetched = _fetch_messages(missing)
+        found.update(fetched)
+        if can_store:
+            message_cache.set_many(fetched.values())
+            if alias:
+                caches[alias].set_many({_shared_key(message.pk): message for message in fetched.values()},
+                                       settings.MAILBOX_CACHE_TIMEOUT)
+    return _with_users(found.values())
+
+
+def attach_messages(letters: "List[Letter]"):
+    """
+    Подставляет письмам их сообщения из кэша.
+    Письма, сообщения которых нет (в базах писем шардов ссылки не проверяются базой), убираются из списка.
+    """
+    messages = get_messages(letter.message_id for letter in letters)
+    letters[:] = [letter for letter in letters if letter.message_id in messages]
+    for letter in letters:
+        letter.message = messages[letter.message_id]
+
+
+# импорт размещён здесь, чтобы модели могли использовать кэш без циклического импорта
+from mail_box.models import Message, Letter
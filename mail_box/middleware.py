@@ -0,0 +1,144 @@
+"""
+Учёт запросов к базе для каждого HTTP-запроса, без DEBUG.
+
+Обёртка выполнения (execute_wrapper) ставится на каждое соединение при его создании и считает запросы
+текущего HTTP-запроса: количество, суммарное время и повторы (тот же текст с теми же параметрами).
+Тексты запросов не накапливаются, поэтому память не растёт, как connection.queries при DEBUG.
+Текущий HTTP-запрос хранится в contextvars и вместе с контекстом переходит в потоки асинхронных страниц.
+
+Итог отдаётся заголовком Server-Timing и строкой журнала mail_box.sql (INFO). Запросы дольше
+MAILBOX_SLOW_QUERY_MS записываются в тот же журнал (WARNING) с текстом без параметров и страницей.
+Потоковые ответы (StreamingHttpResponse) выполняют запросы и во время отдачи тела, когда заголовки уже отправлены:
+эти запросы тоже учитываются, а строка журнала пишется при закрытии ответа, без заголовка Server-Timing.
+"""
+import asyncio
+import logging
+import time
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.utils.decorators import sync_and_async_middleware
+
+logger = logging.getLogger("mail_box.sql")
+
+
+class QueryStats:
+    """Запросы к базе одного HTTP-запроса"""
+
+    def __init__(self, request):
+        self.request = request
+        self.count = 0
+        self.duration = 0.0  # секунды
+        self.duplicates = 0
+        self._seen = set()  # хэши уже выполненных запросов
+
+    def add(self, sql: str, params, many: bool, duration: float):
+        self.count += 1
+        self.duration += duration
+        if many:
+            return
+        key = hash((sql, repr(params)))
+        if key in self._seen:
+            self.duplicates += 1
+        else:
+            self._seen.add(key)
+
+
+_current: "ContextVar[Optional[QueryStats]]" = ContextVar("mailbox_query_stats", default=None)
+
+
+def view_name(request) -> str:
+    """Путь к функции страницы, а если адрес ещё не разобран - путь запроса"""
+    match = getattr(request, "resolver_match", None)
+    if match is None:
+        return request.path
+    func = match.func
+    return f"{func.__module__}.{getattr(func, '__qualname__', type(func).__qualname__)}"
+
+
+def _instrument(execute, sql, params, many, context):
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    started = time.perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        duration = time.perf_counter() - started
+        stats.add(sql, params, many, duration)
+        threshold = settings.MAILBOX_SLOW_QUERY_MS
+        if threshold is not None and duration * 1000 >= threshold:
+            # параметры не пишутся: в них бывают тексты писем и адреса
+            logger.warning("Медленный запрос: view=%s db=%s ms=%.1f sql=%s", view_name(stats.request),
+                           context["connection"].alias, duration * 1000, sql,
+                           extra={"view": view_name(stats.request), "sql": sql, "sql_duration_ms": duration * 1000})
+
+
+def install_query_wrapper(sender, connection, **kwargs):
+    """Обработчик connection_created: добавляет обёртку учёта запросов соединению"""
+    if _instrument not in connection.execute_wrappers:
+        connection.execute_wrappers.append(_instrument)
+
+
+def _counted(stats: "QueryStats", content):
+    """Тело потокового ответа, запросы при выдаче каждого куска которого учитываются в stats"""
+    iterator = iter(content)
+    while True:
+        token = _current.set(stats)
+        try:
+            chunk = next(iterator)
+        except StopIteration:
+            return
+        finally:
+            _current.reset(token)
+        yield chunk
+
+
+def _finish(stats: "QueryStats", response):
+    if response.streaming:
+        response.streaming_content = _counted(stats, response.streaming_content)
+        response._resource_closers.append(lambda: _log(stats, response))
+        return response
+    if settings.MAILBOX_SERVER_TIMING:
+        metric = f'db;dur={stats.duration * 1000:.1f};desc="{stats.count} queries, {stats.duplicates} duplicates"'
+        if response.has_header("Server-Timing"):
+            metric = f"{response['Server-Timing']}, {metric}"
+        response["Server-Timing"] = metric
+    _log(stats, response)
+    return response
+
+
+def _log(stats: "QueryStats", response):
+    duration_ms = stats.duration * 1000
+    request = stats.request
+    logger.info("Запросы к базе: method=%s path=%s view=%s status=%s queries=%d duplicates=%d db_ms=%.1f",
+                request.method, request.path, view_name(request), response.status_code,
+                stats.count, stats.duplicates, duration_ms,
+                extra={"view": view_name(request), "path": request.path, "status": response.status_code,
+                       "sql_queries": stats.count, "sql_duplicates": stats.duplicates,
+                       "sql_duration_ms": duration_ms})
+
+
+@sync_and_async_middleware
+def query_instrumentation_middleware(get_response):
+    """Считает запросы к базе каждого HTTP-запроса; синхронная и асинхронная версии, чтобы не менять режим страниц"""
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            stats = QueryStats(request)
+            token = _current.set(stats)
+            try:
+                response = await get_response(request)
+            finally:
+                _current.reset(token)
+            return _finish(stats, response)
+    else:
+        def middleware(request):
+            stats = QueryStats(request)
+            token = _current.set(stats)
+            try:
+                response = get_response(request)
+            finally:
+                _current.reset(token)
+            return _finish(stats, response)
+    return middleware
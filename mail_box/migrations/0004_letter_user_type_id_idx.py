@@ -0,0 +1,27 @@
+# Generated by Django 3.0.1 on 2026-10-18 13:23
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_box', '0003_auto_20191223_0948'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='letter',
+            name='type',
+            field=models.CharField(choices=[('ВХД', 'INCOMING'), ('ИСХ', 'OUTGOING')], max_length=3),
+        ),
+        migrations.AlterField(
+            model_name='message',
+            name='text',
+            field=models.CharField(max_length=900),
+        ),
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(fields=['user', 'type', 'id'], name='letter_user_type_id_idx'),
+        ),
+    ]
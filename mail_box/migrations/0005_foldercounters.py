@@ -0,0 +1,25 @@
+# Generated by Django 3.0.1 on 2026-10-18 13:24
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        ('mail_box', '0004_letter_user_type_id_idx'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='FolderCounters',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='folder_counters', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('unread_incoming', models.IntegerField(default=0)),
+                ('total_incoming', models.IntegerField(default=0)),
+                ('total_sent', models.IntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.1 on 2026-10-18 13:31
+
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_box', '0005_foldercounters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DeliveryJob',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('recipient_ids', models.TextField()),
+                ('status', models.CharField(choices=[('pending', 'PENDING'), ('running', 'RUNNING'), ('done', 'DONE'), ('failed', 'FAILED')], default='pending', max_length=7)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('last_error', models.TextField(blank=True)),
+                ('run_after', models.DateTimeField(default=django.utils.timezone.now)),
+                ('locked_at', models.DateTimeField(blank=True, null=True)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='delivery_jobs', to='mail_box.Message')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='deliveryjob',
+            index=models.Index(fields=['status', 'run_after'], name='deliveryjob_status_run_idx'),
+        ),
+    ]
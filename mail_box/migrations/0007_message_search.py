@@ -0,0 +1,74 @@
+# Generated by Django 3.0.1 on 2026-10-18 13:34
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+# Полнотекстовый индекс sqlite по заголовку и тексту сообщений.
+# Таблица хранит только индекс (content= ссылается на mail_box_message),
+# а триггеры поддерживают его при любой вставке и удалении сообщений.
+FTS5_SQL = [
+    "CREATE VIRTUAL TABLE mail_box_message_fts USING fts5("
+    "header, text, content='mail_box_message', content_rowid='id', tokenize='unicode61')",
+    "CREATE TRIGGER mail_box_message_fts_insert AFTER INSERT ON mail_box_message BEGIN "
+    "INSERT INTO mail_box_message_fts(rowid, header, text) VALUES (new.id, new.header, new.text); END",
+    "CREATE TRIGGER mail_box_message_fts_delete AFTER DELETE ON mail_box_message BEGIN "
+    "INSERT INTO mail_box_message_fts(mail_box_message_fts, rowid, header, text) "
+    "VALUES ('delete', old.id, old.header, old.text); END",
+    "CREATE TRIGGER mail_box_message_fts_update AFTER UPDATE ON mail_box_message BEGIN "
+    "INSERT INTO mail_box_message_fts(mail_box_message_fts, rowid, header, text) "
+    "VALUES ('delete', old.id, old.header, old.text); "
+    "INSERT INTO mail_box_message_fts(rowid, header, text) VALUES (new.id, new.header, new.text); END",
+    # индексирование уже существующих сообщений
+    "INSERT INTO mail_box_message_fts(mail_box_message_fts) VALUES ('rebuild')",
+]
+
+FTS5_DROP_SQL = [
+    "DROP TRIGGER IF EXISTS mail_box_message_fts_insert",
+    "DROP TRIGGER IF EXISTS mail_box_message_fts_delete",
+    "DROP TRIGGER IF EXISTS mail_box_message_fts_update",
+    "DROP TABLE IF EXISTS mail_box_message_fts",
+]
+
+
+def fts5_available(schema_editor) -> bool:
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite":
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("PRAGMA compile_options")
+        return any(option == "ENABLE_FTS5" for option, in cursor.fetchall())
+
+
+def create_fts5_index(apps, schema_editor):
+    if fts5_available(schema_editor):
+        for sql in FTS5_SQL:
+            schema_editor.execute(sql)
+
+
+def drop_fts5_index(apps, schema_editor):
+    if schema_editor.connection.vendor == "sqlite":
+        for sql in FTS5_DROP_SQL:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('mail_box', '0006_deliveryjob'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='MessageTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=64)),
+                ('weight', models.PositiveIntegerField(default=1)),
+                ('message', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='mail_box.Message')),
+            ],
+            options={
+                'unique_together': {('term', 'message')},
+            },
+        ),
+        migrations.RunPython(create_fts5_index, drop_fts5_index),
+    ]
@@ -0,0 +1,67 @@
+from django.db import migrations, models
+
+# Старые строковые коды папок и новые целые
+TYPE_CODES = {"ВХД": 1, "ИСХ": 2}
+
+
+def type_to_code(apps, schema_editor):
+    Letter = apps.get_model("mail_box", "Letter")
+    for name, code in TYPE_CODES.items():
+        Letter.objects.filter(type=name).update(type_code=code)
+
+
+def code_to_type(apps, schema_editor):
+    Letter = apps.get_model("mail_box", "Letter")
+    for name, code in TYPE_CODES.items():
+        Letter.objects.filter(type_code=code).update(type=name)
+
+
+class Migration(migrations.Migration):
+    """
+    Папка письма хранится целым кодом вместо строки "ВХД"/"ИСХ".
+    Поле заменяется через временное type_code, чтобы перенести значения отдельным UPDATE на каждую папку.
+    """
+
+    dependencies = [
+        ('mail_box', '0007_message_search'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='letter',
+            name='letter_user_type_id_idx',
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='type_code',
+            field=models.PositiveSmallIntegerField(null=True),
+        ),
+        migrations.AlterField(
+            model_name='letter',
+            name='type',
+            field=models.CharField(max_length=3, null=True),
+        ),
+        migrations.RunPython(type_to_code, code_to_type),
+        migrations.RemoveField(
+            model_name='letter',
+            name='type',
+        ),
+        migrations.RenameField(
+            model_name='letter',
+            old_name='type_code',
+            new_name='type',
+        ),
+        migrations.AlterField(
+            model_name='letter',
+            name='type',
+            field=models.PositiveSmallIntegerField(choices=[(1, 'INCOMING'), (2, 'OUTGOING')]),
+        ),
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(fields=['user', 'type', 'id'], name='letter_user_type_id_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='letter',
+            index=models.Index(condition=models.Q(is_read=False), fields=['user', 'type', 'is_read'], name='letter_unread_idx'),
+        ),
+    ]
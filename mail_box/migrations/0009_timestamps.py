@@ -0,0 +1,30 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+    """
+    Поля времени добавляются допускающими NULL: на PostgreSQL это изменение только схемы,
+    без перезаписи таблицы. Заполняются они следующей миграцией пакетами.
+    """
+
+    dependencies = [
+        ('mail_box', '0008_letter_type_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='message',
+            name='sent_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='created_at',
+            field=models.DateTimeField(null=True),
+        ),
+        migrations.AddField(
+            model_name='letter',
+            name='updated_at',
+            field=models.DateTimeField(null=True),
+        ),
+    ]
@@ -0,0 +1,39 @@
+from django.db import migrations, transaction
+from django.db.models import OuterRef, Subquery
+from django.utils import timezone
+
+BATCH_SIZE = 10000
+
+
+def _batches(model):
+    """Диапазоны id по BATCH_SIZE: каждый пакет - короткая транзакция, таблица целиком не блокируется"""
+    last_id = model.objects.order_by("-id").values_list("id", flat=True).first() or 0
+    for start in range(0, last_id, BATCH_SIZE):
+        yield start, start + BATCH_SIZE
+
+
+def backfill_timestamps(apps, schema_editor):
+    Message = apps.get_model("mail_box", "Message")
+    Letter = apps.get_model("mail_box", "Letter")
+    # настоящее время отправки старых писем неизвестно, им ставится время миграции
+    now = timezone.now()
+    for start, end in _batches(Message):
+        with transaction.atomic():
+            Message.objects.filter(id__gt=start, id__lte=end, sent_at__isnull=True).update(sent_at=now)
+    sent_at = Subquery(Message.objects.filter(id=OuterRef("message_id")).values("sent_at")[:1])
+    for start, end in _batches(Letter):
+        with transaction.atomic():
+            Letter.objects.filter(id__gt=start, id__lte=end, created_at__isnull=True) \
+                .update(created_at=sent_at, updated_at=sent_at)
+
+
+class Migration(migrations.Migration):
+    atomic = False
+
+    dependencies = [
+        ('mail_box', '0009_timestamps'),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_timestamps, migrations.RunPython.noop),
+    ]
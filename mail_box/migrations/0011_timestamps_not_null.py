@@ -0,0 +1,62 @@
+from importlib import import_module
+
+import django.utils.timezone
+from django.db import migrations, models
+
+message_search = import_module("mail_box.migrations.0007_message_search")
+
+
+class AddIndexOnline(migrations.AddIndex):
+    """На PostgreSQL индекс строится CONCURRENTLY, не блокируя запись в таблицу"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != "postgresql":
+            return super().database_forwards(app_label, schema_editor, from_state, to_state)
+        model = to_state.apps.get_model(app_label, self.model_name)
+        if self.allow_migrate_model(schema_editor.connection.alias, model):
+            schema_editor.add_index(model, self.index, concurrently=True)
+
+
+def restore_fts5_triggers(apps, schema_editor):
+    """
+    sqlite меняет столбцы пересозданием таблицы mail_box_message, и триггеры полнотекстового индекса
+    удаляются вместе со старой таблицей. Содержимое индекса не меняется: id и тексты сообщений прежние.
+    """
+    connection = schema_editor.connection
+    if connection.vendor != "sqlite" or "mail_box_message_fts" not in connection.introspection.table_names():
+        return
+    for sql in message_search.FTS5_SQL:
+        if sql.startswith("CREATE TRIGGER"):
+            schema_editor.execute(sql.replace("CREATE TRIGGER", "CREATE TRIGGER IF NOT EXISTS", 1))
+
+
+class Migration(migrations.Migration):
+    # CREATE INDEX CONCURRENTLY нельзя выполнять в транзакции
+    atomic = False
+
+    dependencies = [
+        ('mail_box', '0010_backfill_timestamps'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='message',
+            name='sent_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='letter',
+            name='created_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AlterField(
+            model_name='letter',
+            name='updated_at',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        AddIndexOnline(
+            model_name='letter',
+            index=models.Index(fields=['user', 'type', 'created_at'], name='letter_user_type_created_idx'),
+        ),
+        migrations.RunPython(restore_fts5_triggers, migrations.RunPython.noop),
+    ]
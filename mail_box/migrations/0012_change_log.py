@@ -0,0 +1,41 @@
+# Generated by Django 3.0.1 on 2026-10-18 13:56
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('accounts', '0001_initial'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mail_box', '0011_timestamps_not_null'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeSequence',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='change_sequence', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('last_seq', models.BigIntegerField(default=0)),
+                ('compacted_seq', models.BigIntegerField(default=0)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='LetterChange',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('seq', models.BigIntegerField()),
+                ('letter_id', models.IntegerField()),
+                ('letter_type', models.PositiveSmallIntegerField(choices=[(1, 'INCOMING'), (2, 'OUTGOING')])),
+                ('kind', models.PositiveSmallIntegerField(choices=[(1, 'CREATED'), (2, 'READ'), (3, 'UNREAD'), (4, 'DELETED')])),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'seq')},
+            },
+        ),
+    ]
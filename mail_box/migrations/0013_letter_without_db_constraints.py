@@ -0,0 +1,26 @@
+# Generated by Django 3.1.14 on 2026-10-18 14:21
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mail_box', '0012_change_log'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='letter',
+            name='message',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.PROTECT, related_name='+', to='mail_box.message'),
+        ),
+        migrations.AlterField(
+            model_name='letter',
+            name='user',
+            field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='letters_set', to=settings.AUTH_USER_MODEL),
+        ),
+    ]
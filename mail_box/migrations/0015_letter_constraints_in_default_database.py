@@ -0,0 +1,43 @@
+from django.conf import settings
+from django.db import migrations, models, DEFAULT_DB_ALIAS
+import django.db.models.deletion
+
+
+class AlterFieldInDefaultDatabase(migrations.AlterField):
+    """Меняет поле только в основной базе, в базах писем (mail_box.shards) оно остаётся прежним"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.alias == DEFAULT_DB_ALIAS:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.alias == DEFAULT_DB_ALIAS:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    """
+    0013 убрала ограничения внешних ключей писем во всех базах, хотя нужно это только в базах писем шардов:
+    там письма ссылаются на пользователей и сообщения другой базы. В основной базе ограничения возвращаются.
+    Состояние модели не меняется (db_constraint=False), чтобы следующие миграции не добавляли их в базы писем.
+    """
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mail_box', '0014_archive_segment'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(database_operations=[
+            AlterFieldInDefaultDatabase(
+                model_name='letter',
+                name='message',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='mail_box.message'),
+            ),
+            AlterFieldInDefaultDatabase(
+                model_name='letter',
+                name='user',
+                field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='letters_set', to=settings.AUTH_USER_MODEL),
+            ),
+        ]),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 3.1.14 on 2026-10-18 14:55
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mail_box', '0015_letter_constraints_in_default_database'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedLetterDeletion',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('letter_id', models.PositiveIntegerField()),
+                ('deleted_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'unique_together': {('user', 'letter_id')},
+            },
+        ),
+    ]
@@ -0,0 +1,75 @@
+import os
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def fill_ranges(apps, schema_editor):
+    """Диапазоны id писем пользователей в уже записанных сегментах - из индексов самих файлов"""
+    from mail_box.archive import Segment, ArchiveError
+
+    ArchiveSegmentUser = apps.get_model("mail_box", "ArchiveSegmentUser")
+    rows = ArchiveSegmentUser.objects.select_related("segment").order_by("segment_id")
+    segment = None
+    for row in rows.iterator():
+        if segment is None or segment[0] != row.segment_id:
+            try:
+                segment = (row.segment_id, Segment(os.path.join(settings.MAILBOX_ARCHIVE_DIR, row.segment.name)))
+            except (OSError, ArchiveError):
+                # сегмент без файла не читался и раньше, с пустым диапазоном он не открывается
+                segment = (row.segment_id, None)
+        index = segment[1].user_index(row.user_id) if segment[1] is not None else []
+        if index:
+            row.min_letter_id, row.max_letter_id, row.letters = index[0][0], index[-1][0], len(index)
+            row.save(update_fields=["min_letter_id", "max_letter_id", "letters"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('mail_box', '0016_archived_letter_deletion'),
+    ]
+
+    operations = [
+        # таблица связи ArchiveSegment.users остаётся прежней, у неё появляется модель
+        migrations.SeparateDatabaseAndState(state_operations=[
+            migrations.CreateModel(
+                name='ArchiveSegmentUser',
+                fields=[
+                    ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                    ('segment', models.ForeignKey(db_column='archivesegment_id', on_delete=django.db.models.deletion.CASCADE, to='mail_box.archivesegment')),
+                    ('user', models.ForeignKey(db_column='mailboxuser_id', on_delete=django.db.models.deletion.CASCADE, to=settings.AUTH_USER_MODEL)),
+                ],
+                options={
+                    'db_table': 'mail_box_archivesegment_users',
+                    'unique_together': {('segment', 'user')},
+                },
+            ),
+            migrations.AlterField(
+                model_name='archivesegment',
+                name='users',
+                field=models.ManyToManyField(related_name='archive_segments', through='mail_box.ArchiveSegmentUser', to=settings.AUTH_USER_MODEL),
+            ),
+        ]),
+        migrations.AddField(
+            model_name='archivesegmentuser',
+            name='min_letter_id',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='archivesegmentuser',
+            name='max_letter_id',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.AddField(
+            model_name='archivesegmentuser',
+            name='letters',
+            field=models.PositiveIntegerField(default=0),
+            preserve_default=False,
+        ),
+        migrations.RunPython(fill_ranges, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,45 @@
+from django.db import migrations, models, DEFAULT_DB_ALIAS
+import django.db.models.deletion
+
+
+class AlterFieldInLetterDatabases(migrations.AlterField):
+    """Меняет поле только в базах писем (mail_box.shards), в основной базе оно остаётся прежним"""
+
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.alias != DEFAULT_DB_ALIAS:
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+class Migration(migrations.Migration):
+    """
+    В базах писем хранится копия поискового индекса сообщений их писем (mail_box.search),
+    а сами сообщения - в основной базе, поэтому ограничение внешнего ключа там убирается.
+    В основной базе ограничение остаётся.
+    """
+
+    dependencies = [
+        ('mail_box', '0017_archive_segment_user_ranges'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.AlterField(
+                    model_name='messageterm',
+                    name='message',
+                    field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='mail_box.message'),
+                ),
+            ],
+            database_operations=[
+                AlterFieldInLetterDatabases(
+                    model_name='messageterm',
+                    name='message',
+                    field=models.ForeignKey(db_constraint=False, on_delete=django.db.models.deletion.CASCADE, related_name='search_terms', to='mail_box.message'),
+                ),
+            ],
+        ),
+    ]
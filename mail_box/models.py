@@ -1,22 +1,48 @@
+from collections import Counter
 from enum import Enum
+from typing import Dict, List, Tuple
 
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models import Count, F, Q, Exists, OuterRef
+from django.utils import timezone
 
+from mail_box.shards import shard_for_user, group_by_shard, letter_databases
 from mailbox_project import settings
 
 
 class EmailTypes(Enum):
-    INCOMING = "ВХД"
-    OUTGOING = "ИСХ"
-
-    @classmethod
-    def str_to_constant(cls, string: str):
-        for const in cls:
-            if const.value == string:
-                return const
-        else:
-            raise RuntimeError()
+    """Папка письма. Хранится в письме небольшим целым кодом."""
+    INCOMING = 1
+    OUTGOING = 2
+
+
+# Названия папок в адресах и API и соответствующие им типы писем
+FOLDERS = {
+    "inbox": EmailTypes.INCOMING,
+    "sent": EmailTypes.OUTGOING,
+}
+
+
+class MessageQuerySet(models.QuerySet):
+
+    def orphans(self):
+        """
+        Сообщения, на которые не ссылается ни одно письмо.
+        Такое бывает, когда отправитель и все адресаты удалили свои письма.
+        """
+        # у сообщения, ожидающего доставки, писем адресатов ещё может не быть
+        has_jobs = Exists(DeliveryJob.objects.filter(message_id=OuterRef("pk")).exclude(status=DeliveryStatus.DONE.value))
+        shards = letter_databases()
+        if shards == [None]:
+            return self.filter(~Exists(Letter.objects.filter(message_id=OuterRef("pk"))), ~has_jobs)
+        # письма в других базах: подзапрос невозможен, ссылки проверяются в каждой базе писем
+        candidates = list(self.filter(~has_jobs).values_list("id", flat=True))
+        referenced = set()
+        for alias in shards:
+            referenced.update(Letter.objects.using(alias).filter(message_id__in=candidates)
+                              .values_list("message_id", flat=True).distinct())
+        return self.filter(id__in=set(candidates) - referenced)
 
 
 class Message(models.Model):
@@ -28,6 +54,56 @@ class Message(models.Model):
     sender = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.PROTECT, related_name="sent_messages_set")
     header = models.CharField(max_length=70)
     text = models.CharField(max_length=900)
+    sent_at = models.DateTimeField(default=timezone.now)
+
+    objects = MessageQuerySet.as_manager()
+
+
+class LetterQuerySet(models.QuerySet):
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._with_content = False
+
+    def _clone(self):
+        clone = super()._clone()
+        clone._with_content = self._with_content
+        return clone
+
+    def with_content(self):
+        """
+        Письма вместе с содержимым, отправителем и адресатами.
+        Сообщения берутся из общего кэша сообщений (mail_box.message_cache),
+        недостающие - одним запросом и одним запросом адресатов, отправители и адресаты - одним запросом,
+        поэтому число запросов не зависит от количества писем в выборке.
+        """
+        clone = self._chain()
+        clone._with_content = True
+        return clone
+
+    def on_shard_of(self, user):
+        """Запрос в базе, где хранятся письма пользователя (user - пользователь или его id)"""
+        return self.using(shard_for_user(getattr(user, "pk", user)))
+
+    def for_user(self, user):
+        """Письма пользователя из базы его писем"""
+        user_id = getattr(user, "pk", user)
+        return self.on_shard_of(user_id).filter(user_id=user_id)
+
+    def created_between(self, since=None, until=None):
+        """Письма, полученные или отправленные в полуинтервале [since, until)"""
+        queryset = self
+        if since is not None:
+            queryset = queryset.filter(created_at__gte=since)
+        if until is not None:
+            queryset = queryset.filter(created_at__lt=until)
+        return queryset
+
+    def _fetch_all(self):
+        fetched = self._result_cache is None
+        super()._fetch_all()
+        if fetched and self._with_content and self._iterable_class is models.query.ModelIterable:
+            attach_messages(self._result_cache)
 
 
 class Letter(models.Model):
@@ -40,10 +116,326 @@ class Letter(models.Model):
     связанных с удалением пользователей и удалением ими писем.
     """
 
-    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="letters_set")
-    message = models.ForeignKey("Message", on_delete=models.PROTECT, related_name="+")
-    type = models.CharField(max_length=3, choices=[(code.value, code.name) for code in EmailTypes])
+    # при шардировании письма хранятся не в базе пользователей и сообщений (mail_box.shards),
+    # поэтому в базах писем ограничений внешнего ключа нет, CASCADE и PROTECT выполняет django;
+    # в основной базе ограничения есть (миграция 0015)
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="letters_set",
+                             db_constraint=False)
+    message = models.ForeignKey("Message", on_delete=models.PROTECT, related_name="+", db_constraint=False)
+    type = models.PositiveSmallIntegerField(choices=[(code.value, code.name) for code in EmailTypes])
     is_read = models.BooleanField(default=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    # письма меняются условными UPDATE (отметка о прочтении), поэтому время изменения передаётся в них явно
+    updated_at = models.DateTimeField(default=timezone.now)
+
+    objects = LetterQuerySet.as_manager()
+
+    class Meta:
+        indexes = [
+            # Постраничный вывод папки - это проход по диапазону этого индекса
+            models.Index(fields=["user", "type", "id"], name="letter_user_type_id_idx"),
+            # Частичный индекс только по непрочитанным: подсчёт непрочитанных отвечается по индексу,
+            # без чтения строк писем, а сам индекс мал, так как большинство писем прочитаны
+            models.Index(fields=["user", "type", "is_read"], condition=Q(is_read=False), name="letter_unread_idx"),
+            # Письма папки за период и "письма после момента T" - проход по диапазону этого индекса
+            models.Index(fields=["user", "type", "created_at"], name="letter_user_type_created_idx"),
+        ]
+
+    # письма, прочитанные из архива (mail_box.archive): строк в таблице писем у них нет, их можно только удалить
+    archived = False
 
     def get_type(self) -> "EmailTypes":
-        return EmailTypes.str_to_constant(self.type)
+        return EmailTypes(self.type)
+
+
+class FolderCountersManager(models.Manager):
+
+    def _count_from_letters(self, user_ids) -> "dict":
+        """Подсчёт значений счётчиков непосредственно по письмам. Один запрос с группировкой на базу писем."""
+        incoming = Q(type=EmailTypes.INCOMING.value)
+        counted = {}
+        for alias, shard_user_ids in group_by_shard(user_ids).items():
+            rows = Letter.objects.using(alias).filter(user_id__in=shard_user_ids).values("user_id").annotate(
+                unread_incoming=Count("id", filter=incoming & Q(is_read=False)),
+                total_incoming=Count("id", filter=incoming),
+                total_sent=Count("id", filter=Q(type=EmailTypes.OUTGOING.value)),
+            ).order_by()
+            counted.update((row.pop("user_id"), row) for row in rows)
+        return counted
+
+    def _build(self, user_ids) -> "List[FolderCounters]":
+        counted = self._count_from_letters(user_ids)
+        return [self.model(user_id=user_id, **counted.get(user_id, {})) for user_id in user_ids]
+
+    def ensure(self, user_ids):
+        """
+        Создаёт недостающие счётчики, посчитав их по письмам.
+        Вызывается до изменения писем, чтобы последующее приращение не учлось дважды.
+        """
+        user_ids = set(user_ids)
+        existing = set(self.filter(user_id__in=user_ids).values_list("user_id", flat=True))
+        missing = user_ids - existing
+        if missing:
+            self.bulk_create(self._build(missing), ignore_conflicts=True)
+
+    def rebuild(self, user_ids):
+        """Пересчитывает счётчики пользователей по письмам, исправляя расхождения."""
+        user_ids = list(user_ids)
+        self.filter(user_id__in=user_ids).delete()
+        self.bulk_create(self._build(user_ids))
+
+    def get_for_user(self, user) -> "FolderCounters":
+        """Счётчики пользователя. В обычном случае - один запрос по первичному ключу."""
+        counters = self.filter(user_id=user.pk).first()
+        if counters is None:
+            self.ensure([user.pk])
+            counters = self.get(user_id=user.pk)
+        return counters
+
+    def letter_sent(self, sender_id):
+        self.add(sender_id, total_sent=1)
+
+    def letters_received(self, recipient_ids):
+        """Приращение счётчиков входящих для пакета адресатов одним UPDATE."""
+        self.ensure(recipient_ids)
+        self.filter(user_id__in=recipient_ids).update(
+            unread_incoming=F("unread_incoming") + 1,
+            total_incoming=F("total_incoming") + 1,
+        )
+
+    def add(self, user_id, **deltas):
+        """
+        Приращение счётчиков пользователя одним UPDATE.
+        Вызывается до изменения писем, чтобы недостающий счётчик был посчитан по старому состоянию.
+        """
+        deltas = {name: F(name) + delta for name, delta in deltas.items() if delta}
+        if deltas:
+            self.ensure([user_id])
+            self.filter(user_id=user_id).update(**deltas)
+
+    def letter_read(self, letter: "Letter"):
+        """Вызывается, только если письмо было непрочитанным."""
+        if letter.get_type() is EmailTypes.INCOMING:
+            self.add(letter.user_id, unread_incoming=-1)
+
+    def letter_unread(self, letter: "Letter"):
+        """Вызывается, только если письмо было прочитанным."""
+        if letter.get_type() is EmailTypes.INCOMING:
+            self.add(letter.user_id, unread_incoming=1)
+
+    def letter_deleted(self, letter: "Letter"):
+        """Вызывается до удаления письма."""
+        if letter.get_type() is EmailTypes.INCOMING:
+            self.add(letter.user_id, unread_incoming=0 if letter.is_read else -1, total_incoming=-1)
+        else:
+            self.add(letter.user_id, total_sent=-1)
+
+
+class FolderCounters(models.Model):
+    """
+    Денормализованные счётчики папок пользователя.
+    Нужны, чтобы не считать письма при каждом открытии главной страницы.
+    Поддерживаются методами отправки, прочтения и удаления писем в их транзакциях,
+    при расхождении пересчитываются командой rebuild_folder_counters.
+    """
+
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name="folder_counters")
+    unread_incoming = models.IntegerField(default=0)
+    total_incoming = models.IntegerField(default=0)
+    total_sent = models.IntegerField(default=0)
+
+    objects = FolderCountersManager()
+
+
+class DeliveryStatus(Enum):
+    PENDING = "pending"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+
+
+class DeliveryJob(models.Model):
+    """
+    Задание очереди доставки: создать входящие письма сообщения для пакета адресатов.
+    Очередь хранится в базе, поэтому отдельный брокер не нужен.
+    Задания выполняет команда deliver_mail.
+    """
+
+    message = models.ForeignKey("Message", on_delete=models.CASCADE, related_name="delivery_jobs")
+    # id адресатов через запятую. Размер пакета ограничен MAILBOX_FANOUT_BATCH_SIZE.
+    recipient_ids = models.TextField()
+    status = models.CharField(max_length=7, choices=[(code.value, code.name) for code in DeliveryStatus],
+                              default=DeliveryStatus.PENDING.value)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+    run_after = models.DateTimeField(default=timezone.now)
+    locked_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        indexes = [
+            # выбор следующего задания - проход по этому индексу
+            models.Index(fields=["status", "run_after"], name="deliveryjob_status_run_idx"),
+        ]
+
+    def get_recipient_ids(self) -> "List[int]":
+        return [int(user_id) for user_id in self.recipient_ids.split(",") if user_id]
+
+    def get_status(self) -> "DeliveryStatus":
+        return DeliveryStatus(self.status)
+
+
+class MessageTerm(models.Model):
+    """
+    Запись обратного индекса для поиска по письмам: слово и сообщение, в котором оно встречается.
+    Используется, когда база не поддерживает полнотекстовый индекс (sqlite FTS5).
+    weight - сколько раз слово встречается в сообщении, слова заголовка считаются с большим весом.
+    """
+
+    term = models.CharField(max_length=64)
+    # при шардировании в базах писем хранится копия индекса их сообщений (mail_box.search), а сообщения -
+    # в основной базе, поэтому ограничения внешнего ключа в базах писем нет; в основной базе оно есть (миграция 0018)
+    message = models.ForeignKey("Message", on_delete=models.CASCADE, related_name="search_terms",
+                                db_constraint=False)
+    weight = models.PositiveIntegerField(default=1)
+
+    class Meta:
+        unique_together = [("term", "message")]
+
+
+class ArchiveSegment(models.Model):
+    """
+    Файл архива писем в MAILBOX_ARCHIVE_DIR (mail_box.archive).
+    Файл пишется один раз до фиксации этой строки и дальше не меняется;
+    файл без строки (архивация прервалась) не читается. users - пользователи, чьи письма есть в файле.
+    """
+
+    name = models.CharField(max_length=64, unique=True)
+    users = models.ManyToManyField(settings.AUTH_USER_MODEL, related_name="archive_segments",
+                                   through="ArchiveSegmentUser")
+    letters = models.PositiveIntegerField()
+    created_at = models.DateTimeField(default=timezone.now)
+
+
+class ArchiveSegmentUser(models.Model):
+    """
+    Письма пользователя в сегменте архива: диапазон их id и количество.
+    По диапазонам для страницы или письма открываются только сегменты, в которых могут быть нужные письма.
+    """
+
+    segment = models.ForeignKey(ArchiveSegment, on_delete=models.CASCADE, db_column="archivesegment_id")
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, db_column="mailboxuser_id")
+    min_letter_id = models.PositiveIntegerField()
+    max_letter_id = models.PositiveIntegerField()
+    letters = models.PositiveIntegerField()
+
+    class Meta:
+        # таблица связи, созданная для ArchiveSegment.users без модели (миграция 0014)
+        db_table = "mail_box_archivesegment_users"
+        unique_together = [("segment", "user")]
+
+
+class ArchivedLetterDeletion(models.Model):
+    """
+    Отметка об удалении архивного письма (mail_box.archive).
+    Файлы сегментов не меняются, поэтому удалённые письма отбрасываются при чтении архива пользователя.
+    """
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    letter_id = models.PositiveIntegerField()
+    deleted_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        unique_together = [("user", "letter_id")]
+
+
+class ChangeKinds(Enum):
+    """Вид изменения письма в журнале изменений"""
+    CREATED = 1
+    READ = 2
+    UNREAD = 3
+    DELETED = 4
+
+
+class ChangeSequenceManager(models.Manager):
+
+    def allocate(self, counts: "Dict[int, int]") -> "Dict[int, int]":
+        """
+        Выделяет пользователям номера изменений: counts - сколько номеров нужно каждому пользователю.
+        Возвращает последний выделенный номер каждого пользователя, выделены номера с last - count + 1 по last.
+        Вызывается в транзакции изменения писем: UPDATE блокирует строку пользователя до её фиксации,
+        поэтому номера одного пользователя фиксируются строго по возрастанию и клиент не пропустит изменение.
+        """
+        self.bulk_create([self.model(user_id=user_id) for user_id in counts], ignore_conflicts=True)
+        by_count = {}
+        for user_id, count in counts.items():
+            by_count.setdefault(count, []).append(user_id)
+        for count, user_ids in by_count.items():
+            self.filter(user_id__in=user_ids).update(last_seq=F("last_seq") + count)
+        return dict(self.filter(user_id__in=counts).values_list("user_id", "last_seq"))
+
+
+class ChangeSequence(models.Model):
+    """
+    Счётчик изменений писем пользователя.
+    last_seq - номер последнего изменения, compacted_seq - номер, до которого (включительно)
+    журнал удалён сжатием: клиенту с более старым номером нужна полная синхронизация.
+    """
+
+    user = models.OneToOneField(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, primary_key=True,
+                                related_name="change_sequence")
+    last_seq = models.BigIntegerField(default=0)
+    compacted_seq = models.BigIntegerField(default=0)
+
+    objects = ChangeSequenceManager()
+
+
+class LetterChangeManager(models.Manager):
+
+    def record(self, kind: "ChangeKinds", rows: "List[Tuple[int, int, int]]") -> "Dict[int, int]":
+        """
+        Записывает изменения писем одной вставкой.
+        rows - тройки (владелец, id письма, тип письма); изменения одного владельца нумеруются по порядку.
+        Возвращает номер последнего записанного изменения каждого владельца.
+        """
+        if not rows:
+            return {}
+        counts = Counter(user_id for user_id, _, _ in rows)
+        last_seq = ChangeSequence.objects.allocate(counts)
+        next_seq = {user_id: last_seq[user_id] - count + 1 for user_id, count in counts.items()}
+        changes = []
+        for user_id, letter_id, letter_type in rows:
+            changes.append(self.model(user_id=user_id, seq=next_seq[user_id], letter_id=letter_id,
+                                      letter_type=letter_type, kind=kind.value))
+            next_seq[user_id] += 1
+        self.bulk_create(changes)
+        return last_seq
+
+
+class LetterChange(models.Model):
+    """
+    Запись журнала изменений писем пользователя: письмо появилось, прочитано, отмечено непрочитанным или удалено.
+    Журнал только дополняется; клиенты (IMAP/POP) запрашивают изменения после известного им номера,
+    поэтому опрос стоит пропорционально числу изменений, а не размеру папки.
+    Письмо может быть уже удалено, поэтому ссылка на него - просто id.
+    """
+
+    user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE, related_name="+")
+    seq = models.BigIntegerField()
+    letter_id = models.IntegerField()
+    letter_type = models.PositiveSmallIntegerField(choices=[(code.value, code.name) for code in EmailTypes])
+    kind = models.PositiveSmallIntegerField(choices=[(code.value, code.name) for code in ChangeKinds])
+    created_at = models.DateTimeField(default=timezone.now)
+
+    objects = LetterChangeManager()
+
+    class Meta:
+        # выдача изменений после номера - проход по диапазону этого индекса
+        unique_together = [("user", "seq")]
+
+    def get_kind(self) -> "ChangeKinds":
+        return ChangeKinds(self.kind)
+
+
+# импорт размещён здесь намеренно: кэш сообщений сам использует модели этого модуля
+from mail_box.message_cache import attach_messages
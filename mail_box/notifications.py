@@ -0,0 +1,84 @@
+"""
+Уведомления о новых письмах для открытых соединений (mail_box.events).
+
+Подписки хранятся в памяти процесса: соединение подписывается очередью asyncio своего цикла событий,
+а доставка письма после фиксации транзакции кладёт уведомление в очереди подписанных адресатов.
+Ожидающие соединения не делают запросов к базе. Уведомления получают только соединения
+этого же процесса; письма, доставленные в другом процессе (например, командой deliver_mail),
+клиент увидит при переподключении по номеру последнего изменения.
+"""
+import asyncio
+import threading
+from typing import Dict
+
+from django.conf import settings
+from django.db import connection, transaction
+
+
+class Subscription:
+    """Очередь уведомлений одного соединения"""
+
+    def __init__(self, user_id: int, loop: "asyncio.AbstractEventLoop"):
+        self.user_id = user_id
+        self.loop = loop
+        self.queue = asyncio.Queue(maxsize=settings.MAILBOX_EVENTS_QUEUE_SIZE)
+
+    def put(self, event: dict):
+        # отстающему клиенту достаточно последних уведомлений: номер изменения в них только растёт
+        if self.queue.full():
+            self.queue.get_nowait()
+        self.queue.put_nowait(event)
+
+    def put_threadsafe(self, event: dict):
+        self.loop.call_soon_threadsafe(self.put, event)
+
+
+class NotificationHub:
+    """Подписки соединений по пользователям. Публиковать можно из любого потока."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._subscriptions = {}  # id пользователя -> множество подписок
+
+    def subscribe(self, user_id: int) -> "Subscription":
+        subscription = Subscription(user_id, asyncio.get_running_loop())
+        with self._lock:
+            self._subscriptions.setdefault(user_id, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription: "Subscription"):
+        with self._lock:
+            subscriptions = self._subscriptions.get(subscription.user_id)
+            if subscriptions is not None:
+                subscriptions.discard(subscription)
+                if not subscriptions:
+                    del self._subscriptions[subscription.user_id]
+
+    def publish(self, events: "Dict[int, dict]"):
+        """Рассылает уведомления: events - уведомление для каждого пользователя"""
+        with self._lock:
+            targets = [(subscription, events[user_id]) for user_id in events.keys() & self._subscriptions.keys()
+                       for subscription in self._subscriptions[user_id]]
+        for subscription, event in targets:
+            subscription.put_threadsafe(event)
+
+    def subscribers(self) -> int:
+        with self._lock:
+            return sum(len(subscriptions) for subscriptions in self._subscriptions.values())
+
+
+hub = NotificationHub()
+
+
+def notify_new_mail(last_seq: "Dict[int, int]"):
+    """
+    Уведомляет адресатов о новом письме: last_seq - номер изменения, которым письмо записано в журнал.
+    Внутри транзакции уведомления отправляются после её фиксации, иначе клиент запросит ещё не видимое письмо.
+    """
+    events = {user_id: {"event": "mail", "seq": seq} for user_id, seq in last_seq.items()}
+    if not events:
+        return
+    if connection.in_atomic_block:
+        transaction.on_commit(lambda: hub.publish(events))
+    else:
+        hub.publish(events)
@@ -0,0 +1,99 @@
+from typing import List, Optional
+
+from django.conf import settings
+from django.http import Http404
+
+
+class KeysetPage:
+    """
+    Страница писем, выбранная по ключу (id письма), а не по смещению.
+
+    next_cursor - id, начиная с которого (не включительно) идут более старые письма,
+    previous_cursor - id, начиная с которого (не включительно) идут более новые.
+    Если соответствующих писем нет, курсор равен None.
+    """
+
+    def __init__(self, letters: "List", next_cursor: "Optional[int]", previous_cursor: "Optional[int]"):
+        self.letters = letters
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def __iter__(self):
+        return iter(self.letters)
+
+    def __len__(self):
+        return len(self.letters)
+
+    def __bool__(self):
+        return bool(self.letters)
+
+
+def get_page_size(page_size: "Optional[int]" = None) -> int:
+    return page_size if page_size else settings.MAILBOX_PAGE_SIZE
+
+
+def get_cursor(request, name: str) -> "Optional[int]":
+    """Курсор из гет-параметров запроса. Нечисловой курсор считается несуществующей страницей."""
+    value = request.GET.get(name)
+    if value is None or value == "":
+        return None
+    try:
+        cursor = int(value)
+    except ValueError:
+        raise Http404("Некорректный курсор страницы.")
+    if cursor < 0:
+        raise Http404("Некорректный курсор страницы.")
+    return cursor
+
+
+def _merge_archived(rows: "List", archive, newest_first: bool, limit: int, **cursor) -> "List":
+    """
+    Письма таблицы вместе с архивными письмами папки (mail_box.archive) в порядке id, не больше limit.
+    Сначала сравниваются только id, записи архива читаются для писем, попавших на страницу.
+    """
+    archived_ids = archive.ids(limit=limit, **cursor)
+    if not archived_ids:
+        return rows
+    merged = sorted([(row.id, row) for row in rows] + [(letter_id, None) for letter_id in archived_ids],
+                    key=lambda item: item[0], reverse=newest_first)[:limit]
+    archived = archive.letters(letter_id for letter_id, row in merged if row is None)
+    return [row if row is not None else archived[letter_id] for letter_id, row in merged]
+
+
+def paginate_letters(queryset, before: "Optional[int]" = None, after: "Optional[int]" = None,
+                     page_size: "Optional[int]" = None, archive=None) -> "KeysetPage":
+    """
+    Постраничная выборка писем папки в порядке убывания id.
+
+    Вместо OFFSET используется условие по id, поэтому каждая страница -
+    это ограниченный проход по индексу (user, type, id), и время выборки
+    не зависит от того, насколько далеко страница от начала папки.
+    Запрашивается на одно письмо больше размера страницы, чтобы узнать, есть ли следующая.
+    archive - архивные письма той же папки (archive.ArchivedFolder), они выводятся вместе с письмами таблицы.
+    """
+    page_size = get_page_size(page_size)
+
+    if after is not None:
+        # движение к более новым письмам: выбираем по возрастанию и разворачиваем
+        rows = list(queryset.filter(id__gt=after).order_by("id")[:page_size + 1])
+        if archive is not None:
+            rows = _merge_archived(rows, archive, False, page_size + 1, after=after)
+        has_newer = len(rows) > page_size
+        letters = list(reversed(rows[:page_size]))
+        previous_cursor = letters[0].id if has_newer and letters else None
+        next_cursor = letters[-1].id if letters else after + 1
+        return KeysetPage(letters, next_cursor, previous_cursor)
+
+    if before is not None:
+        queryset = queryset.filter(id__lt=before)
+    rows = list(queryset.order_by("-id")[:page_size + 1])
+    if archive is not None:
+        rows = _merge_archived(rows, archive, True, page_size + 1, before=before)
+    has_older = len(rows) > page_size
+    letters = rows[:page_size]
+    next_cursor = letters[-1].id if has_older else None
+    if before is None:
+        previous_cursor = None
+    else:
+        previous_cursor = letters[0].id if letters else before - 1
+    return KeysetPage(letters, next_cursor, previous_cursor)
@@ -0,0 +1,102 @@
+"""
+Чтение из реплик основной базы.
+
+Запросы чтения страниц направляются в случайную реплику из MAILBOX_READ_REPLICAS, запись - в основную базу.
+Чтобы пользователь видел свои изменения, несмотря на отставание реплик, из основной базы читают:
+- всё вне HTTP-запросов (команды, очередь доставки);
+- запросы с изменяющими методами (POST и т. п.) и всё внутри транзакций;
+- запрос после первой записи и следующие запросы клиента в течение MAILBOX_REPLICA_PIN_SECONDS:
+  такой ответ ставит cookie PIN_COOKIE.
+Базы писем (mail_box.shards) реплик не имеют, запросы к ним этот маршрутизатор не меняет.
+"""
+import asyncio
+import random
+from contextvars import ContextVar
+from typing import Optional
+
+from django.conf import settings
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.utils.decorators import sync_and_async_middleware
+
+PIN_COOKIE = "mailbox_primary"
+SAFE_METHODS = ("GET", "HEAD", "OPTIONS")
+
+
+class ReadState:
+    """Откуда читает текущий HTTP-запрос"""
+
+    def __init__(self, primary: bool):
+        self.primary = primary
+        self.wrote = False
+
+
+_current: "ContextVar[Optional[ReadState]]" = ContextVar("mailbox_read_state", default=None)
+
+
+def reads_from_replica() -> bool:
+    """Идут ли запросы чтения текущего кода в реплику"""
+    if not settings.MAILBOX_READ_REPLICAS:
+        return False
+    state = _current.get()
+    return state is not None and not state.primary and not connections[DEFAULT_DB_ALIAS].in_atomic_block
+
+
+class ReplicaRouter:
+    """Чтение - из реплик, запись - в основную базу; после записи чтение тоже из основной базы"""
+
+    def db_for_read(self, model, **hints):
+        if not settings.MAILBOX_READ_REPLICAS:
+            return None
+        if reads_from_replica():
+            return random.choice(settings.MAILBOX_READ_REPLICAS)
+        return DEFAULT_DB_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if not settings.MAILBOX_READ_REPLICAS:
+            return None
+        state = _current.get()
+        if state is not None:
+            state.primary = state.wrote = True
+        # объекты, прочитанные из реплики, тоже сохраняются в основную базу
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *settings.MAILBOX_READ_REPLICAS}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+
+def _start(request) -> "ReadState":
+    return ReadState(primary=request.method not in SAFE_METHODS or PIN_COOKIE in request.COOKIES)
+
+
+def _finish(state: "ReadState", response):
+    if settings.MAILBOX_READ_REPLICAS and state.wrote:
+        response.set_cookie(PIN_COOKIE, "1", max_age=settings.MAILBOX_REPLICA_PIN_SECONDS, httponly=True,
+                            samesite="Lax")
+    return response
+
+
+@sync_and_async_middleware
+def read_replica_middleware(get_response):
+    """Разрешает чтение из реплик на время HTTP-запроса и закрепляет клиента за основной базой после записи"""
+    if asyncio.iscoroutinefunction(get_response):
+        async def middleware(request):
+            state = _start(request)
+            token = _current.set(state)
+            try:
+                response = await get_response(request)
+            finally:
+                _current.reset(token)
+            return _finish(state, response)
+    else:
+        def middleware(request):
+            state = _start(request)
+            token = _current.set(state)
+            try:
+                response = get_response(request)
+            finally:
+                _current.reset(token)
+            return _finish(state, response)
+    return middleware
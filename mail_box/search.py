@@ -0,0 +1,264 @@
+"""
+Полнотекстовый поиск по заголовку и тексту писем пользователя.
+
+На sqlite с FTS5 используется полнотекстовый индекс mail_box_message_fts (создаётся миграцией
+и поддерживается триггерами), на остальных базах - обратный индекс в таблице MessageTerm,
+который заполняется при отправке письма.
+Результаты ранжируются по релевантности и выдаются постранично.
+Если письма пользователя хранятся в базе шарда (mail_box.shards), поиск идёт по копии обратного индекса
+в базе его писем: она пополняется при доставке писем в эту базу независимо от выбранного механизма.
+"""
+import math
+import re
+from collections import Counter
+from typing import List, Optional
+
+from django.conf import settings
+from django.db import connection, connections, DEFAULT_DB_ALIAS
+from django.db.models import Count, Sum, Case, When, F, FloatField, Value
+
+from mail_box.cache import get_cache
+from mail_box.models import Letter, Message, MessageTerm, EmailTypes
+from mail_box.shards import shard_for_user, letter_shards
+
+FTS5_TABLE = "mail_box_message_fts"
+
+# Во сколько раз слово заголовка весомее слова текста
+HEADER_WEIGHT = 3
+
+# Число сообщений для idf: подсчёт всей таблицы дорог, а для ранжирования достаточно приблизительного значения,
+# поэтому оно берётся из кэша и пересчитывается раз в MAILBOX_SEARCH_COUNT_TIMEOUT секунд
+MESSAGE_COUNT_KEY = "mailbox:search:messages"
+
+_word = re.compile(r"\w+")
+
+
+def tokenize(text: str) -> "List[str]":
+    return [word[:64] for word in _word.findall(text.lower())]
+
+
+def _message_terms(messages: "List[Message]") -> "List[MessageTerm]":
+    """Строки обратного индекса сообщений: слово и его вес в сообщении"""
+    terms = []
+    for message in messages:
+        weights = Counter()
+        for token in tokenize(message.header):
+            weights[token] += HEADER_WEIGHT
+        for token in tokenize(message.text):
+            weights[token] += 1
+        terms.extend(MessageTerm(term=term, message_id=message.pk, weight=weight) for term, weight in weights.items())
+    return terms
+
+
+class SearchResults:
+    """Страница результатов поиска"""
+
+    def __init__(self, letters: "List[Letter]", page: int, has_next: bool):
+        self.letters = letters
+        self.page = page
+        self.has_next = has_next
+
+    @property
+    def has_previous(self) -> bool:
+        return self.page > 1
+
+    def __iter__(self):
+        return iter(self.letters)
+
+    def __len__(self):
+        return len(self.letters)
+
+
+class Fts5Backend:
+    """Поиск по индексу sqlite FTS5, ранжирование - bm25"""
+
+    name = "fts5"
+
+    def index_message(self, message: "Message"):
+        pass  # индекс поддерживается триггерами на mail_box_message
+
+    def index_messages(self, messages: "List[Message]"):
+        pass
+
+    def rebuild(self):
+        with connection.cursor() as cursor:
+            cursor.execute(f"INSERT INTO {FTS5_TABLE}({FTS5_TABLE}) VALUES ('rebuild')")
+
+    @staticmethod
+    def _match(tokens: "List[str]") -> str:
+        # каждое слово берётся в кавычки, чтобы ввод пользователя не разбирался как синтаксис запроса FTS5
+        return " ".join('"{}"'.format(token.replace('"', '""')) for token in tokens)
+
+    def search_ids(self, user, tokens: "List[str]", email_type: "Optional[EmailTypes]",
+                   offset: int, limit: int) -> "List[int]":
+        match = self._match(tokens)
+        type_condition = "AND l.type = %s" if email_type else ""
+        params = [match, user.pk] + ([email_type.value] if email_type else []) + [limit, offset]
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT l.id FROM {FTS5_TABLE} f "
+                f"JOIN mail_box_letter l ON l.message_id = f.rowid "
+                f"WHERE {FTS5_TABLE} MATCH %s AND l.user_id = %s {type_condition} "
+                f"ORDER BY bm25({FTS5_TABLE}, {HEADER_WEIGHT}.0, 1.0), l.id DESC "
+                f"LIMIT %s OFFSET %s",
+                params,
+            )
+            return [row[0] for row in cursor.fetchall()]
+
+
+class InvertedIndexBackend:
+    """
+    Поиск по обратному индексу MessageTerm.
+    Найдены должны быть все слова запроса, ранжирование - сумма вес * idf по словам.
+    """
+
+    name = "inverted"
+
+    def index_message(self, message: "Message"):
+        self.index_messages([message])
+
+    def index_messages(self, messages: "List[Message]"):
+        """Индексирует пакет сообщений одной вставкой"""
+        MessageTerm.objects.bulk_create(_message_terms(messages))
+
+    def rebuild(self, batch_size=1000):
+        MessageTerm.objects.all().delete()
+        get_cache().delete(MESSAGE_COUNT_KEY)
+        last_id = 0
+        while True:
+            messages = list(Message.objects.filter(id__gt=last_id).order_by("id")[:batch_size])
+            if not messages:
+                break
+            self.index_messages(messages)
+            last_id = messages[-1].id
+
+    @staticmethod
+    def _idf(tokens: "List[str]", using: str = DEFAULT_DB_ALIAS) -> "Optional[dict]":
+        """idf слов запроса по индексу базы using; None, если какого-то слова нет ни в одном письме"""
+        total_messages = get_cache().get_or_set(MESSAGE_COUNT_KEY, Message.objects.count,
+                                                settings.MAILBOX_SEARCH_COUNT_TIMEOUT) or 1
+        document_frequency = dict(MessageTerm.objects.using(using).filter(term__in=tokens).values("term")
+                                  .annotate(df=Count("id")).values_list("term", "df"))
+        if len(document_frequency) < len(tokens):
+            return None
+        return {term: math.log(1 + total_messages / df) for term, df in document_frequency.items()}
+
+    def search_ids(self, user, tokens: "List[str]", email_type: "Optional[EmailTypes]",
+                   offset: int, limit: int) -> "List[int]":
+        idf = self._idf(tokens)
+        if idf is None:
+            return []
+
+        letters = Letter.objects.filter(user=user, message__search_terms__term__in=tokens)
+        if email_type:
+            letters = letters.filter(type=email_type.value)
+        score = Sum(Case(
+            *[When(message__search_terms__term=term, then=F("message__search_terms__weight") * Value(weight))
+              for term, weight in idf.items()],
+            output_field=FloatField(),
+        ))
+        rows = letters.values("id").annotate(matched=Count("message__search_terms__term", distinct=True),
+                                             score=score) \
+            .filter(matched=len(tokens)).order_by("-score", "-id").values_list("id", flat=True)
+        return list(rows[offset:offset + limit])
+
+
+def _search_shard_ids(user, tokens: "List[str]", email_type: "Optional[EmailTypes]",
+                      offset: int, limit: int) -> "List[int]":
+    """
+    Поиск писем пользователя в базе его писем: письма соединяются с копией обратного индекса в этой базе
+    (index_letter_database) одним запросом с LIMIT. Частоты слов для idf берутся из той же копии:
+    в основной базе обратного индекса может не быть (FTS5).
+    """
+    shard = shard_for_user(user.pk)
+    idf = InvertedIndexBackend._idf(tokens, shard)
+    if idf is None:
+        return []
+    terms = list(idf)
+    type_condition = "AND l.type = %s" if email_type else ""
+    score = " ".join("WHEN %s THEN t.weight * %s" for _ in terms)
+    params = [user.pk, *terms] + ([email_type.value] if email_type else []) + [len(terms)] \
+        + [value for term in terms for value in (term, idf[term])] + [limit, offset]
+    with connections[shard].cursor() as cursor:
+        cursor.execute(
+            f"SELECT l.id FROM {Letter._meta.db_table} l "
+            f"JOIN {MessageTerm._meta.db_table} t ON t.message_id = l.message_id "
+            f"WHERE l.user_id = %s AND t.term IN ({', '.join(['%s'] * len(terms))}) {type_condition} "
+            f"GROUP BY l.id HAVING COUNT(DISTINCT t.term) = %s "
+            f"ORDER BY SUM(CASE t.term {score} END) DESC, l.id DESC LIMIT %s OFFSET %s",
+            params,
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def index_letter_database(messages: "List[Message]", alias: "Optional[str]"):
+    """
+    Копия обратного индекса сообщений в базе писем alias (mail_box.shards), где появились их письма:
+    поиск соединяет письма пользователя с индексом в одной базе. Вызывается в транзакции этой базы,
+    повторная запись сообщения в ту же базу (следующий пакет рассылки) пропускается.
+    """
+    if alias is not None:
+        MessageTerm.objects.using(alias).bulk_create(_message_terms(messages), ignore_conflicts=True)
+
+
+def rebuild_letter_databases(batch_size: int = 1000):
+    """Перестраивает копии обратного индекса в базах писем по сообщениям их писем"""
+    for alias in letter_shards():
+        MessageTerm.objects.using(alias).all().delete()
+        last_id = 0
+        while True:
+            message_ids = list(Letter.objects.using(alias).filter(message_id__gt=last_id).order_by("message_id")
+                               .values_list("message_id", flat=True).distinct()[:batch_size])
+            if not message_ids:
+                break
+            messages = list(Message.objects.filter(id__in=message_ids))
+            MessageTerm.objects.using(alias).bulk_create(_message_terms(messages))
+            last_id = message_ids[-1]
+
+
+# есть ли таблица FTS5 в базе: (алиас, имя базы) -> bool. Таблица создаётся миграцией,
+# поэтому проверяется один раз на базу, а не при каждой отправке и поиске
+_fts5_tables = {}
+
+
+def _fts5_table_exists() -> bool:
+    key = (connection.alias, connection.settings_dict["NAME"])
+    exists = _fts5_tables.get(key)
+    if exists is None:
+        exists = connection.vendor == "sqlite" and FTS5_TABLE in connection.introspection.table_names()
+        _fts5_tables[key] = exists
+    return exists
+
+
+def get_backend():
+    """Поисковый механизм по настройке MAILBOX_SEARCH_BACKEND: auto, fts5 или inverted"""
+    choice = settings.MAILBOX_SEARCH_BACKEND
+    if choice == "fts5" or (choice == "auto" and _fts5_table_exists()):
+        return Fts5Backend()
+    return InvertedIndexBackend()
+
+
+def index_message(message: "Message"):
+    """Индексирует только что созданное сообщение"""
+    get_backend().index_message(message)
+
+
+def search_letters(user, query: str, email_type: "Optional[EmailTypes]" = None, page: int = 1,
+                   page_size: "Optional[int]" = None) -> "SearchResults":
+    """
+    Поиск писем пользователя, содержащих все слова запроса.
+    Запрашивается на одно письмо больше размера страницы, чтобы узнать, есть ли следующая.
+    """
+    page_size = page_size or settings.MAILBOX_PAGE_SIZE
+    tokens = list(dict.fromkeys(tokenize(query)))
+    if not tokens:
+        return SearchResults([], page, False)
+    offset, limit = (page - 1) * page_size, page_size + 1
+    if shard_for_user(user.pk) is None:
+        ids = get_backend().search_ids(user, tokens, email_type, offset, limit)
+    else:
+        ids = _search_shard_ids(user, tokens, email_type, offset, limit)
+    has_next = len(ids) > page_size
+    ids = ids[:page_size]
+    letters = Letter.objects.for_user(user).with_content().in_bulk(ids)
+    return SearchResults([letters[letter_id] for letter_id in ids], page, has_next)
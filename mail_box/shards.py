@@ -0,0 +1,111 @@
+"""
+Шардирование писем по пользователям.
+
+Письма (Letter) пользователя хранятся в одной из баз MAILBOX_LETTER_SHARDS, выбранной картой шардов
+по id владельца; пользователи, сообщения, счётчики и журнал изменений остаются в основной базе.
+Все операции с письмами ограничены владельцем, поэтому запросы к письмам направляются в одну базу:
+Letter.objects.for_user(user). Содержимое (Message) общее для писем всех шардов и читается из основной базы.
+Базы шардов получают полную схему миграциями (без миграций данных), но строки в них - только письма.
+
+Транзакции разных баз фиксируются по очереди (сначала базы писем, затем основная), общей фиксации нет.
+Пустой MAILBOX_LETTER_SHARDS - шардирования нет, письма в основной базе.
+"""
+from contextlib import contextmanager, ExitStack
+from typing import Dict, Iterable, List, Optional
+
+from django.conf import settings
+from django.db import transaction, DEFAULT_DB_ALIAS
+
+# модели, строки которых хранятся в базах шардов
+SHARDED_MODELS = {"mail_box.Letter"}
+
+
+def letter_shards() -> "List[str]":
+    return list(settings.MAILBOX_LETTER_SHARDS)
+
+
+def shard_for_user(user_id: int) -> "Optional[str]":
+    """Алиас базы писем пользователя; None - письма в основной базе"""
+    shards = settings.MAILBOX_LETTER_SHARDS
+    return shards[user_id % len(shards)] if shards else None
+
+
+def group_by_shard(user_ids: "Iterable[int]") -> "Dict[Optional[str], List[int]]":
+    """Пользователи по базам их писем, в исходном порядке внутри каждой базы"""
+    groups = {}
+    for user_id in user_ids:
+        groups.setdefault(shard_for_user(user_id), []).append(user_id)
+    return groups
+
+
+def letter_databases() -> "List[Optional[str]]":
+    """Все базы, где могут быть письма: для запросов, не ограниченных пользователем"""
+    return letter_shards() or [None]
+
+
+@contextmanager
+def shard_transactions(user_ids: "Iterable[int]"):
+    """
+    Транзакции в базах писем пользователей, дополняющие транзакцию основной базы.
+    Открываются в порядке алиасов, чтобы одновременные рассылки не ждали друг друга по кругу.
+    Без шардирования ничего не делает.
+    """
+    aliases = sorted({shard_for_user(user_id) for user_id in user_ids} - {None})
+    with ExitStack() as stack:
+        for alias in aliases:
+            stack.enter_context(transaction.atomic(using=alias))
+        yield
+
+
+def _label(obj) -> str:
+    return obj._meta.label
+
+
+class LetterShardRouter:
+    """
+    Направляет письма в базу шарда владельца по объекту-подсказке (письму или пользователю),
+    а связанные с письмом объекты (сообщение, владелец) - в основную базу.
+    Запросы без подсказки не меняются: база писем указывается в них явно (Letter.objects.for_user).
+    """
+
+    def db_for_read(self, model, **hints):
+        instance = hints.get("instance")
+        if not settings.MAILBOX_LETTER_SHARDS or instance is None:
+            return None
+        if _label(model) in SHARDED_MODELS:
+            if _label(instance) in SHARDED_MODELS:
+                user_id = instance.user_id
+            elif _label(instance) == settings.AUTH_USER_MODEL:
+                user_id = instance.pk
+            else:
+                return None
+            return shard_for_user(user_id) if user_id is not None else None
+        if _label(instance) in SHARDED_MODELS:
+            return DEFAULT_DB_ALIAS
+        return None
+
+    db_for_write = db_for_read
+
+    def allow_relation(self, obj1, obj2, **hints):
+        if _label(obj1) in SHARDED_MODELS or _label(obj2) in SHARDED_MODELS:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # базы писем создаются пустыми, а реплики - копией основной базы, поэтому в них применяются
+        # только изменения схемы; миграции данных (RunPython без модели) выполняются в основной базе
+        if db != DEFAULT_DB_ALIAS and model_name is None:
+            return False
+        return None
+
+
+def delete_user_letters(sender, instance, **kwargs):
+    """
+    Обработчик pre_delete пользователя: каскадное удаление django проходит только по основной базе,
+    поэтому письма в базе шарда удаляются отдельно.
+    """
+    from mail_box.models import Letter  # модели сами используют карту шардов
+
+    shard = shard_for_user(instance.pk)
+    if shard is not None:
+        Letter.objects.using(shard).filter(user_id=instance.pk).delete()
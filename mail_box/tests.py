@@ -1,9 +1,40 @@
+import asyncio
+import base64
+import json
+import os
+import tempfile
+from datetime import timedelta
+from io import StringIO
+from unittest import mock, skipUnless
+
+from asgiref.sync import async_to_sync, sync_to_async
+from asgiref.testing import ApplicationCommunicator
+from django.conf import settings
+from django.contrib.sessions.models import Session
 from django.core.exceptions import ValidationError, PermissionDenied
-from django.test import TestCase
-from django.urls import reverse
+from django.core.management import call_command
+from django.core.signals import request_finished
+from django.db import connection, connections, transaction, close_old_connections
+from django.http import HttpResponse, StreamingHttpResponse
+from django.test import TestCase, TransactionTestCase, override_settings, Client, RequestFactory
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse, resolve
+from django.utils import timezone
 
 from accounts.models import MailboxUser
-from mail_box.models import Letter, EmailTypes
+from mail_box import api, delivery, search, cache as mailbox_cache, message_cache, events, notifications, middleware, \
+    shards, replicas, archive
+from mail_box.forms import EmailForm
+from mail_box.pagination import paginate_letters
+from mail_box.models import Letter, EmailTypes, Message, FolderCounters, DeliveryJob, DeliveryStatus, \
+    MessageTerm, LetterChange, ChangeSequence, ChangeKinds, ArchiveSegment, ArchiveSegmentUser
+
+# Базы для проверки шардирования писем и реплик объявлены в mailbox_project/settings_test.py:
+# python manage.py test --settings=mailbox_project.settings_test. С основными настройками эти тесты пропускаются.
+TEST_SHARDS = getattr(settings, "MAILBOX_TEST_SHARDS", [])
+TEST_REPLICA = getattr(settings, "MAILBOX_TEST_REPLICA", None)
+requires_test_databases = skipUnless(TEST_SHARDS and TEST_REPLICA,
+                                     "базы шардов и реплики объявлены в mailbox_project.settings_test")
 
 
 class BaseTest(TestCase):
@@ -11,6 +42,8 @@ class BaseTest(TestCase):
     fixtures = ["initial_data.json", ]
 
     def setUp(self) -> None:
+        # кэш живёт в памяти процесса и не откатывается вместе с транзакцией теста
+        mailbox_cache.get_cache().clear()
         self._login_user("admin@mail.ru", "adminadmin")
 
     def _login_user(self, email, password):
@@ -72,6 +105,36 @@ class TestOfPages(BaseTest):
         self._unauthorized_login_attempt_to_view_authorize_required(
             reverse("letter_page", kwargs={"letter_id": letter_of_user.id}))
 
+    def test_letter_page_read_once_and_revalidate(self):
+        """Повторный просмотр не пишет в базу, актуальный ETag даёт 304"""
+        letter = Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value).earliest("id")
+        Letter.objects.filter(id=letter.id).update(is_read=False)
+        url = reverse("letter_page", kwargs={"letter_id": letter.id})
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        updates = [q["sql"] for q in queries if q["sql"].startswith("UPDATE")]
+        self.assertEqual(len([sql for sql in updates if "mail_box_letter" in sql]), 1)
+        self.assertTrue(Letter.objects.get(id=letter.id).is_read)
+        etag = response["ETag"]
+
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([q for q in queries if q["sql"].startswith("UPDATE") and "mail_box_letter" in q["sql"]])
+        last_modified = response["Last-Modified"]
+
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        # время отправки сообщения служит Last-Modified
+        self.assertEqual(self.client.get(url, HTTP_IF_MODIFIED_SINCE=last_modified).status_code, 304)
+
+        # письмо снова отмечено непрочитанным - просмотр с ETag всё равно отмечает его прочитанным
+        self.authorized_user.unread_letter(Letter.objects.get(id=letter.id))
+        self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertTrue(Letter.objects.get(id=letter.id).is_read)
+
     def test_inbox_page(self):
         # Вход на свою страницу со входящими
         response = self.client.get(reverse("inbox_page"))
@@ -123,6 +186,154 @@ class TestOfPages(BaseTest):
         self.assertTemplateUsed(response, "mail_box/send_email_page.html")
 
 
+@override_settings(MAILBOX_PAGE_SIZE=3)
+class TestFolderPagination(BaseTest):
+    """Постраничный вывод папок по курсору"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        sender = MailboxUser.objects.exclude(id=self.authorized_user.id).earliest("id")
+        for i in range(7):
+            sender.send_mail(f"Письмо {i}", "Текст", [self.authorized_user])
+        self.inbox_letters = list(
+            Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value).order_by("-id"))
+
+    def test_walk_pages_forward_and_back(self):
+        seen = []
+        response = self.client.get(reverse("inbox_page"))
+        page = response.context["page"]
+        self.assertIsNone(page.previous_cursor)
+        while True:
+            self.assertLessEqual(len(page.letters), 3)
+            seen.extend(page.letters)
+            if page.next_cursor is None:
+                break
+            response = self.client.get(reverse("inbox_page"), {"before": page.next_cursor})
+            page = response.context["page"]
+        # все письма папки пройдены по одному разу и в нужном порядке
+        self.assertListEqual(seen, self.inbox_letters)
+
+        # возврат на предыдущую страницу
+        response = self.client.get(reverse("inbox_page"), {"after": page.previous_cursor})
+        previous_page = response.context["page"]
+        self.assertListEqual(previous_page.letters, self.inbox_letters[-len(page.letters) - 3:-len(page.letters)])
+
+    def test_invalid_cursor(self):
+        response = self.client.get(reverse("inbox_page"), {"before": "abc"})
+        self.assertEqual(response.status_code, 404)
+
+
+@override_settings(MAILBOX_PAGE_SIZE=500)
+class TestFolderQueryCount(BaseTest):
+    """Число запросов при выводе папки не должно зависеть от количества писем"""
+
+    def _fill_inbox(self, total):
+        """Быстрое наполнение входящих: каждое письмо со своим содержимым и двумя адресатами"""
+        sender = MailboxUser.objects.exclude(id=self.authorized_user.id).earliest("id")
+        addressees = list(MailboxUser.objects.exclude(id=sender.id)[:2])
+        Message.objects.bulk_create([Message(sender=sender, header=f"Письмо {i}", text="Текст") for i in range(total)])
+        # sqlite не возвращает id после bulk_create, поэтому созданные сообщения выбираются заново
+        messages = list(Message.objects.order_by("-id")[:total])
+        Message.addressees_set.through.objects.bulk_create(
+            [Message.addressees_set.through(message_id=m.id, mailboxuser_id=u.id) for m in messages for u in addressees])
+        Letter.objects.bulk_create(
+            [Letter(user=self.authorized_user, message=m, type=EmailTypes.INCOMING.value, is_read=False)
+             for m in messages])
+        mailbox_cache.invalidate_users([self.authorized_user.pk])
+
+    def _count_inbox_queries(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("inbox_page"))
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), len(response.context["letters"])
+
+    def test_inbox_query_count_is_constant(self):
+        Letter.objects.filter(user=self.authorized_user).delete()
+        self._fill_inbox(1)
+        small_queries, small_total = self._count_inbox_queries()
+        self.assertEqual(small_total, 1)
+
+        self._fill_inbox(499)
+        big_queries, big_total = self._count_inbox_queries()
+        self.assertEqual(big_total, 500)
+        self.assertEqual(small_queries, big_queries)
+
+    @skipUnless(connection.vendor == "sqlite", "план запроса проверяется для sqlite")
+    def test_unread_count_is_index_only(self):
+        self._fill_inbox(1)
+        letters = Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value, is_read=False)
+        sql, params = letters.values("id").query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn("COVERING INDEX letter_unread_idx", plan)
+        self.assertIs(letters.first().get_type(), EmailTypes.INCOMING)
+
+    @skipUnless(connection.vendor == "sqlite", "план запроса проверяется для sqlite")
+    def test_created_range_uses_index(self):
+        since = timezone.now() - timedelta(days=1)
+        letters = Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value) \
+            .created_between(since, None)
+        sql, params = letters.values("id").query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn("letter_user_type_created_idx", plan)
+
+
+class TestQueryInstrumentation(BaseTest):
+    """Учёт запросов к базе для каждого HTTP-запроса без DEBUG"""
+
+    def test_server_timing_and_log(self):
+        with CaptureQueriesContext(connection) as context, self.assertLogs("mail_box.sql", "INFO") as logs:
+            response = self.client.get(reverse("inbox_page"))
+        self.assertEqual(response.status_code, 200)
+        self.assertRegex(response["Server-Timing"],
+                         rf'^db;dur=[0-9.]+;desc="{len(context.captured_queries)} queries, \d+ duplicates"$')
+        self.assertIn("view=mail_box.views.inbox ", logs.output[-1])
+        self.assertIn(f"queries={len(context.captured_queries)} ", logs.output[-1])
+
+    def test_duplicates(self):
+        def view(request):
+            for _ in range(3):
+                list(MailboxUser.objects.filter(id=request.user.id))
+            return HttpResponse()
+
+        request = RequestFactory().get("/")
+        request.user = self.authorized_user
+        response = middleware.query_instrumentation_middleware(view)(request)
+        self.assertIn('desc="3 queries, 2 duplicates"', response["Server-Timing"])
+
+    def test_streaming_response(self):
+        def rows():
+            for _ in range(2):
+                yield str(MailboxUser.objects.count())
+
+        def view(request):
+            return StreamingHttpResponse(rows())
+
+        request = RequestFactory().get("/")
+        response = middleware.query_instrumentation_middleware(view)(request)
+        self.assertFalse(response.has_header("Server-Timing"))
+        # close() посылает request_finished, а close_old_connections закрыл бы соединение с транзакцией теста
+        request_finished.disconnect(close_old_connections)
+        try:
+            with self.assertLogs("mail_box.sql", "INFO") as logs:
+                self.assertEqual(b"".join(response), b"33")
+                response.close()
+        finally:
+            request_finished.connect(close_old_connections)
+        self.assertIn("queries=2 duplicates=1 ", logs.output[-1])
+
+    @override_settings(MAILBOX_SLOW_QUERY_MS=0)
+    def test_slow_query_log(self):
+        with self.assertLogs("mail_box.sql", "WARNING") as logs:
+            self.client.get(reverse("sent_page"))
+        slow = [record for record in logs.records if record.levelname == "WARNING"]
+        self.assertTrue(any(record.view == "mail_box.views.sent_box" and "mail_box_letter" in record.sql
+                            for record in slow))
+
+
 class TestDeleteLetter(BaseTest):
 
     def _is_letter_deleted(self, letter_id):
@@ -185,6 +396,14 @@ class TestSendEmails(TestCase):
         letters = self.sender.send_mail(header, text, self.target_users)
         self._checked_created_emails(self.sender, self.target_users, letters)
 
+    def test_send_duplicate_recipient(self):
+        """Адресат, указанный дважды, получает одно письмо"""
+        letters = self.sender.send_mail("Заголовок", "Текст", [self.target_users[0], *self.target_users])
+        self._checked_created_emails(self.sender, self.target_users, letters)
+        message = letters[0].message
+        self.assertEqual(message.addressees_set.count(), 2)
+        self.assertEqual(Letter.objects.filter(message=message, type=EmailTypes.INCOMING.value).count(), 2)
+
     def test_send_invalid_header(self):
 
         # слишком длинный заголовок
@@ -213,6 +432,24 @@ class TestSendEmails(TestCase):
         with self.assertRaises(ValidationError):
             self.sender.send_mail(header, text, self.target_users)
 
+    def test_send_fanout(self):
+        """Рассылка пакетами: адресаты по id и по email, несуществующие адресаты пропускаются"""
+        recipients = [self.target_users[0].id, self.target_users[1].email, self.target_users[0].email,
+                      "nobody@mail.ru", 10 ** 6]
+        result = self.sender.send_mail_fanout("Рассылка", "Текст", recipients, batch_size=1)
+
+        self.assertEqual(result.delivered, 2)
+        self.assertListEqual(result.unknown, ["nobody@mail.ru", 10 ** 6])
+        self.assertGreater(result.throughput, 0)
+        incoming = Letter.objects.filter(message=result.message, type=EmailTypes.INCOMING.value)
+        self.assertSetEqual({letter.user_id for letter in incoming}, {u.id for u in self.target_users})
+        self.assertEqual(Letter.objects.filter(message=result.message, type=EmailTypes.OUTGOING.value).get().user,
+                         self.sender)
+        self.assertSetEqual(set(result.message.addressees_set.all()), set(self.target_users))
+        for user in self.target_users:
+            self.assertEqual(FolderCounters.objects.get_for_user(user).unread_incoming,
+                             user.letters_set.filter(type=EmailTypes.INCOMING.value, is_read=False).count())
+
     def test_read_user_letter(self):
         user = MailboxUser.objects.all().earliest("id")
         Letter.objects.filter(user=user, is_read=True).update(is_read=False)
@@ -237,12 +474,12 @@ class TestSendEmailsFromViews(BaseTest):
         self.assertTrue(MailboxUser.objects.count() >= 3)
 
         # Первые три пользователя, которым должны прийти письма
-        target_users = MailboxUser.objects.all()[:2]
+        target_users = list(MailboxUser.objects.order_by("id")[:2])
         inbox_mail_count_list = [u.letters_set.filter(type=EmailTypes.INCOMING.value).count() for u in target_users]
         sent_mail_count_of_sender = self.authorized_user.letters_set.filter(type=EmailTypes.OUTGOING.value).count()
 
         mail_data = {
-            "addressee": [1, 2, 3],
+            "addressee": "admin@mail.ru, asdfasdf@mail.ru, number_one@mail.ru",
             "header": "Тестовое письмо номер один",
             "text": "Какой-то дурацкий текст."
         }
@@ -258,9 +495,8 @@ class TestSendEmailsFromViews(BaseTest):
 
         # у каждого адресата должно появиться по одному входящему
         new_inbox_mail_count_list = [u.letters_set.filter(type=EmailTypes.INCOMING.value).count() for u in target_users]
-        for v in inbox_mail_count_list:
-            for new_v in new_inbox_mail_count_list:
-                self.assertEqual(v + 1, new_v)
+        for v, new_v in zip(inbox_mail_count_list, new_inbox_mail_count_list):
+            self.assertEqual(v + 1, new_v)
 
         # у отправителья должно появиться одно исходящее письмо
         current_sent_mail_count = self.authorized_user.letters_set.filter(type=EmailTypes.OUTGOING.value).count()
@@ -270,7 +506,7 @@ class TestSendEmailsFromViews(BaseTest):
 
         # Ни один пользователь не был указан получателем письма
         mail_data = {
-            "addressee": [],
+            "addressee": "",
             "header": "Тестовое письмо номер один",
             "text": "Какой-то дурацкий текст."
         }
@@ -283,7 +519,7 @@ class TestSendEmailsFromViews(BaseTest):
 
         # несуществующие в базе пользователи
         mail_data = {
-            "addressee": [5, 6, 7],
+            "addressee": "nobody@mail.ru, admin@mail.ru",
             "header": "Тестовое письмо номер один",
             "text": "Какой-то дурацкий текст."
         }
@@ -294,7 +530,7 @@ class TestSendEmailsFromViews(BaseTest):
     def test_send_invalid_header(self):
         # Слишком длинный заголовок
         mail_data = {
-            "addressee": [1, 2, 3],
+            "addressee": "admin@mail.ru, asdfasdf@mail.ru, number_one@mail.ru",
             "header": "".join("s" for _ in range(71)),
             "text": "Какой-то дурацкий текст."
         }
@@ -303,7 +539,7 @@ class TestSendEmailsFromViews(BaseTest):
 
         # Отстутствие заголовка
         mail_data = {
-            "addressee": [1, 2, 3],
+            "addressee": "admin@mail.ru, asdfasdf@mail.ru, number_one@mail.ru",
             "header": "",
             "text": "Какой-то дурацкий текст."
         }
@@ -314,7 +550,7 @@ class TestSendEmailsFromViews(BaseTest):
 
         # Слишком длинный текст
         mail_data = {
-            "addressee": [1, 2, 3],
+            "addressee": "admin@mail.ru, asdfasdf@mail.ru, number_one@mail.ru",
             "header": "Заголовок",
             "text": "".join("s" for _ in range(902)),
         }
@@ -324,10 +560,1287 @@ class TestSendEmailsFromViews(BaseTest):
 
         # Отсутствие текста
         mail_data = {
-            "addressee": [1, 2, 3],
+            "addressee": "admin@mail.ru, asdfasdf@mail.ru, number_one@mail.ru",
             "header": "Заголовок",
             "text": "",
         }
 
         response = self.client.post(reverse("send_email"), data=mail_data)
         self.assertEqual(response.status_code, 200)
+
+
+class TestFolderCounters(BaseTest):
+    """Счётчики папок должны совпадать с реальным количеством писем"""
+
+    def _assert_counters_match_letters(self, user):
+        counters = FolderCounters.objects.get(user=user)
+        letters = Letter.objects.filter(user=user)
+        self.assertEqual(counters.unread_incoming,
+                         letters.filter(type=EmailTypes.INCOMING.value, is_read=False).count())
+        self.assertEqual(counters.total_incoming, letters.filter(type=EmailTypes.INCOMING.value).count())
+        self.assertEqual(counters.total_sent, letters.filter(type=EmailTypes.OUTGOING.value).count())
+
+    def test_send_read_delete(self):
+        sender = MailboxUser.objects.exclude(id=self.authorized_user.id).earliest("id")
+        sender.send_mail("Заголовок", "Текст", [self.authorized_user])
+        self._assert_counters_match_letters(sender)
+        self._assert_counters_match_letters(self.authorized_user)
+
+        letter = Letter.objects.filter(user=self.authorized_user, is_read=False).latest("id")
+        self.authorized_user.read_letter(letter)
+        # повторное прочтение не должно менять счётчик
+        self.authorized_user.read_letter(letter)
+        self._assert_counters_match_letters(self.authorized_user)
+
+        for letter in Letter.objects.filter(user=self.authorized_user):
+            self.authorized_user.delete_letter(letter)
+        self._assert_counters_match_letters(self.authorized_user)
+
+    def test_main_page_badge(self):
+        FolderCounters.objects.ensure([self.authorized_user.id])
+        unread = Letter.objects.filter(
+            user=self.authorized_user, type=EmailTypes.INCOMING.value, is_read=False).count()
+        response = self.client.get(reverse("main_page"))
+        self.assertEqual(response.context["total_new_letters"], unread)
+
+    def test_rebuild_command(self):
+        FolderCounters.objects.ensure(MailboxUser.objects.values_list("id", flat=True))
+        FolderCounters.objects.update(unread_incoming=100, total_incoming=-1, total_sent=42)
+        call_command("rebuild_folder_counters", batch_size=2, stdout=StringIO())
+        for user in MailboxUser.objects.all():
+            self._assert_counters_match_letters(user)
+
+
+class TestMailboxCache(BaseTest):
+
+    def setUp(self) -> None:
+        super().setUp()
+        mailbox_cache.stats.reset()
+        self.sender, self.bystander = MailboxUser.objects.exclude(id=self.authorized_user.id).order_by("id")[:2]
+
+    def _count_queries(self, url):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(context.captured_queries), response
+
+    def test_folder_page_cached_and_invalidated_on_send(self):
+        first_queries, _ = self._count_queries(reverse("inbox_page"))
+        cached_queries, _ = self._count_queries(reverse("inbox_page"))
+        self.assertLess(cached_queries, first_queries)
+        self.assertEqual(mailbox_cache.stats.as_dict()["folder"], {"hits": 1, "misses": 1})
+
+        bystander_version = mailbox_cache.get_version(self.bystander.pk)
+        sender_version = mailbox_cache.get_version(self.sender.pk)
+        self.sender.send_mail("Свежее письмо", "Текст", [self.authorized_user])
+        # версия меняется только у отправителя и адресата
+        self.assertEqual(mailbox_cache.get_version(self.bystander.pk), bystander_version)
+        self.assertNotEqual(mailbox_cache.get_version(self.sender.pk), sender_version)
+        _, response = self._count_queries(reverse("inbox_page"))
+        self.assertIn("Свежее письмо", response.content.decode())
+
+    def test_unread_count_and_letter_invalidated_on_read_and_delete(self):
+        self.sender.send_mail("Непрочитанное", "Текст", [self.authorized_user])
+        letter = Letter.objects.get(user=self.authorized_user, message__header="Непрочитанное")
+        unread = self.client.get(reverse("main_page")).context["total_new_letters"]
+        self.assertEqual(self.client.get(reverse("main_page")).context["total_new_letters"], unread)
+
+        self.client.get(reverse("letter_page", kwargs={"letter_id": letter.id}))
+        self.assertEqual(self.client.get(reverse("main_page")).context["total_new_letters"], unread - 1)
+        self.assertEqual(self.client.get(reverse("letter_page", kwargs={"letter_id": letter.id})).status_code, 200)
+
+        self.client.get(reverse("delete_letter", kwargs={"letter_id": letter.id}))
+        self.assertEqual(self.client.get(reverse("letter_page", kwargs={"letter_id": letter.id})).status_code, 404)
+
+    def test_stats_endpoint(self):
+        self.client.get(reverse("main_page"))
+        response = self.client.get(reverse("api_cache_stats"))
+        self.assertEqual(json.loads(response.content.decode())["counters"], {"hits": 0, "misses": 1})
+
+        self.client.force_login(self.sender)
+        self.assertEqual(self.client.get(reverse("api_cache_stats")).status_code, 403)
+
+
+class TestMessageCache(TransactionTestCase):
+    """Кэш наполняется только вне транзакции, поэтому здесь TransactionTestCase"""
+    fixtures = ["initial_data.json", ]
+
+    def setUp(self) -> None:
+        message_cache.message_cache.clear()
+        mailbox_cache.get_cache().clear()
+        self.sender, self.first, self.second = MailboxUser.objects.order_by("id")[:3]
+
+    def test_shared_across_recipients(self):
+        self.sender.send_mail("Объявление", "Для всех", [self.first, self.second])
+        for user in (self.first, self.second):
+            letter = Letter.objects.get(user=user, message__header="Объявление")
+            self.client.force_login(user)
+            with CaptureQueriesContext(connection) as context:
+                response = self.client.get(reverse("letter_page", kwargs={"letter_id": letter.id}))
+            self.assertContains(response, "Для всех")
+            message_queries = [q for q in context.captured_queries if 'FROM "mail_box_message"' in q["sql"]]
+            # сообщение выбирается из базы только для первого адресата
+            self.assertEqual(len(message_queries), 1 if user == self.first else 0)
+        stats = message_cache.message_cache.stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["hit_ratio"]), (1, 1, 0.5))
+
+    def test_users_are_not_cached(self):
+        self.sender.send_mail("Объявление", "Для всех", [self.first])
+        message = Message.objects.get(header="Объявление")
+        message_cache.get_messages([message.pk])
+        cached = message_cache.message_cache.get_many([message.pk])[message.pk]
+        self.assertEqual((cached.sender_id, cached.addressee_ids), (self.sender.pk, [self.first.pk]))
+        self.assertNotIn("sender", cached._state.fields_cache)
+
+        # отправитель и адресаты выбираются при каждом обращении: без пароля и с новым именем
+        MailboxUser.objects.filter(pk=self.sender.pk).update(first_name="Новое имя")
+        with self.assertNumQueries(1):
+            message = message_cache.get_messages([message.pk])[message.pk]
+            self.assertEqual(message.sender.first_name, "Новое имя")
+            self.assertEqual([user.email for user in message.addressees_set.all()], [self.first.email])
+        self.assertTrue({"password", "last_login"} <= message.sender.get_deferred_fields())
+
+    def test_lru_bounds(self):
+        cache = message_cache.MessageCache(max_entries=2, max_bytes=10 ** 6)
+        messages = [message for _, message in sorted(message_cache._fetch_messages(
+            Message.objects.order_by("id").values_list("id", flat=True)[:3]).items())]
+        cache.set_many(messages[:2])
+        cache.get_many([messages[0].pk])  # первое сообщение становится недавно использованным
+        cache.set_many(messages[2:])
+        self.assertEqual(set(cache.get_many(m.pk for m in messages)), {messages[0].pk, messages[2].pk})
+
+        size = message_cache._estimate_size(messages[0])
+        small = message_cache.MessageCache(max_entries=100, max_bytes=size)
+        small.set_many(messages)
+        self.assertLessEqual(small.stats()["bytes"], size)
+
+
+class TestApi(BaseTest):
+    """JSON API хранилища писем"""
+
+    def _get_json(self, response):
+        content = b"".join(response.streaming_content) if response.streaming else response.content
+        return json.loads(content.decode())
+
+    def _basic_auth(self, email, password):
+        credentials = base64.b64encode(f"{email}:{password}".encode()).decode()
+        return {"HTTP_AUTHORIZATION": f"Basic {credentials}"}
+
+    def test_folder_list(self):
+        response = self.client.get(reverse("api_folder_list", kwargs={"folder": "inbox"}))
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.streaming)
+        letters = self._get_json(response)
+        inbox_ids = list(Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value)
+                         .order_by("-id").values_list("id", flat=True))
+        self.assertListEqual([letter["id"] for letter in letters], inbox_ids)
+        self.assertTrue(all(letter["folder"] == "inbox" for letter in letters))
+
+        # продолжение списка по курсору
+        response = self.client.get(reverse("api_folder_list", kwargs={"folder": "inbox"}),
+                                   {"before": inbox_ids[0], "limit": 1})
+        self.assertListEqual([letter["id"] for letter in self._get_json(response)], inbox_ids[1:2])
+
+        response = self.client.get(reverse("api_folder_list", kwargs={"folder": "spam"}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_folder_list_time_range(self):
+        url = reverse("api_folder_list", kwargs={"folder": "inbox"})
+        letters = list(Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value)
+                       .order_by("id"))
+        old, new = letters[0], letters[-1]
+        day_ago = timezone.now() - timedelta(days=1)
+        Letter.objects.filter(id=old.id).update(created_at=day_ago - timedelta(days=1))
+
+        response = self.client.get(url, {"since": day_ago.isoformat()})
+        ids = [letter["id"] for letter in self._get_json(response)]
+        self.assertIn(new.id, ids)
+        self.assertNotIn(old.id, ids)
+        self.assertTrue(all("created_at" in letter for letter in self._get_json(self.client.get(url))))
+
+        response = self.client.get(url, {"until": day_ago.isoformat()})
+        self.assertListEqual([letter["id"] for letter in self._get_json(response)], [old.id])
+
+        response = self.client.get(url, {"since": "вчера"})
+        self.assertEqual(response.status_code, 400)
+
+    def test_stream_is_valid_json_across_chunks(self):
+        rows = ({"id": i} for i in range(7))
+        content = "".join(api._stream_json_list(rows, chunk_size=3))
+        self.assertListEqual(json.loads(content), [{"id": i} for i in range(7)])
+        self.assertListEqual(json.loads("".join(api._stream_json_list(iter([]), chunk_size=3))), [])
+
+    def test_letter_detail(self):
+        letter = Letter.objects.filter(user=self.authorized_user).earliest("id")
+        response = self.client.get(reverse("api_letter", kwargs={"letter_id": letter.id}))
+        self.assertEqual(response.status_code, 200)
+        data = self._get_json(response)
+        self.assertEqual(data["header"], letter.message.header)
+        self.assertEqual(data["sender"], letter.message.sender.email)
+
+        another_letter = Letter.objects.exclude(user=self.authorized_user).earliest("id")
+        response = self.client.get(reverse("api_letter", kwargs={"letter_id": another_letter.id}))
+        self.assertEqual(response.status_code, 403)
+
+        response = self.client.get(reverse("api_letter", kwargs={"letter_id": 10 ** 6}))
+        self.assertEqual(response.status_code, 404)
+
+    def test_read_mark_and_delete(self):
+        letter = Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value).earliest("id")
+        url = reverse("api_letter_read", kwargs={"letter_id": letter.id})
+        for is_read in (False, True, False):
+            response = self.client.post(url, json.dumps({"is_read": is_read}), content_type="application/json")
+            self.assertEqual(response.status_code, 200)
+            letter.refresh_from_db()
+            self.assertEqual(letter.is_read, is_read)
+        self.assertEqual(FolderCounters.objects.get_for_user(self.authorized_user).unread_incoming,
+                         Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value,
+                                               is_read=False).count())
+
+        response = self.client.delete(reverse("api_letter", kwargs={"letter_id": letter.id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Letter.objects.filter(id=letter.id).exists())
+
+    def test_send_with_basic_auth(self):
+        client = Client(enforce_csrf_checks=True)
+        target = MailboxUser.objects.exclude(id=self.authorized_user.id).earliest("id")
+        total_letters = Letter.objects.count()
+        data = {"header": "Заголовок", "text": "Текст", "addressees": [target.email]}
+        response = client.post(reverse("api_send_letter"), json.dumps(data), content_type="application/json",
+                               **self._basic_auth(self.authorized_user.email, "adminadmin"))
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(total_letters + 2, Letter.objects.count())
+
+        # неизвестный адресат и слишком длинный заголовок
+        data = {"header": "Заголовок", "text": "Текст", "addressees": ["nobody@mail.ru"]}
+        response = client.post(reverse("api_send_letter"), json.dumps(data), content_type="application/json",
+                               **self._basic_auth(self.authorized_user.email, "adminadmin"))
+        self.assertEqual(response.status_code, 400)
+        data = {"header": "s" * 71, "text": "Текст", "addressees": [target.email]}
+        response = client.post(reverse("api_send_letter"), json.dumps(data), content_type="application/json",
+                               **self._basic_auth(self.authorized_user.email, "adminadmin"))
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("header", self._get_json(response)["fields"])
+
+        # неверный пароль
+        response = client.post(reverse("api_send_letter"), json.dumps(data), content_type="application/json",
+                               **self._basic_auth(self.authorized_user.email, "wrong"))
+        self.assertEqual(response.status_code, 401)
+
+    def test_authentication_required(self):
+        client = Client(enforce_csrf_checks=True)
+        response = client.get(reverse("api_folder_list", kwargs={"folder": "inbox"}))
+        self.assertEqual(response.status_code, 401)
+
+        # сессионная аутентификация без csrf-токена не позволяет изменять письма
+        client.login(email=self.authorized_user.email, password="adminadmin")
+        letter = Letter.objects.filter(user=self.authorized_user).earliest("id")
+        response = client.delete(reverse("api_letter", kwargs={"letter_id": letter.id}))
+        self.assertEqual(response.status_code, 403)
+        self.assertTrue(Letter.objects.filter(id=letter.id).exists())
+
+    def _post_bulk(self, data):
+        return self.client.post(reverse("api_letters_bulk"), json.dumps(data), content_type="application/json")
+
+    def _assert_counters_consistent(self):
+        FolderCounters.objects.ensure([self.authorized_user.id])
+        self.assertEqual(FolderCounters.objects.get_for_user(self.authorized_user).unread_incoming,
+                         Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value,
+                                               is_read=False).count())
+
+    def test_bulk_mark_by_ids(self):
+        self._assert_counters_consistent()
+        own_ids = list(Letter.objects.filter(user=self.authorized_user).values_list("id", flat=True))
+        another_id = Letter.objects.exclude(user=self.authorized_user).earliest("id").id
+        Letter.objects.filter(id=own_ids[0]).update(is_read=True)
+        Letter.objects.filter(id__in=own_ids[1:]).update(is_read=False)
+        FolderCounters.objects.rebuild([self.authorized_user.id])
+        Letter.objects.filter(id=another_id).update(is_read=False)
+
+        response = self._post_bulk({"action": "read", "ids": own_ids + [another_id]})
+        self.assertEqual(response.status_code, 200)
+        data = self._get_json(response)
+        self.assertEqual(data["affected"], len(own_ids) - 1)
+        self.assertEqual(data["results"][str(own_ids[0])], "unchanged")
+        self.assertEqual(data["results"][str(own_ids[1])], "updated")
+        self.assertEqual(data["results"][str(another_id)], "not_found")
+        self.assertFalse(Letter.objects.filter(id__in=own_ids, is_read=False).exists())
+        # чужое письмо не изменилось
+        self.assertFalse(Letter.objects.get(id=another_id).is_read)
+        self._assert_counters_consistent()
+
+        response = self._post_bulk({"action": "unread", "ids": own_ids})
+        self.assertEqual(self._get_json(response)["affected"], len(own_ids))
+        self._assert_counters_consistent()
+
+    def test_bulk_delete_folder_up_to_id(self):
+        inbox = Letter.objects.filter(user=self.authorized_user, type=EmailTypes.INCOMING.value).order_by("id")
+        inbox_ids = list(inbox.values_list("id", flat=True))
+        total_others = Letter.objects.exclude(user=self.authorized_user).count()
+        self._assert_counters_consistent()
+
+        response = self._post_bulk({"action": "delete", "folder": "inbox", "up_to_id": inbox_ids[-2]})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self._get_json(response)["affected"], len(inbox_ids) - 1)
+        self.assertListEqual(list(inbox.values_list("id", flat=True)), inbox_ids[-1:])
+        self.assertEqual(Letter.objects.exclude(user=self.authorized_user).count(), total_others)
+        self._assert_counters_consistent()
+
+    def test_bulk_invalid_requests(self):
+        for data in ({"action": "archive", "ids": [1]},
+                     {"action": "read", "ids": "1,2"},
+                     {"action": "read", "folder": "inbox"},
+                     {"action": "read", "ids": list(range(1001))}):
+            self.assertEqual(self._post_bulk(data).status_code, 400)
+
+
+class TestChangeLog(BaseTest):
+    """Журнал изменений писем и инкрементальная синхронизация"""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.sender = MailboxUser.objects.exclude(id=self.authorized_user.id).earliest("id")
+
+    def _sync(self, since, **params):
+        response = self.client.get(reverse("api_changes"), {"since": since, **params})
+        return response.status_code, json.loads(response.content.decode())
+
+    def test_send_read_delete_are_logged(self):
+        _, start = self._sync(0)
+        while start["has_more"]:
+            _, start = self._sync(start["next_seq"])
+        since = start["next_seq"]
+
+        self.sender.send_mail("Заголовок", "Текст", [self.authorized_user])
+        letter = Letter.objects.filter(user=self.authorized_user).latest("id")
+        self.authorized_user.read_letter(letter)
+        self.authorized_user.read_letter(letter)  # уже прочитано - изменения нет
+        self.authorized_user.mark_letters(Letter.objects.filter(id=letter.id), is_read=False)
+        self.authorized_user.delete_letter(Letter.objects.get(id=letter.id))
+
+        status, data = self._sync(since)
+        self.assertEqual(status, 200)
+        self.assertListEqual([(c["letter_id"], c["folder"], c["change"]) for c in data["changes"]], [
+            (letter.id, "inbox", "created"), (letter.id, "inbox", "read"),
+            (letter.id, "inbox", "unread"), (letter.id, "inbox", "deleted")])
+        self.assertListEqual([c["seq"] for c in data["changes"]], list(range(since + 1, since + 5)))
+        self.assertEqual(data["next_seq"], since + 4)
+        self.assertFalse(data["has_more"])
+
+        # у отправителя своя последовательность
+        sender_changes = LetterChange.objects.filter(user=self.sender).order_by("-seq").first()
+        self.assertEqual(sender_changes.get_kind(), ChangeKinds.CREATED)
+        self.assertEqual(sender_changes.letter_type, EmailTypes.OUTGOING.value)
+
+    def test_batches_and_folder_filter(self):
+        self.authorized_user.delete_letters(Letter.objects.all())
+        for i in range(5):
+            self.sender.send_mail(f"Письмо {i}", "Текст", [self.authorized_user])
+        self.authorized_user.send_mail("Ответ", "Текст", [self.sender])
+
+        seen, since, more = [], 0, True
+        while more:
+            status, data = self._sync(since, limit=2, folder="inbox")
+            self.assertLessEqual(len(data["changes"]), 2)
+            seen.extend(change["change"] for change in data["changes"] if change["folder"] == "inbox")
+            since, more = data["next_seq"], data["has_more"]
+        self.assertEqual(seen.count("created"), 5)
+        self.assertEqual(since, ChangeSequence.objects.get(user=self.authorized_user).last_seq)
+
+    def test_compaction_requires_resync(self):
+        self.sender.send_mail("Заголовок", "Текст", [self.authorized_user])
+        LetterChange.objects.filter(user=self.authorized_user).update(created_at=timezone.now() - timedelta(days=40))
+        self.sender.send_mail("Новое", "Текст", [self.authorized_user])
+        call_command("compact_changes", days=30, batch_size=1, stdout=StringIO())
+
+        sequence = ChangeSequence.objects.get(user=self.authorized_user)
+        self.assertEqual(sequence.compacted_seq, sequence.last_seq - 1)
+        status, data = self._sync(0)
+        self.assertEqual(status, 410)
+        self.assertEqual(data["next_seq"], sequence.last_seq)
+        status, data = self._sync(sequence.compacted_seq)
+        self.assertEqual([change["change"] for change in data["changes"]], ["created"])
+
+        self.assertEqual(self._sync(sequence.last_seq + 1)[0], 410)
+        self.assertEqual(self._sync("abc")[0], 400)
+
+
+class TestNotifications(TransactionTestCase):
+    """Уведомления публикуются после фиксации доставки, поэтому здесь TransactionTestCase"""
+    fixtures = ["initial_data.json", ]
+
+    def setUp(self) -> None:
+        mailbox_cache.get_cache().clear()
+        self.user = MailboxUser.objects.get(email="admin@mail.ru")
+        self.sender = MailboxUser.objects.exclude(id=self.user.id).earliest("id")
+
+    def _scope(self, *headers, query_string=b""):
+        credentials = base64.b64encode(b"admin@mail.ru:adminadmin")
+        return {"type": "http", "method": "GET", "path": events.EVENTS_PATH, "query_string": query_string,
+                "headers": [(b"authorization", b"Basic " + credentials), *headers], "root_path": "",
+                "http_version": "1.1", "scheme": "http", "server": ("testserver", 80), "client": ("127.0.0.1", 1)}
+
+    def _send_mail(self, header):
+        self.sender.send_mail(header, "Текст", [self.user])
+
+    @override_settings(MAILBOX_EVENTS_LONGPOLL_TIMEOUT=0.1)
+    def test_long_poll(self):
+        async def poll(send_mail):
+            communicator = ApplicationCommunicator(events.events_app, self._scope())
+            await communicator.send_input({"type": "http.request"})
+            if send_mail:
+                await asyncio.sleep(0.05)
+                await sync_to_async(self._send_mail)("Новое письмо")
+            start = await communicator.receive_output(1)
+            body = await communicator.receive_output(1)
+            return start["status"], body["body"]
+
+        with CaptureQueriesContext(connection) as context:
+            status, _ = async_to_sync(poll)(False)
+        self.assertEqual(status, 204)
+        self.assertEqual(len(context.captured_queries), 1)  # только аутентификация, ожидание базу не использует
+
+        status, body = async_to_sync(poll)(True)
+        self.assertEqual(status, 200)
+        seq = ChangeSequence.objects.get(user=self.user).last_seq
+        self.assertListEqual(json.loads(body.decode())["events"], [{"event": "mail", "seq": seq}])
+        self.assertEqual(notifications.hub.subscribers(), 0)
+
+    def test_event_stream(self):
+        async def stream():
+            communicator = ApplicationCommunicator(
+                events.events_app, self._scope((b"accept", b"text/event-stream"), (b"last-event-id", b"0")))
+            await communicator.send_input({"type": "http.request"})
+            start = await communicator.receive_output(1)
+            chunks = [(await communicator.receive_output(1))["body"] for _ in range(2)]
+            await sync_to_async(self._send_mail)("Новое письмо")
+            chunks.append((await communicator.receive_output(1))["body"])
+            await communicator.send_input({"type": "http.disconnect"})
+            await communicator.wait(1)
+            return start, chunks
+
+        self._send_mail("Пропущенное письмо")  # клиент переподключается с устаревшим Last-Event-ID
+        start, chunks = async_to_sync(stream)()
+        self.assertEqual(dict(start["headers"])[b"content-type"], b"text/event-stream")
+        seq = ChangeSequence.objects.get(user=self.user).last_seq
+        self.assertEqual(chunks[0], b": connected\n\n")
+        self.assertTrue(chunks[1].startswith(f"id: {seq - 1}\nevent: mail\n".encode()))
+        self.assertTrue(chunks[2].startswith(f"id: {seq}\nevent: mail\n".encode()))
+        self.assertEqual(notifications.hub.subscribers(), 0)
+
+    @override_settings(MAILBOX_EVENTS_LONGPOLL_TIMEOUT=0.1)
+    def test_reconnect_ignores_other_changes(self):
+        async def poll(since):
+            communicator = ApplicationCommunicator(events.events_app,
+                                                   self._scope(query_string=f"since={since}".encode()))
+            await communicator.send_input({"type": "http.request"})
+            start = await communicator.receive_output(1)
+            body = await communicator.receive_output(1)
+            return start["status"], body["body"]
+
+        self._send_mail("Письмо")
+        delivered = ChangeSequence.objects.get(user=self.user).last_seq
+        letter = Letter.objects.filter(user=self.user, is_read=False).latest("id")
+        self.user.read_letter(letter)
+        self.user.delete_letter(letter)
+        self.user.send_mail("Ответ", "Текст", [self.sender])
+        # после delivered были только прочтение, удаление и отправка - новой почты нет
+        self.assertEqual(async_to_sync(poll)(delivered)[0], 204)
+        status, body = async_to_sync(poll)(delivered - 1)
+        self.assertEqual(status, 200)
+        self.assertListEqual(json.loads(body.decode())["events"], [{"event": "mail", "seq": delivered}])
+
+    def test_authentication_required(self):
+        async def request():
+            scope = {**self._scope(), "headers": []}
+            communicator = ApplicationCommunicator(events.events_app, scope)
+            await communicator.send_input({"type": "http.request"})
+            return (await communicator.receive_output(1))["status"]
+
+        self.assertEqual(async_to_sync(request)(), 401)
+
+
+class TestAsyncViews(TransactionTestCase):
+    """
+    Страницы чтения под ASGI выполняются в потоке пула, у которого своё соединение с базой,
+    поэтому данные должны быть зафиксированы - здесь TransactionTestCase
+    """
+    fixtures = ["initial_data.json", ]
+
+    def setUp(self) -> None:
+        mailbox_cache.get_cache().clear()
+        # постоянные соединения потоков пула остались бы открытыми и помешали удалить тестовую базу
+        patcher = mock.patch.dict(connection.settings_dict, {"CONN_MAX_AGE": 0})
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.user = MailboxUser.objects.get(email="admin@mail.ru")
+        self.async_client.force_login(self.user)
+
+    def _request(self, method, url):
+        async def request():
+            return await getattr(self.async_client, method)(url)
+        return async_to_sync(request)()
+
+    def test_read_pages_over_asgi(self):
+        letter = Letter.objects.filter(user=self.user, type=EmailTypes.INCOMING.value).latest("id")
+        Letter.objects.filter(id=letter.id).update(is_read=False)
+        for name, kwargs in [("main_page", {}), ("inbox_page", {}), ("sent_page", {}),
+                             ("letter_page", {"letter_id": letter.id})]:
+            self.assertTrue(asyncio.iscoroutinefunction(resolve(reverse(name, kwargs=kwargs)).func))
+            response = self._request("get", reverse(name, kwargs=kwargs))
+            self.assertEqual(response.status_code, 200, name)
+            # запросы страницы в потоке пула тоже учтены
+            self.assertNotIn('desc="0 queries', response["Server-Timing"], name)
+        self.assertTrue(Letter.objects.get(id=letter.id).is_read)
+        self.assertEqual(self._request("post", reverse("inbox_page")).status_code, 405)
+
+        another_letter = Letter.objects.exclude(user=self.user).earliest("id")
+        response = self._request("get", reverse("letter_page", kwargs={"letter_id": another_letter.id}))
+        self.assertEqual(response.status_code, 403)
+
+
+@requires_test_databases
+@override_settings(MAILBOX_LETTER_SHARDS=TEST_SHARDS)
+class TestLetterShards(TestCase):
+    """Письма пользователей в двух базах sqlite, пользователи и сообщения - в основной базе"""
+    databases = {"default", *TEST_SHARDS}
+
+    def setUp(self) -> None:
+        mailbox_cache.get_cache().clear()
+        message_cache.message_cache.clear()
+        # id идут подряд, поэтому пользователи поровну распределены по базам
+        self.users = [MailboxUser.objects.create_user(f"shard{i}@mail.ru", "password") for i in range(4)]
+        self.sender = self.users[0]
+
+    def _shard_letters(self, user):
+        return Letter.objects.using(shards.shard_for_user(user.pk)).filter(user=user)
+
+    def test_send_mail_inserts_per_shard(self):
+        contexts = {alias: CaptureQueriesContext(connections[alias]) for alias in TEST_SHARDS}
+        with contexts[TEST_SHARDS[0]], contexts[TEST_SHARDS[1]]:
+            self.sender.send_mail("Шарды", "Текст письма", self.users[1:])
+        # в базе отправителя - его письмо и вставка входящих, в другой базе - одна вставка входящих
+        sender_shard = shards.shard_for_user(self.sender.pk)
+        for alias, context in contexts.items():
+            inserts = [query for query in context.captured_queries
+                       if query["sql"].startswith('INSERT INTO "mail_box_letter"')]
+            self.assertEqual(len(inserts), 2 if alias == sender_shard else 1, alias)
+        self.assertFalse(Letter.objects.using("default").exists())
+        for user in self.users:
+            self.assertEqual(self._shard_letters(user).count(), 1)
+
+        self.sender.send_mail_fanout("Рассылка", "Текст", [user.email for user in self.users[1:]], batch_size=2)
+        self.assertEqual(self._shard_letters(self.users[3]).count(), 2)
+        self.assertEqual(FolderCounters.objects.get_for_user(self.users[3]).unread_incoming, 2)
+
+    def test_content_and_pages(self):
+        self.sender.send_mail("Шарды", "Текст письма", self.users[1:])
+        recipient = self.users[1]
+        letter = Letter.objects.for_user(recipient).with_content().get()
+        self.assertEqual(letter.message.header, "Шарды")
+        # сообщение и отправитель читаются из основной базы и без общего кэша
+        self.assertEqual(Letter.objects.for_user(recipient).get().message.sender, self.sender)
+
+        self.client.force_login(recipient)
+        self.assertContains(self.client.get(reverse("inbox_page")), "Шарды")
+        response = self.client.get(reverse("letter_page", kwargs={"letter_id": letter.id}))
+        self.assertContains(response, "Текст письма")
+        self.assertTrue(Letter.objects.for_user(recipient).get().is_read)
+        self.assertEqual(FolderCounters.objects.get_for_user(recipient).unread_incoming, 0)
+
+    def test_api_folder_list(self):
+        self.sender.send_mail("Шарды", "Текст письма", self.users[1:])
+        self.sender.send_mail("Второе", "Текст письма", self.users[1:2])
+        self.client.force_login(self.users[1])
+        url = reverse("api_folder_list", kwargs={"folder": "inbox"})
+        letters = json.loads(b"".join(self.client.get(url).streaming_content).decode())
+        self.assertEqual([(letter["header"], letter["sender"]) for letter in letters],
+                         [("Второе", self.sender.email), ("Шарды", self.sender.email)])
+        self.assertEqual([letter["id"] for letter in letters],
+                         list(self._shard_letters(self.users[1]).order_by("-id").values_list("id", flat=True)))
+
+    def test_api_bulk(self):
+        self.sender.send_mail("Шарды", "Текст письма", self.users[1:])
+        recipient = self.users[1]
+        own_id = self._shard_letters(recipient).get().id
+        another_id = self._shard_letters(self.users[2]).get().id
+        self.client.force_login(recipient)
+
+        response = self.client.post(reverse("api_letters_bulk"),
+                                    json.dumps({"action": "read", "ids": [own_id, another_id]}),
+                                    content_type="application/json")
+        self.assertEqual(json.loads(response.content.decode()),
+                         {"action": "read", "affected": 1,
+                          "results": {str(own_id): "updated", str(another_id): "not_found"}})
+        self.assertTrue(self._shard_letters(recipient).get().is_read)
+        self.assertFalse(self._shard_letters(self.users[2]).get().is_read)
+
+        response = self.client.post(reverse("api_letters_bulk"),
+                                    json.dumps({"action": "delete", "folder": "inbox", "up_to_id": another_id}),
+                                    content_type="application/json")
+        self.assertEqual(json.loads(response.content.decode())["affected"], 1)
+        self.assertFalse(self._shard_letters(recipient).exists())
+        self.assertTrue(self._shard_letters(self.users[2]).exists())
+
+    def test_mark_delete_and_counters(self):
+        self.sender.send_mail("Шарды", "Текст письма", self.users[1:])
+        recipient = self.users[2]
+        incoming = Letter.objects.filter(type=EmailTypes.INCOMING.value)
+        self.assertEqual(recipient.mark_letters(incoming, True), 1)
+        self.assertEqual(recipient.mark_letters(incoming, False), 1)
+        self.assertEqual(recipient.delete_letters(incoming), 1)
+        self.assertFalse(self._shard_letters(recipient).exists())
+        self.assertEqual(self._shard_letters(self.users[3]).count(), 1)
+
+        FolderCounters.objects.rebuild([user.pk for user in self.users])
+        counters = {user.pk: FolderCounters.objects.get(user=user) for user in self.users}
+        self.assertEqual(counters[recipient.pk].total_incoming, 0)
+        self.assertEqual(counters[self.users[3].pk].unread_incoming, 1)
+        self.assertEqual(counters[self.sender.pk].total_sent, 1)
+
+    def test_search(self):
+        self.sender.send_mail("Квартальный отчёт", "Цифры", self.users[1:])
+        self.sender.send_mail("Другое", "Без отчётов", self.users[1:2])
+        results = search.search_letters(self.users[1], "отчёт")
+        self.assertEqual([letter.message.header for letter in results], ["Квартальный отчёт"])
+        self.assertEqual(len(search.search_letters(self.sender, "отчёт", EmailTypes.OUTGOING)), 1)
+
+    @override_settings(MAILBOX_SEARCH_BACKEND="inverted")
+    def test_search_in_letter_database(self):
+        self.sender.send_mail("Отчёт", "Цифры", self.users[1:2])
+        self.sender.send_mail("Отчёт", "Отчёт за квартал", self.users[2:])
+        self.users[1].send_mail("Ответ", "Отчёт получен", [self.sender])
+        recipient = self.users[1]
+        shard = shards.shard_for_user(recipient.pk)
+        # в базе писем - копия индекса только тех сообщений, чьи письма в ней есть
+        own_messages = set(Letter.objects.using(shard).values_list("message_id", flat=True))
+        self.assertEqual(set(MessageTerm.objects.using(shard).values_list("message_id", flat=True)), own_messages)
+        with CaptureQueriesContext(connections[shard]) as context:
+            results = search.search_letters(recipient, "отчёт")
+        # частоты слов, поиск и письма страницы: письма отбираются и ранжируются одним запросом с LIMIT,
+        # без перебора папки
+        self.assertEqual(len(context.captured_queries), 3)
+        self.assertIn("LIMIT", context.captured_queries[1]["sql"])
+        self.assertEqual([letter.message.header for letter in results], ["Отчёт", "Ответ"])
+        self.assertEqual([letter.message.header for letter in search.search_letters(self.sender, "квартал")],
+                         ["Отчёт"])
+        self.assertEqual(len(search.search_letters(recipient, "отчёт", page_size=1)), 1)
+
+        MessageTerm.objects.using(shard).all().delete()
+        call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual([letter.message.header for letter in search.search_letters(recipient, "отчёт")],
+                         ["Отчёт", "Ответ"])
+
+    def test_letter_without_message(self):
+        self.sender.send_mail("Шарды", "Текст письма", self.users[1:2])
+        # в базе писем ссылка на сообщение базой не проверяется
+        Message.objects.all().delete()
+        self.assertTrue(Letter.objects.for_user(self.users[1]).exists())
+        self.assertEqual(list(Letter.objects.for_user(self.users[1]).with_content()), [])
+
+    def test_archive(self):
+        self.sender.send_mail("Архив", "Текст письма", self.users[1:])
+        letter_ids = {user.pk: Letter.objects.for_user(user).get().id for user in self.users}
+        for user in self.users:
+            Letter.objects.for_user(user).update(is_read=True)
+        with tempfile.TemporaryDirectory() as directory, override_settings(MAILBOX_ARCHIVE_DIR=directory):
+            call_command("archive_letters", days=0, stdout=StringIO())
+            # по сегменту на базу писем
+            self.assertEqual(ArchiveSegment.objects.count(), 2)
+            for user in self.users:
+                self.assertFalse(self._shard_letters(user).exists())
+                letter = archive.UserArchive(user).get_letter(letter_ids[user.pk])
+                self.assertEqual(letter.message.header, "Архив")
+
+    @override_settings(MAILBOX_SEARCH_BACKEND="inverted")
+    def test_benchmarks_write_to_letter_databases(self):
+        call_command("generate_mailbox_data", users=8, messages=10, max_recipients=3, batch_size=5, stdout=StringIO())
+        self.assertFalse(Letter.objects.using("default").exists())
+        user = MailboxUser.objects.filter(email__startswith="gen").first()
+        letter = Letter.objects.for_user(user).with_content().first()
+        word = search.tokenize(letter.message.header)[0]
+        self.assertIn(letter, list(search.search_letters(user, word, page_size=100)))
+
+        output = StringIO()
+        call_command("bench_search", messages=20, users=4, queries=3, vocabulary=50, batch_size=10, stdout=output)
+        self.assertNotIn("Найдено писем в среднем: 0.0", output.getvalue())
+        call_command("bench_database", connections=1, users=4, sends=2, recipients=2, lists=2, reads=2,
+                     stdout=StringIO())
+        # данные замеров откатываются во всех базах
+        self.assertFalse(MailboxUser.objects.filter(email__endswith="@bench.local")
+                         .exclude(email__startswith="gen").exists())
+        for alias in TEST_SHARDS:
+            self.assertFalse(Letter.objects.using(alias).exclude(user__email__startswith="gen").exists())
+
+    def test_orphans_and_user_deletion(self):
+        self.sender.send_mail("Остаётся", "Текст", self.users[1:2])
+        message = Message.objects.get(header="Остаётся")
+        Letter.objects.for_user(self.sender).delete()
+        # письмо адресата хранится в другой базе, сообщение нужно ему
+        call_command("purge_orphan_messages", stdout=StringIO())
+        self.assertTrue(Message.objects.filter(id=message.id).exists())
+
+        recipient = self.users[1]
+        recipient_letters = self._shard_letters(recipient)
+        recipient.delete()
+        self.assertFalse(recipient_letters.exists())
+        call_command("purge_orphan_messages", stdout=StringIO())
+        self.assertFalse(Message.objects.filter(id=message.id).exists())
+        for alias in TEST_SHARDS:
+            self.assertFalse(MessageTerm.objects.using(alias).filter(message_id=message.id).exists())
+
+
+@requires_test_databases
+@override_settings(MAILBOX_READ_REPLICAS=[TEST_REPLICA])
+class TestReadReplicas(TransactionTestCase):
+    """
+    Реплика - копия основной базы на момент setUp, дальнейшие записи в неё не попадают.
+    Без транзакции теста: внутри транзакций чтение идёт в основную базу.
+    """
+    databases = {"default", *filter(None, [TEST_REPLICA])}
+
+    def setUp(self) -> None:
+        mailbox_cache.get_cache().clear()
+        self.sender = MailboxUser.objects.create_user("sender@mail.ru", "password")
+        self.recipient = MailboxUser.objects.create_user("recipient@mail.ru", "password")
+        self.sender.send_mail("Старое", "Текст письма", [self.recipient])
+        self.client.force_login(self.recipient)
+        for model in (MailboxUser, Session, Message, Message.addressees_set.through, Letter, FolderCounters):
+            model.objects.using(TEST_REPLICA).bulk_create(model.objects.using("default").all())
+
+    def test_reads_from_replica_until_own_write(self):
+        self.sender.send_mail("Новое", "Текст письма", [self.recipient])
+        response = self.client.get(reverse("inbox_page"))
+        self.assertContains(response, "Старое")
+        self.assertNotContains(response, "Новое")
+        self.assertNotIn(replicas.PIN_COOKIE, response.cookies)
+
+        # прочтение - запись: ответ закрепляет клиента за основной базой
+        letter = Letter.objects.using("default").get(user=self.recipient, message__header="Старое")
+        response = self.client.get(reverse("letter_page", kwargs={"letter_id": letter.id}))
+        self.assertContains(response, "Текст письма")
+        self.assertIn(replicas.PIN_COOKIE, response.cookies)
+        self.assertTrue(Letter.objects.using("default").get(id=letter.id).is_read)
+        self.assertContains(self.client.get(reverse("inbox_page")), "Новое")
+
+        # без cookie чтение снова идёт в реплику
+        del self.client.cookies[replicas.PIN_COOKIE]
+        mailbox_cache.get_cache().clear()
+        self.assertNotContains(self.client.get(reverse("inbox_page")), "Новое")
+
+    def test_routing_rules(self):
+        router = replicas.ReplicaRouter()
+        # вне HTTP-запроса (команды, очередь доставки) чтение идёт в основную базу
+        self.assertEqual(router.db_for_read(Letter), "default")
+        self.assertEqual(router.db_for_write(Letter), "default")
+
+        state = replicas.ReadState(primary=False)
+        token = replicas._current.set(state)
+        try:
+            self.assertEqual(router.db_for_read(Letter), TEST_REPLICA)
+            with transaction.atomic():
+                self.assertEqual(router.db_for_read(Letter), "default")
+            self.assertEqual(router.db_for_write(Letter), "default")
+            self.assertTrue(state.wrote)
+            self.assertEqual(router.db_for_read(Letter), "default")
+        finally:
+            replicas._current.reset(token)
+
+        # изменяющие запросы и запросы с cookie читают из основной базы с самого начала
+        factory = RequestFactory()
+        self.assertTrue(replicas._start(factory.post("/")).primary)
+        self.assertFalse(replicas._start(factory.get("/")).primary)
+        factory.cookies[replicas.PIN_COOKIE] = "1"
+        self.assertTrue(replicas._start(factory.get("/")).primary)
+
+
+class TestPurgeOrphanMessages(TestCase):
+    fixtures = ["initial_data.json", ]
+
+    def setUp(self) -> None:
+        # сообщения без писем, которые уже есть в фикстуре
+        self._fixture_orphans = Message.objects.orphans().count()
+
+    def test_purge(self):
+        sender, target = MailboxUser.objects.all()[:2]
+        sender.send_mail("Удаляемое", "Текст", [target])
+        sender.send_mail("Остающееся", "Текст", [target])
+        orphan = Message.objects.get(header="Удаляемое")
+        kept = Message.objects.get(header="Остающееся")
+        total_messages = Message.objects.count()
+
+        # все владельцы удалили письма с первым сообщением, у второго осталось письмо адресата
+        Letter.objects.filter(message=orphan).delete()
+        Letter.objects.filter(message=kept, user=sender).delete()
+
+        call_command("purge_orphan_messages", batch_size=2, stdout=StringIO())
+        self.assertFalse(Message.objects.filter(id=orphan.id).exists())
+        self.assertFalse(Message.addressees_set.through.objects.filter(message_id=orphan.id).exists())
+        self.assertTrue(Message.objects.filter(id=kept.id).exists())
+        self.assertEqual(Message.objects.count(), total_messages - 1 - self._fixture_orphans)
+
+
+class TestArchive(TestCase):
+    """Перенос прочитанных писем в файлы архива и их вывод в папках, на странице письма и в API"""
+
+    def setUp(self) -> None:
+        mailbox_cache.get_cache().clear()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        override = override_settings(MAILBOX_ARCHIVE_DIR=directory.name)
+        override.enable()
+        self.addCleanup(override.disable)
+        self.sender = MailboxUser.objects.create_user("archive_sender@mail.ru", "password")
+        self.recipient = MailboxUser.objects.create_user("archive_recipient@mail.ru", "password")
+        for number in range(5):
+            self.sender.send_mail(f"Письмо {number}", f"Текст письма {number}", [self.recipient])
+        self.incoming = list(Letter.objects.for_user(self.recipient).order_by("id"))
+        # три старых письма, одно из них не прочитано
+        Letter.objects.filter(id__in=[letter.id for letter in self.incoming[:3]]) \
+            .update(created_at=timezone.now() - timedelta(days=400))
+        for letter in self.incoming[1:3]:
+            self.recipient.read_letter(letter)
+        self.client.force_login(self.recipient)
+
+    def test_archive_old_letters(self):
+        call_command("archive_letters", days=365, batch_size=1, stdout=StringIO())
+        archived = self.incoming[1:3]
+        self.assertEqual(ArchiveSegment.objects.count(), 2)
+        self.assertFalse(Letter.objects.filter(id__in=[letter.id for letter in archived]).exists())
+        self.assertTrue(Letter.objects.filter(id=self.incoming[0].id).exists())
+        counters = FolderCounters.objects.get(user=self.recipient)
+        self.assertEqual((counters.total_incoming, counters.unread_incoming), (3, 3))
+
+        # сообщения архивных писем больше не нужны базе, письма читаются из файлов
+        Letter.objects.filter(user=self.sender).delete()
+        call_command("purge_orphan_messages", stdout=StringIO())
+        self.assertFalse(Message.objects.filter(header="Письмо 1").exists())
+        # в базе - только список сегментов пользователя и отметки удаления
+        with self.assertNumQueries(2):
+            letter = archive.UserArchive(self.recipient).get_letter(archived[0].id)
+        self.assertTrue(letter.archived)
+        self.assertEqual((letter.message.header, letter.message.sender.email), ("Письмо 1", self.sender.email))
+        self.assertEqual([user.email for user in letter.message.addressees_set.all()], [self.recipient.email])
+
+        response = self.client.get(reverse("inbox_page"))
+        for number in range(5):
+            self.assertContains(response, f"Письмо {number}")
+        self.assertContains(response, reverse("delete_letter", kwargs={"letter_id": archived[0].id}))
+        response = self.client.get(reverse("letter_page", kwargs={"letter_id": archived[0].id}))
+        self.assertContains(response, "Текст письма 1")
+
+        url = reverse("api_letter", kwargs={"letter_id": archived[1].id})
+        self.assertEqual(self.client.get(url).json()["header"], "Письмо 2")
+        read_url = reverse("api_letter_read", kwargs={"letter_id": archived[1].id})
+        self.assertEqual(self.client.post(read_url, json.dumps({"is_read": False}),
+                                          content_type="application/json").status_code, 409)
+        # чужое архивное письмо не находится
+        self.client.force_login(self.sender)
+        self.assertEqual(self.client.get(reverse("letter_page", kwargs={"letter_id": archived[0].id})).status_code,
+                         404)
+        self.assertEqual(self.client.delete(url).status_code, 404)
+
+    def test_delete_archived_letters(self):
+        call_command("archive_letters", days=365, stdout=StringIO())
+        archived = self.incoming[1:3]
+        counters = FolderCounters.objects.get(user=self.recipient)
+        last_seq = ChangeSequence.objects.get(user=self.recipient).last_seq
+
+        response = self.client.get(reverse("delete_letter", kwargs={"letter_id": archived[0].id}))
+        self.assertRedirects(response, reverse("inbox_page"))
+        response = self.client.delete(reverse("api_letter", kwargs={"letter_id": archived[1].id}))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.delete(reverse("api_letter", kwargs={"letter_id": archived[1].id})).status_code,
+                         404)
+
+        self.assertIsNone(archive.UserArchive(self.recipient).get_letter(archived[0].id))
+        response = self.client.get(reverse("inbox_page"))
+        self.assertNotContains(response, "Письмо 1")
+        self.assertNotContains(response, "Письмо 2")
+        self.assertContains(response, "Письмо 0")
+        self.assertEqual(self.client.get(reverse("letter_page", kwargs={"letter_id": archived[0].id})).status_code,
+                         404)
+        # архивные письма уже не входят в счётчики, удаление записывается в журнал изменений
+        self.assertEqual(FolderCounters.objects.get(user=self.recipient).total_incoming, counters.total_incoming)
+        changes = LetterChange.objects.filter(user=self.recipient, seq__gt=last_seq).order_by("seq")
+        self.assertEqual([(change.letter_id, change.get_kind()) for change in changes],
+                         [(letter.id, ChangeKinds.DELETED) for letter in archived])
+
+    def test_folder_limit_and_pagination(self):
+        Letter.objects.filter(user=self.recipient).update(is_read=True)
+        call_command("archive_letters", days=1000, keep=2, batch_size=2, stdout=StringIO())
+        self.assertEqual(Letter.objects.for_user(self.recipient).count(), 2)
+        # у отправителя в папке исходящих тоже пять писем
+        self.assertEqual(Letter.objects.for_user(self.sender).count(), 2)
+
+        expected = [letter.id for letter in reversed(self.incoming)]
+        folder = archive.UserArchive(self.recipient).folder(EmailTypes.INCOMING)
+        letters = Letter.objects.for_user(self.recipient).filter(type=EmailTypes.INCOMING.value).with_content()
+        page = paginate_letters(letters, page_size=3, archive=folder)
+        self.assertEqual([letter.id for letter in page], expected[:3])
+        self.assertEqual([letter.archived for letter in page], [False, False, True])
+        older = paginate_letters(letters, before=page.next_cursor, page_size=3, archive=folder)
+        self.assertEqual([letter.id for letter in older], expected[3:])
+        self.assertIsNone(older.next_cursor)
+        newer = paginate_letters(letters, after=older.previous_cursor, page_size=3, archive=folder)
+        self.assertEqual([letter.id for letter in newer], expected[:3])
+
+    def test_api_folder_list(self):
+        Letter.objects.filter(user=self.recipient).update(is_read=True)
+        call_command("archive_letters", days=365, stdout=StringIO())
+        url = reverse("api_folder_list", kwargs={"folder": "inbox"})
+
+        def ids(**params):
+            return [letter["id"] for letter in json.loads(b"".join(self.client.get(url, params).streaming_content))]
+
+        expected = [letter.id for letter in reversed(self.incoming)]
+        self.assertEqual(ids(), expected)
+        letters = json.loads(b"".join(self.client.get(url).streaming_content))
+        self.assertEqual((letters[-1]["header"], letters[-1]["sender"]), ("Письмо 0", self.sender.email))
+        # курсор и limit общие для писем таблицы и архива
+        self.assertEqual(ids(limit=3), expected[:3])
+        self.assertEqual(ids(before=expected[2], limit=2), expected[3:])
+        self.assertEqual(ids(until=(timezone.now() - timedelta(days=1)).isoformat()), expected[2:])
+        self.assertEqual(ids(since=(timezone.now() - timedelta(days=1)).isoformat()), expected[:2])
+
+    def test_pages_open_covering_segments(self):
+        Letter.objects.filter(user=self.recipient).update(is_read=True)
+        # по сегменту на письмо
+        call_command("archive_letters", days=0, batch_size=1, stdout=StringIO())
+        self.assertEqual(list(ArchiveSegmentUser.objects.filter(user=self.recipient).order_by("min_letter_id")
+                              .values_list("min_letter_id", "max_letter_id", "letters")),
+                         [(letter.id, letter.id, 1) for letter in self.incoming])
+        expected = [letter.id for letter in reversed(self.incoming)]
+        with mock.patch.object(archive, "open_segment", wraps=archive.open_segment) as opened:
+            folder = archive.UserArchive(self.recipient).folder(EmailTypes.INCOMING)
+            self.assertEqual(folder.ids(limit=2), expected[:2])
+            self.assertEqual(opened.call_count, 2)
+            self.assertEqual(folder.ids(before=expected[2], limit=1), expected[3:4])
+            self.assertEqual(opened.call_count, 3)
+            self.assertEqual(folder.ids(after=expected[2], limit=5), expected[1::-1])
+            self.assertEqual(opened.call_count, 3)
+            self.assertEqual(archive.UserArchive(self.recipient).get_letter(expected[4]).message.header, "Письмо 0")
+            self.assertEqual(opened.call_count, 4)
+
+    def test_segment_format(self):
+        letters = list(Letter.objects.filter(message__sender=self.sender).order_by("id").with_content())
+        name = archive.write_segment(letters)
+        segment = archive.Segment(os.path.join(settings.MAILBOX_ARCHIVE_DIR, name))
+        index = segment.user_index(self.recipient.pk)
+        self.assertEqual([entry[0] for entry in index], [letter.id for letter in self.incoming])
+        self.assertEqual(segment.letter(*index[2][2:]).message.text, "Текст письма 2")
+        self.assertEqual(segment.user_index(0), [])
+
+        # недописанный файл не читается
+        path = os.path.join(settings.MAILBOX_ARCHIVE_DIR, "broken.seg")
+        with open(os.path.join(settings.MAILBOX_ARCHIVE_DIR, name), "rb") as source, open(path, "wb") as broken:
+            broken.write(source.read()[:-4])
+        with self.assertRaises(archive.ArchiveError):
+            archive.Segment(path)
+
+
+class TestBenchmarkCommands(TestCase):
+    def test_generate_and_bench(self):
+        letters_before = Letter.objects.count()
+        call_command("generate_mailbox_data", users=20, messages=50, max_recipients=5, batch_size=20,
+                     stdout=StringIO())
+        generated = Message.objects.filter(sender__email__startswith="gen")
+        self.assertEqual(generated.count(), 50)
+        # у каждого сообщения письмо отправителя и по письму на каждого адресата
+        addressees = Message.addressees_set.through.objects.filter(message__in=generated).count()
+        self.assertEqual(Letter.objects.count() - letters_before, 50 + addressees)
+        user = MailboxUser.objects.filter(email__startswith="gen").first()
+        counters = FolderCounters.objects.get(user=user)
+        self.assertEqual(counters.unread_incoming, Letter.objects.filter(
+            user=user, type=EmailTypes.INCOMING.value, is_read=False).count())
+
+        letters_after = Letter.objects.count()
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, "bench.json")
+            call_command("bench_suite", iterations=3, recipients=2, output=output, stdout=StringIO())
+            with open(output, encoding="utf-8") as file:
+                report = json.load(file)
+        self.assertEqual(set(report["operations"]), {"send_mail", "folder_page", "unread_count", "read_letter",
+                                                     "unread_letter", "delete_letter"})
+        self.assertEqual(report["operations"]["send_mail"]["count"], 3)
+        # замер ничего не оставляет в базе
+        self.assertEqual(Letter.objects.count(), letters_after)
+
+
+@override_settings(MAILBOX_QUEUED_DELIVERY=True, MAILBOX_FANOUT_BATCH_SIZE=2)
+class TestQueuedDelivery(BaseTest):
+    """Отложенная доставка через очередь в базе"""
+
+    mail_data = {
+        "addressee": "admin@mail.ru, asdfasdf@mail.ru, number_one@mail.ru",
+        "header": "Письмо через очередь",
+        "text": "Какой-то дурацкий текст.",
+    }
+
+    def _send(self):
+        response = self.client.post(reverse("send_email"), data=self.mail_data)
+        self.assertRedirects(response, reverse("main_page"))
+        return Message.objects.get(header=self.mail_data["header"])
+
+    def test_send_then_deliver(self):
+        message = self._send()
+        # сразу сохранены сообщение с адресатами и письмо отправителя, входящих ещё нет
+        self.assertEqual(message.addressees_set.count(), 3)
+        self.assertTrue(Letter.objects.filter(message=message, type=EmailTypes.OUTGOING.value).exists())
+        self.assertFalse(Letter.objects.filter(message=message, type=EmailTypes.INCOMING.value).exists())
+        self.assertEqual(DeliveryJob.objects.filter(message=message).count(), 2)
+
+        # пока доставка не выполнена, сообщение не считается осиротевшим
+        Letter.objects.filter(message=message).delete()
+        self.assertFalse(Message.objects.orphans().filter(id=message.id).exists())
+
+        call_command("deliver_mail", once=True, stdout=StringIO())
+        self.assertSetEqual(
+            set(Letter.objects.filter(message=message, type=EmailTypes.INCOMING.value).values_list("user_id", flat=True)),
+            {1, 2, 3})
+        self.assertFalse(DeliveryJob.objects.exclude(status=DeliveryStatus.DONE.value).exists())
+        for user in MailboxUser.objects.all():
+            self.assertEqual(FolderCounters.objects.get_for_user(user).unread_incoming,
+                             user.letters_set.filter(type=EmailTypes.INCOMING.value, is_read=False).count())
+
+    def test_retries_then_fails(self):
+        message = self._send()
+        with mock.patch.object(MailboxUser, "_deliver", side_effect=RuntimeError("сбой")), \
+                self.assertLogs("mail_box.delivery", "ERROR"):
+            stats = delivery.run_worker(max_attempts=2, retry_delay=0, once=True)
+        self.assertDictEqual(stats, {"done": 0, "failed": 4})
+        for job in DeliveryJob.objects.filter(message=message):
+            self.assertIs(job.get_status(), DeliveryStatus.FAILED)
+            self.assertEqual(job.attempts, 2)
+            self.assertIn("сбой", job.last_error)
+        self.assertFalse(Letter.objects.filter(message=message, type=EmailTypes.INCOMING.value).exists())
+
+    def test_release_stale_jobs(self):
+        message = self._send()
+        job = DeliveryJob.objects.filter(message=message).first()
+        DeliveryJob.objects.filter(id=job.id).update(status=DeliveryStatus.RUNNING.value,
+                                                     locked_at=timezone.now() - timedelta(hours=1))
+        self.assertEqual(delivery.release_stale_jobs(timeout=60), 1)
+        self.assertIs(DeliveryJob.objects.get(id=job.id).get_status(), DeliveryStatus.PENDING)
+
+
+class TestRecipients(BaseTest):
+    """Ввод адресатов по email с подсказками"""
+
+    def test_send_page_does_not_list_users(self):
+        with CaptureQueriesContext(connection) as context:
+            response = self.client.get(reverse("send_email_page"))
+        self.assertNotContains(response, "<option")
+        # запрашивается только текущий пользователь сессии
+        user_queries = [q for q in context.captured_queries if "accounts_mailboxuser" in q["sql"]]
+        self.assertEqual(len(user_queries), 1)
+
+    def test_autocomplete(self):
+        response = self.client.get(reverse("recipients_autocomplete"), {"q": "a"})
+        self.assertEqual(response.status_code, 200)
+        emails = [user["email"] for user in json.loads(response.content.decode())]
+        self.assertListEqual(emails, ["admin@mail.ru", "asdfasdf@mail.ru"])
+
+        with override_settings(MAILBOX_AUTOCOMPLETE_LIMIT=1):
+            response = self.client.get(reverse("recipients_autocomplete"), {"q": "a"})
+        self.assertEqual(len(json.loads(response.content.decode())), 1)
+
+        response = self.client.get(reverse("recipients_autocomplete"), {"q": "number_one@"})
+        self.assertEqual(json.loads(response.content.decode())[0]["name"], "Вася Пупкин")
+        response = self.client.get(reverse("recipients_autocomplete"), {"q": ""})
+        self.assertListEqual(json.loads(response.content.decode()), [])
+        # символы шаблона LIKE ищутся как есть
+        response = self.client.get(reverse("recipients_autocomplete"), {"q": "_"})
+        self.assertListEqual(json.loads(response.content.decode()), [])
+
+    @skipUnless(connection.vendor == "postgresql", "индекс varchar_pattern_ops есть только в PostgreSQL")
+    def test_autocomplete_pattern_index(self):
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT indexdef FROM pg_indexes WHERE tablename = %s",
+                           [MailboxUser._meta.db_table])
+            indexes = [row[0] for row in cursor.fetchall()]
+        self.assertTrue([index for index in indexes if "(email varchar_pattern_ops)" in index], indexes)
+
+    @skipUnless(connection.vendor == "sqlite", "план запроса проверяется для sqlite")
+    def test_autocomplete_uses_email_index(self):
+        users = MailboxUser.objects.filter(email__startswith="a", email__gte="a", email__lt="a\uffff")
+        sql, params = users.values("email").query.sql_with_params()
+        with connection.cursor() as cursor:
+            cursor.execute("EXPLAIN QUERY PLAN " + sql, params)
+            plan = " ".join(str(row[-1]) for row in cursor.fetchall())
+        self.assertIn("INDEX", plan)
+
+    def test_form_validates_with_one_query(self):
+        form = EmailForm({"addressee": "number_one@mail.ru; admin@mail.ru,admin@mail.ru",
+                          "header": "Заголовок", "text": "Текст"})
+        with self.assertNumQueries(1):
+            self.assertTrue(form.is_valid())
+        self.assertListEqual(form.cleaned_data["addressee"], [3, 1])
+
+        form = EmailForm({"addressee": "admin@mail.ru, not-an-email", "header": "Заголовок", "text": "Текст"})
+        self.assertFalse(form.is_valid())
+        with override_settings(MAILBOX_FORM_MAX_RECIPIENTS=1):
+            form = EmailForm({"addressee": "admin@mail.ru, number_one@mail.ru", "header": "Заголовок", "text": "Т"})
+            self.assertFalse(form.is_valid())
+
+
+class SearchTestMixin:
+    """Проверки поиска, общие для всех поисковых механизмов"""
+
+    backend = None
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.sender = MailboxUser.objects.exclude(id=self.authorized_user.id).earliest("id")
+        with override_settings(MAILBOX_SEARCH_BACKEND=self.backend):
+            self.sender.send_mail("Отчёт за квартал", "Продажи выросли, отчёт во вложении", [self.authorized_user])
+            self.sender.send_mail("Обед", "Идём на обед? Отчёт подождёт", [self.authorized_user])
+            self.sender.send_mail("Квартал", "Только для отправителя", [self.sender])
+
+    def _search(self, query, **kwargs):
+        with override_settings(MAILBOX_SEARCH_BACKEND=self.backend):
+            return search.search_letters(self.authorized_user, query, **kwargs)
+
+    def test_ranking(self):
+        results = self._search("отчёт")
+        headers = [letter.message.header for letter in results]
+        # совпадение в заголовке важнее совпадения в тексте
+        self.assertListEqual(headers, ["Отчёт за квартал", "Обед"])
+
+    def test_all_words_required_and_user_scope(self):
+        self.assertListEqual([l.message.header for l in self._search("ОТЧЁТ квартал")], ["Отчёт за квартал"])
+        # письмо отправителя самому себе не видно другому пользователю
+        self.assertListEqual([l.message.header for l in self._search("отправителя")], [])
+        self.assertFalse(self._search("отчёт", email_type=EmailTypes.OUTGOING).letters)
+        self.assertFalse(self._search("  !!! ").letters)
+
+    def test_pagination(self):
+        first = self._search("отчёт", page_size=1)
+        second = self._search("отчёт", page=2, page_size=1)
+        self.assertTrue(first.has_next)
+        self.assertFalse(second.has_next)
+        self.assertNotEqual(first.letters, second.letters)
+
+    def test_search_views(self):
+        with override_settings(MAILBOX_SEARCH_BACKEND=self.backend):
+            response = self.client.get(reverse("search_page"), {"q": "обед"})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(len(response.context["results"]), 1)
+            response = self.client.get(reverse("api_search"), {"q": "отчёт", "folder": "inbox"})
+            self.assertEqual(len(json.loads(response.content.decode())["letters"]), 2)
+
+
+@skipUnless(connection.vendor == "sqlite", "FTS5 есть только в sqlite")
+class TestFts5Search(SearchTestMixin, BaseTest):
+    backend = "fts5"
+
+    def test_purged_messages_leave_index(self):
+        message = Message.objects.get(header="Обед")
+        Letter.objects.filter(message=message).delete()
+        call_command("purge_orphan_messages", stdout=StringIO())
+        self.assertListEqual([l.message.header for l in self._search("обед")], [])
+
+    def test_auto_backend_resolved_once(self):
+        with override_settings(MAILBOX_SEARCH_BACKEND="auto"):
+            search.get_backend()
+            with self.assertNumQueries(0):
+                self.assertEqual(search.get_backend().name, "fts5")
+
+
+class TestInvertedIndexSearch(SearchTestMixin, BaseTest):
+    backend = "inverted"
+
+    def test_rebuild(self):
+        with override_settings(MAILBOX_SEARCH_BACKEND=self.backend):
+            MessageTerm.objects.all().delete()
+            call_command("rebuild_search_index", stdout=StringIO())
+        self.assertEqual(len(self._search("отчёт")), 2)
+
+    def test_message_count_cached(self):
+        search.InvertedIndexBackend._idf(["отчёт"])
+        with CaptureQueriesContext(connection) as context:
+            self.assertIsNotNone(search.InvertedIndexBackend._idf(["отчёт"]))
+        self.assertEqual(len(context.captured_queries), 1)
+        self.assertNotIn('FROM "mail_box_message"', context.captured_queries[0]["sql"])
+
+
+class TestDatabaseProfile(TestCase):
+    """Проверки, которые запускаются на каждом профиле базы (MAILBOX_DB)"""
+    # makemigrations проверяет историю миграций во всех базах, в том числе в базах писем и реплике
+    databases = {"default", *TEST_SHARDS, *filter(None, [TEST_REPLICA])}
+
+    def test_migrations_match_models(self):
+        # база тестов создаётся миграциями, здесь проверяется, что они не отстают от моделей
+        call_command("makemigrations", "--check", "--dry-run", stdout=StringIO())
+
+    @requires_test_databases
+    def test_letter_foreign_keys(self):
+        # ограничения внешних ключей писем есть в основной базе и отсутствуют в базах писем
+        def foreign_keys(alias):
+            with connections[alias].cursor() as cursor:
+                constraints = connections[alias].introspection.get_constraints(cursor, Letter._meta.db_table)
+            return {tuple(constraint["columns"]) for constraint in constraints.values() if constraint["foreign_key"]}
+
+        self.assertEqual(foreign_keys("default"), {("user_id",), ("message_id",)})
+        self.assertEqual(foreign_keys(TEST_SHARDS[0]), set())
+
+    def _new_connection(self):
+        wrapper = connections["default"].__class__(connection.settings_dict, alias="pool_test")
+        self.addCleanup(wrapper.close)
+        return wrapper
+
+    def _backend_pid(self, wrapper) -> int:
+        with wrapper.cursor() as cursor:
+            cursor.execute("SELECT pg_backend_pid()")
+            return cursor.fetchone()[0]
+
+    @skipUnless(connection.settings_dict.get("PRAGMAS"), "настройка соединений только в профиле sqlite")
+    def test_sqlite_pragmas_applied(self):
+        with connection.cursor() as cursor:
+            cursor.execute("PRAGMA busy_timeout")
+            self.assertEqual(cursor.fetchone()[0], settings.SQLITE_PRAGMAS["busy_timeout"])
+        # тестовая база в памяти, режим журнала проверяется на файле; без MAILBOX_SQLITE_WAL он не меняется
+        for pragmas, journal_mode in [(settings.SQLITE_PRAGMAS, "delete"),
+                                      ({**settings.SQLITE_PRAGMAS, **settings.SQLITE_WAL_PRAGMAS}, "wal")]:
+            with tempfile.TemporaryDirectory() as directory:
+                wrapper = connections["default"].__class__(
+                    {**connection.settings_dict, "NAME": os.path.join(directory, "db.sqlite3"), "PRAGMAS": pragmas},
+                    alias="pragmas_test")
+                try:
+                    with wrapper.cursor() as cursor:
+                        cursor.execute("PRAGMA journal_mode")
+                        self.assertEqual(cursor.fetchone()[0], journal_mode)
+                finally:
+                    wrapper.close()
+
+    @skipUnless(connection.settings_dict.get("POOL"), "пул соединений включён только в профиле postgresql")
+    def test_pool_reuses_connections(self):
+        wrapper = self._new_connection()
+        pid = self._backend_pid(wrapper)
+        wrapper.close()
+        self.assertEqual(self._backend_pid(wrapper), pid)
+
+    @skipUnless(connection.settings_dict.get("POOL"), "пул соединений включён только в профиле postgresql")
+    def test_health_check_once_per_request(self):
+        wrapper = self._new_connection()
+        pid = self._backend_pid(wrapper)
+        with mock.patch.object(wrapper, "is_usable", wraps=wrapper.is_usable) as is_usable:
+            # конец запроса и начало следующего соединение не проверяют
+            wrapper.close_if_unusable_or_obsolete()
+            wrapper.close_if_unusable_or_obsolete()
+            self.assertEqual(is_usable.call_count, 0)
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_terminate_backend(%s)", [pid])
+            # первое обращение в запросе проверяет соединение и заменяет разорванное, следующие - нет
+            self.assertNotEqual(self._backend_pid(wrapper), pid)
+            self._backend_pid(wrapper)
+            self.assertEqual(is_usable.call_count, 1)
+
+    @skipUnless(connection.settings_dict.get("POOL"), "пул соединений включён только в профиле postgresql")
+    def test_pool_health_check_replaces_dead_connection(self):
+        wrapper = self._new_connection()
+        pid = self._backend_pid(wrapper)
+        wrapper.close()
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT pg_terminate_backend(%s)", [pid])
+        self.assertNotEqual(self._backend_pid(wrapper), pid)
@@ -1,6 +1,8 @@
 from django.urls import path
 
-from mail_box.views import inbox, sent_box, send_email, send_email_page, letter_page, delete_letter
+from mail_box.api import folder_list, letter_detail, letter_read_mark, send_letter, letters_bulk, \
+    recipients_autocomplete, search as api_search, cache_stats, changes
+from mail_box.views import inbox, sent_box, send_email, send_email_page, letter_page, delete_letter, search
 
 urlpatterns = [
     path("inbox/", inbox, name="inbox_page"),
@@ -8,5 +10,16 @@ urlpatterns = [
     path("send-email-page/", send_email_page, name="send_email_page"),
     path("send-email/", send_email, name="send_email"),
     path("letter/letter_id-<int:letter_id>/", letter_page, name="letter_page"),
-    path("letter/delete/letter_id-<int:letter_id>/", delete_letter, name="delete_letter")
-]
\ No newline at end of file
+    path("letter/delete/letter_id-<int:letter_id>/", delete_letter, name="delete_letter"),
+    path("search/", search, name="search_page"),
+    # JSON API
+    path("api/folders/<str:folder>/", folder_list, name="api_folder_list"),
+    path("api/letters/", send_letter, name="api_send_letter"),
+    path("api/letters/bulk/", letters_bulk, name="api_letters_bulk"),
+    path("api/letters/<int:letter_id>/", letter_detail, name="api_letter"),
+    path("api/letters/<int:letter_id>/read/", letter_read_mark, name="api_letter_read"),
+    path("api/changes/", changes, name="api_changes"),
+    path("api/recipients/", recipients_autocomplete, name="recipients_autocomplete"),
+    path("api/search/", api_search, name="api_search"),
+    path("api/cache/stats/", cache_stats, name="api_cache_stats"),
+]
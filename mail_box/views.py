@@ -1,42 +1,117 @@
+import hashlib
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
 from django.core.exceptions import PermissionDenied
+from django.core.handlers.asgi import ASGIRequest
+from django.db import close_old_connections
+from django.http import HttpResponse
 from django.shortcuts import render, redirect, get_object_or_404
+from django.utils.cache import get_conditional_response, patch_cache_control
+from django.utils.http import quote_etag, http_date
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.http import require_POST, require_GET
 
-from mail_box.forms import EmailForm
-from .models import Letter, EmailTypes
+from mail_box import cache as mailbox_cache
+from mail_box.archive import UserArchive
+from mail_box.events import EVENTS_PATH
+from mail_box.forms import EmailForm, SearchForm
+from mail_box.pagination import paginate_letters, get_cursor
+from mail_box.search import search_letters
+from .models import Letter, EmailTypes, FolderCounters, FOLDERS
 from accounts.models import MailboxUser
 
 
+def async_view(view):
+    """
+    Асинхронная версия страницы.
+    ORM django синхронный, поэтому тело страницы (запросы к базе, сессия, отрисовка) выполняется
+    одним переходом в поток. Под ASGI это поток из пула цикла событий, а не единственный поток,
+    в котором django выполняет синхронные представления, поэтому медленная страница не задерживает остальные.
+    Под WSGI у запроса уже есть свой поток, и тело выполняется в нём.
+    """
+
+    def run_in_pool(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        finally:
+            # соединение потока пула закрывается по тем же правилам, что и в конце обычного запроса
+            close_old_connections()
+
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if isinstance(request, ASGIRequest):
+            return await sync_to_async(run_in_pool, thread_sensitive=False)(request, *args, **kwargs)
+        return await sync_to_async(view)(request, *args, **kwargs)
+    return wrapper
+
+
+@async_view
 @require_GET
 def main_page(request):
     """Главная страница"""
     user = request.user
     if user.is_authenticated:
-        total_new_letters = Letter.objects.filter(user=user, type=EmailTypes.INCOMING.value, is_read=False).count()
+        total_new_letters = mailbox_cache.get_or_set(
+            user.pk, "counters", "unread", lambda: FolderCounters.objects.get_for_user(user).unread_incoming)
     else:
         total_new_letters = []
-    return render(request, "main_page.html", {"total_new_letters": total_new_letters})
+    # поток уведомлений обслуживается только ASGI-сервером (mailbox_project.asgi)
+    events_url = EVENTS_PATH if user.is_authenticated and isinstance(request, ASGIRequest) else None
+    return render(request, "main_page.html", {"total_new_letters": total_new_letters, "events_url": events_url})
+
+
+def _folder_page(request, email_type: "EmailTypes", template: str):
+    """
+    Страница папки. Первая страница без уведомлений кэшируется отрисованной,
+    остальные страницы открываются редко и всегда выбираются из базы.
+    """
+    user = request.user
+    before, after = get_cursor(request, "before"), get_cursor(request, "after")
+
+    def render_page():
+        letters = Letter.objects.for_user(user).filter(type=email_type.value).with_content()
+        page = paginate_letters(letters, before=before, after=after, archive=UserArchive(user).folder(email_type))
+        return render(request, template, {"letters": page.letters, "page": page})
 
+    if before is None and after is None and not len(messages.get_messages(request)):
+        content = mailbox_cache.get_or_set(user.pk, "folder", email_type.name, lambda: render_page().content)
+        return HttpResponse(content)
+    return render_page()
 
+
+@async_view
 @require_GET
 @login_required
 def inbox(request):
     """Ящик входящей почты"""
-    user = request.user
-    letters = Letter.objects.filter(user=user, type=EmailTypes.INCOMING.value).order_by("-id")
-    return render(request, "mail_box/inbox.html", {"letters": letters})
+    return _folder_page(request, EmailTypes.INCOMING, "mail_box/inbox.html")
 
 
+@async_view
 @require_GET
 @login_required
 def sent_box(request):
     """Ящик исходящей почты"""
-    user = request.user
-    letters = Letter.objects.filter(user=user, type=EmailTypes.OUTGOING.value).order_by("-id")
-    return render(request, "mail_box/sent.html", {"letters": letters})
+    return _folder_page(request, EmailTypes.OUTGOING, "mail_box/sent.html")
+
+
+@require_GET
+@login_required
+def search(request):
+    """Поиск по письмам пользователя"""
+    form = SearchForm(request.GET or None)
+    results = None
+    if form.is_valid():
+        folder = form.cleaned_data["folder"]
+        results = search_letters(request.user, form.cleaned_data["q"],
+                                 email_type=FOLDERS[folder] if folder else None,
+                                 page=form.cleaned_data["page"] or 1)
+    return render(request, "mail_box/search.html", {"form": form, "results": results})
 
 
 @require_GET
@@ -67,29 +142,68 @@ def send_email(request):
     if email_form.is_valid():
         header = email_form.cleaned_data["header"]
         text = email_form.cleaned_data["text"]
-        users = email_form.cleaned_data["addressee"]
-        user.send_mail(header, text, users)
+        recipient_ids = email_form.cleaned_data["addressee"]
+        if settings.MAILBOX_QUEUED_DELIVERY:
+            user.send_mail_queued(header, text, recipient_ids)
+            messages.success(request, "Письмо отправлено и будет доставлено адресатам в ближайшее время.")
+        else:
+            user.send_mail_fanout(header, text, recipient_ids)
+            messages.success(request, "Письмо успешно отправлено.")
         response = redirect("main_page")
-        messages.success(request, "Письмо успешно отправлено.")
     else:
         response = render(request, "mail_box/send_email_page.html", {"email_form": email_form})
     return response
 
 
+def _letter_etag(letter: "Letter", user: "MailboxUser") -> str:
+    """
+    ETag страницы письма. Содержимое сообщения не меняется,
+    поэтому достаточно id письма и сообщения и данных отправителя и пользователя, выводимых на странице.
+    """
+    sender = letter.message.sender
+    key = f"{letter.id}:{letter.message_id}:{sender}:{user}"
+    return hashlib.md5(key.encode()).hexdigest()
+
+
+@async_view
 @require_GET
 @login_required
 def letter_page(request, letter_id):
-    """Страница для просмотра содержимого письма."""
+    """
+    Страница для просмотра содержимого письма.
+    Письмо кэшируется для пользователя, сообщение с отправителем берётся из общего кэша сообщений.
+    Повторный просмотр прочитанного письма в базу не пишет,
+    а клиент с актуальным ETag получает 304 без отрисовки страницы.
+    Письма, которых нет в таблице, ищутся в архиве пользователя.
+    """
 
     # noinspection PyTypeChecker
     user: "MailboxUser" = request.user
-    letter = get_object_or_404(Letter, id=letter_id)
+    letter = mailbox_cache.get_or_set(
+        user.pk, "letter", str(letter_id),
+        lambda: Letter.objects.for_user(user).with_content().filter(id=letter_id).first())
+    if letter is None:
+        letter = UserArchive(user).get_letter(letter_id)
+    if letter is None:
+        # своего письма нет: чужое письмо - 403, несуществующее - 404
+        letter = get_object_or_404(Letter.objects.on_shard_of(user), id=letter_id)
 
     if not user.is_ownership_letter(letter):  # здесь поставил проверку, для больше наглядности
         raise PermissionDenied()
 
     user.read_letter(letter)
-    return render(request, "mail_box/letter_page.html", {"letter": letter})
+    etag = quote_etag(_letter_etag(letter, user))
+    last_modified = int(letter.message.sent_at.timestamp())  # содержимое сообщения после отправки не меняется
+    # непоказанные уведомления выводятся на странице, поэтому при их наличии страница отдаётся целиком
+    if not len(messages.get_messages(request)):
+        response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+        if response is not None:
+            return response
+    response = render(request, "mail_box/letter_page.html", {"letter": letter})
+    response["ETag"] = etag
+    response["Last-Modified"] = http_date(last_modified)
+    patch_cache_control(response, private=True, no_cache=True)
+    return response
 
 
 @require_GET
@@ -107,10 +221,15 @@ def delete_letter(request, letter_id):
     # noinspection PyTypeChecker
     user: "MailboxUser" = request.user
 
-    letter = get_object_or_404(Letter, id=letter_id)
+    letter = Letter.objects.for_user(user).filter(id=letter_id).first()
+    if letter is None:
+        letter = UserArchive(user).get_letter(letter_id)
+    if letter is None:
+        # своего письма нет: чужое письмо - 403, несуществующее - 404
+        letter = get_object_or_404(Letter.objects.on_shard_of(user), id=letter_id)
     if not user.is_ownership_letter(letter):
         raise PermissionDenied()
-    letter.delete()
+    user.delete_letter(letter)
 
     if letter.get_type() is EmailTypes.INCOMING:
         response = redirect("inbox_page")
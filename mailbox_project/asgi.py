@@ -0,0 +1,26 @@
+"""
+ASGI config for mailbox_project project.
+
+It exposes the ASGI callable as a module-level variable named ``application``.
+Уведомления о новых письмах (mail_box.events) обслуживаются напрямую на asyncio,
+остальные запросы передаются django.
+
+For more information on this file, see
+https://docs.djangoproject.com/en/3.0/howto/deployment/asgi/
+"""
+
+import os
+
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'mailbox_project.settings')
+
+django_application = get_asgi_application()
+
+from mail_box.events import EVENTS_PATH, events_app  # noqa: E402 - модели доступны только после настройки django
+
+
+async def application(scope, receive, send):
+    if scope["type"] == "http" and scope["path"] == EVENTS_PATH:
+        return await events_app(scope, receive, send)
+    return await django_application(scope, receive, send)
@@ -0,0 +1,174 @@
+"""
+Бэкенд PostgreSQL с пулом соединений внутри процесса.
+
+Закрытое django соединение не разрывается, а возвращается в пул и отдаётся следующему запросу,
+поэтому установка соединения (а это несколько обменов с сервером и запуск процесса postgres)
+происходит только при росте нагрузки. Настройки в DATABASES:
+    "POOL": {"MAX_SIZE": 20, "TIMEOUT": 10} - размер пула и ожидание свободного соединения в секундах,
+                                             без ключа POOL бэкенд ведёт себя как стандартный;
+    "HEALTH_CHECKS": True - проверять соединение перед повторным использованием: взятое из пула - при выдаче,
+                            сохранённое между запросами (CONN_MAX_AGE) - при первом обращении в новом запросе.
+"""
+import os
+import threading
+
+from django.db.backends.postgresql import base
+from django.db.backends.postgresql.creation import DatabaseCreation as BaseDatabaseCreation
+
+Database = base.Database
+
+
+def _is_alive(connection) -> bool:
+    try:
+        with connection.cursor() as cursor:
+            cursor.execute("SELECT 1")
+    except Database.Error:
+        return False
+    return True
+
+
+class ConnectionPool:
+    """
+    Пул соединений одного процесса.
+    Свободные соединения хранятся в стеке, число выданных ограничено max_size:
+    при исчерпании пула поток ждёт освобождения соединения не дольше timeout секунд.
+    """
+
+    def __init__(self, conn_params: dict, max_size: int, timeout: float):
+        self.conn_params = conn_params
+        self.timeout = timeout
+        self._idle = []
+        self._lock = threading.Lock()
+        self._slots = threading.BoundedSemaphore(max_size)
+
+    def getconn(self, health_check: bool):
+        if not self._slots.acquire(timeout=self.timeout):
+            raise Database.OperationalError("Нет свободных соединений в пуле.")
+        try:
+            while True:
+                with self._lock:
+                    connection = self._idle.pop() if self._idle else None
+                if connection is None:
+                    return Database.connect(**self.conn_params)
+                if not connection.closed and (not health_check or _is_alive(connection)):
+                    return connection
+                connection.close()  # соединение разорвано сервером, берётся следующее
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def putconn(self, connection):
+        try:
+            if not connection.closed:
+                if connection.get_transaction_status() != base.psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                    connection.rollback()
+                with self._lock:
+                    self._idle.append(connection)
+        except Database.Error:
+            connection.close()
+        finally:
+            self._slots.release()
+
+    def close(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for connection in idle:
+            connection.close()
+
+
+class DatabaseCreation(BaseDatabaseCreation):
+
+    def _destroy_test_db(self, test_database_name, verbosity):
+        # пул держит соединения с тестовой базой открытыми, с ними её не удалить
+        DatabaseWrapper.close_pools()
+        super()._destroy_test_db(test_database_name, verbosity)
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+    creation_class = DatabaseCreation
+
+    # пулы процесса по параметрам соединения; pid в ключе - чтобы дочерний процесс не взял соединения родителя
+    _pools = {}
+    _pools_lock = threading.Lock()
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._pool = None
+        # проверено ли соединение в текущем запросе
+        self.health_check_done = False
+
+    @property
+    def health_checks(self) -> bool:
+        return bool(self.settings_dict.get("HEALTH_CHECKS"))
+
+    def _get_pool(self, conn_params: dict) -> "ConnectionPool":
+        options = self.settings_dict["POOL"]
+        key = (os.getpid(), tuple(sorted(conn_params.items())))
+        with self._pools_lock:
+            pool = self._pools.get(key)
+            if pool is None:
+                pool = ConnectionPool(conn_params, options.get("MAX_SIZE", 20), options.get("TIMEOUT", 10))
+                self._pools[key] = pool
+        return pool
+
+    @classmethod
+    def close_pools(cls):
+        """Закрывает свободные соединения всех пулов процесса"""
+        with cls._pools_lock:
+            pools, cls._pools = list(cls._pools.values()), {}
+        for pool in pools:
+            pool.close()
+
+    @base.async_unsafe
+    def get_new_connection(self, conn_params):
+        if self.settings_dict.get("POOL") is None:
+            return super().get_new_connection(conn_params)
+        self._pool = self._get_pool(conn_params)
+        connection = self._pool.getconn(self.health_checks)
+
+        # как в стандартном бэкенде: уровень изоляции из OPTIONS или по умолчанию сервера
+        options = self.settings_dict["OPTIONS"]
+        try:
+            self.isolation_level = options["isolation_level"]
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def connect(self):
+        # новое соединение или соединение из пула, проверенное при выдаче; флаг ставится заранее,
+        # потому что настройка соединения в connect сама вызывает ensure_connection
+        self.health_check_done = True
+        super().connect()
+
+    def ensure_connection(self):
+        self._close_if_health_check_failed()
+        super().ensure_connection()
+
+    def _close_if_health_check_failed(self):
+        """Закрывает переставшее отвечать соединение, один раз за запрос и не внутри транзакции"""
+        if self.connection is None or not self.health_checks or self.health_check_done or self.in_atomic_block:
+            return
+        self.health_check_done = True
+        if not self.is_usable():
+            self.close()
+
+    def _close(self):
+        if self._pool is None:
+            return super()._close()
+        pool, self._pool = self._pool, None
+        with self.wrap_database_errors:
+            pool.putconn(self.connection)
+
+    def close_if_unusable_or_obsolete(self):
+        """
+        В начале и в конце запроса: только стандартные проверки, без запроса к серверу.
+        Постоянное соединение проверяется при первом обращении в следующем запросе (ensure_connection),
+        поэтому запрос, не обращающийся к базе, и конец запроса проверку не выполняют.
+        """
+        # стандартные проверки читают autocommit через ensure_connection, проверка соединения здесь не нужна
+        self.health_check_done = True
+        super().close_if_unusable_or_obsolete()
+        self.health_check_done = False
@@ -12,6 +12,8 @@ https://docs.djangoproject.com/en/2.2/ref/settings/
 
 import os
 
+from django.core.exceptions import ImproperlyConfigured
+
 # Build paths inside the project like this: os.path.join(BASE_DIR, ...)
 from django.urls import reverse
 
@@ -45,6 +47,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    # первым, чтобы учитывать и запросы остальных промежуточных слоёв (сессия, пользователь)
+    'mail_box.middleware.query_instrumentation_middleware',
+    # до сессии: сессия и пользователь тоже читаются из реплики или основной базы по правилам mail_box.replicas
+    'mail_box.replicas.read_replica_middleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -78,11 +84,124 @@ WSGI_APPLICATION = 'mailbox_project.wsgi.application'
 # Database
 # https://docs.djangoproject.com/en/2.2/ref/settings/#databases
 
-DATABASES = {
-    'default': {
-        'ENGINE': 'django.db.backends.sqlite3',
-        'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+# Профиль базы выбирается переменной окружения MAILBOX_DB: sqlite (по умолчанию) или postgresql.
+# Параметры PostgreSQL задаются переменными MAILBOX_DB_NAME, MAILBOX_DB_USER, MAILBOX_DB_PASSWORD,
+# MAILBOX_DB_HOST, MAILBOX_DB_PORT, время жизни соединения - MAILBOX_DB_CONN_MAX_AGE (секунды),
+# размер пула соединений процесса - MAILBOX_DB_POOL_SIZE (0 - без пула).
+
+# Для sqlite MAILBOX_SQLITE_TUNING=0 отключает настройку соединений (SQLITE_PRAGMAS) и IMMEDIATE-транзакции.
+# Журнал WAL (SQLITE_WAL_PRAGMAS) включается только явно, MAILBOX_SQLITE_WAL=1: режим журнала записывается
+# в заголовок файла базы, а поставляемый db.sqlite3 не должен меняться от запуска любой команды manage.py.
+
+MAILBOX_DB = os.environ.get("MAILBOX_DB", "sqlite")
+
+# Применяются к каждому новому соединению sqlite
+SQLITE_PRAGMAS = {
+    "busy_timeout": 5000,  # миллисекунды ожидания занятой базы вместо немедленной ошибки
+    "mmap_size": 256 * 1024 * 1024,
+    "cache_size": -32000,  # отрицательное значение - в килобайтах
+    "temp_store": "MEMORY",
+}
+
+# Добавляются к SQLITE_PRAGMAS при MAILBOX_SQLITE_WAL=1
+SQLITE_WAL_PRAGMAS = {
+    "journal_mode": "WAL",  # читатели не блокируются записью
+    "synchronous": "NORMAL",  # в режиме WAL fsync только при контрольной точке, целостность сохраняется
+}
+
+if MAILBOX_DB == "sqlite":
+    _sqlite_tuning = os.environ.get("MAILBOX_SQLITE_TUNING", "1") == "1"
+    _sqlite_wal = os.environ.get("MAILBOX_SQLITE_WAL", "0") == "1"
+    DATABASES = {
+        'default': {
+            'ENGINE': 'mailbox_project.sqlite_tuned',
+            'NAME': os.path.join(BASE_DIR, 'db.sqlite3'),
+            'PRAGMAS': {**SQLITE_PRAGMAS, **(SQLITE_WAL_PRAGMAS if _sqlite_wal else {})} if _sqlite_tuning else {},
+            'TRANSACTION_MODE': "IMMEDIATE" if _sqlite_tuning else None,
+        }
+    }
+elif MAILBOX_DB == "postgresql":
+    _pool_size = int(os.environ.get("MAILBOX_DB_POOL_SIZE", "20"))
+    DATABASES = {
+        'default': {
+            'ENGINE': 'mailbox_project.postgresql_pool',
+            'NAME': os.environ.get("MAILBOX_DB_NAME", "mailbox"),
+            'USER': os.environ.get("MAILBOX_DB_USER", "postgres"),
+            'PASSWORD': os.environ.get("MAILBOX_DB_PASSWORD", ""),
+            'HOST': os.environ.get("MAILBOX_DB_HOST", "localhost"),
+            'PORT': os.environ.get("MAILBOX_DB_PORT", "5432"),
+            'CONN_MAX_AGE': int(os.environ.get("MAILBOX_DB_CONN_MAX_AGE", "60")),
+            'HEALTH_CHECKS': True,
+            'POOL': {"MAX_SIZE": _pool_size, "TIMEOUT": 10} if _pool_size else None,
+        }
+    }
+else:
+    raise ImproperlyConfigured(f"Неизвестный профиль базы MAILBOX_DB={MAILBOX_DB!r}: ожидается sqlite или postgresql.")
+
+# Шардирование писем (mail_box/shards.py): MAILBOX_SHARDS баз писем рядом с основной базой
+# (файлы db_letters_<n>.sqlite3 или базы <имя>_letters_<n> того же сервера PostgreSQL).
+# Письма пользователя хранятся в базе MAILBOX_LETTER_SHARDS[id % количество], остальные данные - в основной.
+# 0 - без шардирования. Количество нельзя менять без переноса писем.
+
+MAILBOX_SHARDS = int(os.environ.get("MAILBOX_SHARDS", "0"))
+MAILBOX_LETTER_SHARDS = []
+for _number in range(MAILBOX_SHARDS):
+    _name, _extension = os.path.splitext(DATABASES["default"]["NAME"])
+    DATABASES[f"letters_{_number}"] = {**DATABASES["default"], "NAME": f"{_name}_letters_{_number}{_extension}"}
+    MAILBOX_LETTER_SHARDS.append(f"letters_{_number}")
+
+# Реплики для чтения (mail_box/replicas.py): MAILBOX_DB_REPLICAS - через запятую хосты реплик PostgreSQL
+# или файлы копий базы sqlite. Чтение на страницах идёт в случайную реплику, запись - в основную базу;
+# после записи клиент MAILBOX_REPLICA_PIN_SECONDS секунд читает из основной базы, чтобы видеть свои изменения.
+# В тестах реплики - зеркала основной базы.
+
+MAILBOX_READ_REPLICAS = []
+for _number, _replica in enumerate(filter(None, os.environ.get("MAILBOX_DB_REPLICAS", "").split(","))):
+    _location = "NAME" if MAILBOX_DB == "sqlite" else "HOST"
+    DATABASES[f"replica_{_number}"] = {**DATABASES["default"], _location: _replica.strip(),
+                                       "TEST": {"MIRROR": "default"}}
+    MAILBOX_READ_REPLICAS.append(f"replica_{_number}")
+MAILBOX_REPLICA_PIN_SECONDS = 5
+
+DATABASE_ROUTERS = ["mail_box.shards.LetterShardRouter", "mail_box.replicas.ReplicaRouter"]
+
+
+# Кэш
+# Кэш почтового ящика (mail_box/cache.py) выбирается переменной окружения MAILBOX_CACHE:
+# locmem (по умолчанию, в памяти процесса), file (каталог MAILBOX_CACHE_LOCATION)
+# или memcached (адрес MAILBOX_CACHE_LOCATION, подойдёт и совместимый с memcached сервер).
+# Размер - MAILBOX_CACHE_MAX_ENTRIES записей.
+
+MAILBOX_CACHE = os.environ.get("MAILBOX_CACHE", "locmem")
+_cache_max_entries = int(os.environ.get("MAILBOX_CACHE_MAX_ENTRIES", "10000"))
+
+if MAILBOX_CACHE == "locmem":
+    # locmem вытесняет давно не использованные записи; при CULL_FREQUENCY, равном размеру,
+    # вытесняется по одной записи, то есть это точный LRU
+    _mailbox_cache = {
+        "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+        "LOCATION": "mailbox",
+        "OPTIONS": {"MAX_ENTRIES": _cache_max_entries, "CULL_FREQUENCY": _cache_max_entries},
     }
+elif MAILBOX_CACHE == "file":
+    # общий для процессов; при переполнении удаляется треть записей, без учёта давности использования
+    _mailbox_cache = {
+        "BACKEND": "django.core.cache.backends.filebased.FileBasedCache",
+        "LOCATION": os.environ.get("MAILBOX_CACHE_LOCATION", os.path.join(BASE_DIR, ".mailbox_cache")),
+        "OPTIONS": {"MAX_ENTRIES": _cache_max_entries},
+    }
+elif MAILBOX_CACHE == "memcached":
+    # размер и вытеснение (LRU) настраиваются на сервере memcached
+    _mailbox_cache = {
+        "BACKEND": "django.core.cache.backends.memcached.MemcachedCache",
+        "LOCATION": os.environ.get("MAILBOX_CACHE_LOCATION", "127.0.0.1:11211"),
+    }
+else:
+    raise ImproperlyConfigured(f"Неизвестный кэш MAILBOX_CACHE={MAILBOX_CACHE!r}: ожидается locmem, file или memcached.")
+
+CACHES = {
+    "default": {"BACKEND": "django.core.cache.backends.locmem.LocMemCache"},
+    "mailbox": _mailbox_cache,
 }
 
 
@@ -131,3 +250,80 @@ STATIC_URL = '/static/'
 AUTH_USER_MODEL = "accounts.MailboxUser"
 LOGIN_REDIRECT_URL = "/"
 LOGOUT_REDIRECT_URL = "/"
+
+
+# Настройка почтового ящика
+
+# Количество писем на одной странице папки
+MAILBOX_PAGE_SIZE = 50
+
+# Максимальное количество id писем в одной пакетной операции API
+MAILBOX_BULK_MAX_IDS = 1000
+
+# Размер пакета адресатов при рассылке письма
+MAILBOX_FANOUT_BATCH_SIZE = 500
+
+# Отложенная доставка: входящие письма адресатов создаёт команда deliver_mail
+MAILBOX_QUEUED_DELIVERY = False
+
+# Максимальное количество адресатов в форме письма
+MAILBOX_FORM_MAX_RECIPIENTS = 500
+
+# Количество подсказок при вводе адресата
+MAILBOX_AUTOCOMPLETE_LIMIT = 10
+
+# Механизм поиска по письмам: auto (FTS5 на sqlite, иначе обратный индекс), fts5 или inverted
+MAILBOX_SEARCH_BACKEND = "auto"
+# Сколько секунд число сообщений для ранжирования обратного индекса берётся из кэша
+MAILBOX_SEARCH_COUNT_TIMEOUT = 600
+
+# Алиас кэша почтового ящика в CACHES и время жизни записей в секундах
+MAILBOX_CACHE_ALIAS = "mailbox"
+MAILBOX_CACHE_TIMEOUT = 300
+
+# Кэш содержимого сообщений в памяти процесса: число сообщений и оценка занимаемой памяти в байтах.
+# Если задан алиас кэша django, он используется вторым уровнем, общим для процессов.
+MAILBOX_MESSAGE_CACHE_SIZE = 10000
+MAILBOX_MESSAGE_CACHE_MAX_BYTES = 64 * 1024 * 1024
+MAILBOX_MESSAGE_CACHE_ALIAS = None
+
+# Журнал изменений для синхронизации: максимальное число изменений в одном ответе
+# и сколько дней изменения хранятся до сжатия командой compact_changes
+MAILBOX_SYNC_BATCH_SIZE = 500
+MAILBOX_CHANGES_RETENTION_DAYS = 30
+
+# Архив писем (mail_box.archive): каталог файлов-сегментов, какие прочитанные письма переносит туда команда
+# archive_letters (старше MAILBOX_ARCHIVE_AFTER_DAYS дней или сверх MAILBOX_ARCHIVE_FOLDER_LIMIT последних писем
+# папки, None - без ограничения) и сколько сегментов держится открытыми в памяти процесса
+MAILBOX_ARCHIVE_DIR = os.environ.get("MAILBOX_ARCHIVE_DIR", os.path.join(BASE_DIR, "archive"))
+MAILBOX_ARCHIVE_AFTER_DAYS = 365
+MAILBOX_ARCHIVE_FOLDER_LIMIT = None
+MAILBOX_ARCHIVE_OPEN_SEGMENTS = 128
+
+# Уведомления о новых письмах (mail_box.events): интервал пустых сообщений, поддерживающих соединение,
+# время ожидания при long-poll в секундах и сколько уведомлений хранится для медленного клиента
+MAILBOX_EVENTS_HEARTBEAT = 15
+MAILBOX_EVENTS_LONGPOLL_TIMEOUT = 25
+MAILBOX_EVENTS_QUEUE_SIZE = 100
+
+# Учёт запросов к базе для каждого HTTP-запроса (mail_box.middleware): заголовок Server-Timing
+# и журнал mail_box.sql. Запросы дольше MAILBOX_SLOW_QUERY_MS миллисекунд пишутся в журнал
+# с текстом и страницей (None - не писать). Уровень журнала задаётся переменной окружения MAILBOX_SQL_LOG_LEVEL:
+# WARNING - только медленные запросы, INFO - ещё и строка на каждый HTTP-запрос.
+MAILBOX_SERVER_TIMING = True
+MAILBOX_SLOW_QUERY_MS = 200
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "mail_box.sql": {
+            "handlers": ["console"],
+            "level": os.environ.get("MAILBOX_SQL_LOG_LEVEL", "WARNING"),
+            "propagate": False,
+        },
+    },
+}
@@ -0,0 +1,25 @@
+"""
+Настройки для тестов: основные настройки и базы, нужные тестам шардирования писем и реплик.
+Тесты запускаются с ними: python manage.py test --settings=mailbox_project.settings_test.
+"""
+import os
+import tempfile
+
+from mailbox_project.settings import *  # noqa: F401,F403
+from mailbox_project.settings import DATABASES
+
+# Две локальные базы sqlite для проверки шардирования писем (TestLetterShards),
+# шардирование включается только в самих тестах
+MAILBOX_TEST_SHARDS = ["test_letters_0", "test_letters_1"]
+# Отдельная база, а не зеркало основной: реплика с отставанием для TestReadReplicas
+MAILBOX_TEST_REPLICA = "test_replica"
+
+DATABASES = {
+    **DATABASES,
+    **{alias: {
+        "ENGINE": "mailbox_project.sqlite_tuned",
+        "NAME": os.path.join(tempfile.gettempdir(), f"mailbox_{alias}.sqlite3"),
+        # тестовые базы - файлы, они удаляются после тестов
+        "TEST": {"NAME": os.path.join(tempfile.gettempdir(), f"test_mailbox_{alias}.sqlite3")},
+    } for alias in (*MAILBOX_TEST_SHARDS, MAILBOX_TEST_REPLICA)},
+}
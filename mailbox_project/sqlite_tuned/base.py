@@ -0,0 +1,24 @@
+"""
+Бэкенд sqlite с настройкой каждого нового соединения.
+
+Стандартный журнал отката блокирует читателей на время любой записи, а отложенная (DEFERRED)
+транзакция, начавшая с чтения, при попытке записи получает "database is locked" без ожидания.
+Настройки в DATABASES:
+    "PRAGMAS": {"journal_mode": "WAL", ...} - выполняются при создании соединения;
+    "TRANSACTION_MODE": "IMMEDIATE" - транзакции atomic сразу берут блокировку записи
+                                      и ждут её в пределах busy_timeout.
+"""
+from django.db.backends.sqlite3 import base
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_new_connection(self, conn_params):
+        connection = super().get_new_connection(conn_params)
+        for name, value in self.settings_dict.get("PRAGMAS", {}).items():
+            connection.execute(f"PRAGMA {name} = {value}")
+        return connection
+
+    def _start_transaction_under_autocommit(self):
+        mode = self.settings_dict.get("TRANSACTION_MODE")
+        self.cursor().execute(f"BEGIN {mode}" if mode else "BEGIN")